@@ -0,0 +1,221 @@
+""" Downloads from an S3 bucket in the AWS layout only the files the mosaic datasets of a resolution read, see tileFiles,
+    and hands a tile over to the import as soon as all of its files are on disk:
+        with S3TileSource("sentinel-s2-l2a", region="eu-central-1", requesterPays=True) as source:
+            fetcher = BandFetcher(source, "E:/Sentinel_tiles_from_amazonS3/", workers=8)
+            tiles = [key for key, size, mtime in source.listTiles("tiles/34/U/DB/2018/")]
+            SentinelImporter.addTiles(mosaic_dataset, fetcher.fetchTiles(tiles, "10m"), "10m", cloudmask_featureclass)
+    A file is written to path.part first, an interrupted download goes on from where the part ends and is renamed into
+    place once its size (and the MD5 of the ETag, for objects not uploaded in parts) is verified. """
+import hashlib
+import http.client
+import os
+import posixpath
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from SentinelImporter import loadRasterType
+
+md5Etag = re.compile(r"^[0-9a-f]{32}$")
+# the bands of Rxm of the raster type, for where it is not next to SentinelImporter.py
+rasterFiles = {"10m": ["B02.jp2", "B03.jp2", "B04.jp2", "B08.jp2"],
+               "20m": ["B02.jp2", "B03.jp2", "B04.jp2", "B05.jp2", "B06.jp2", "B07.jp2", "B8A.jp2", "B11.jp2", "B12.jp2"],
+               "20c": ["../qi/CLD_20m.jp2", "B02.jp2", "B03.jp2", "B04.jp2", "B05.jp2", "B06.jp2", "B07.jp2", "B8A.jp2", "B11.jp2", "B12.jp2"]}
+
+def tileFiles(resolution, withCloudMask=True):
+    """ Paths relative to the tile folder of the files of a tile the import of resolution reads: metadata.xml,
+        tileInfo.json, the bands of Rxm[resolution]["bandKeys"] of the raster type (qi/CLD_20m.jp2 included for 20c)
+        and qi/MSK_CLOUDS_B00.gml if withCloudMask. Without the raster type the bands are those of rasterFiles. """
+    folder = "R" + resolution.replace("c", "m")
+    rasterType = loadRasterType()
+    if rasterType:
+        bands = [rasterType.bandProperties[key]["filename"] for key in rasterType.Rxm[resolution]["bandKeys"]]
+    else:
+        bands = rasterFiles[resolution]
+    files = ["metadata.xml", "tileInfo.json"] + [posixpath.normpath(posixpath.join(folder, band)) for band in bands]
+    if withCloudMask:
+        files.append("qi/MSK_CLOUDS_B00.gml")
+    return files
+
+class BandFetcher(object):
+    """ Fetches tile files of source (an S3TileSource, for its endpoint and credentials) below destination, keeping
+        the layout of the keys. At most workers files are downloaded at once, each worker thread keeps its own
+        keep-alive connection. A download failing in the middle is resumed up to retries times. """
+
+    def __init__(self, source, destination, workers=8, retries=3, timeout=60, chunkSize=1 << 20):
+        self.source = source
+        self.destination = destination
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.chunkSize = chunkSize
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.failedTiles = []
+        self.stats = {"files": 0, "skipped": 0, "resumed": 0, "bytes": 0, "seconds": 0.0}
+
+    def localPath(self, key):
+        return os.path.join(self.destination, *key.split("/"))
+
+    def connection(self, fresh=False):
+        """ The connection of the current thread """
+        connection = getattr(self.local, "connection", None)
+        if connection is None or fresh:
+            if connection is not None:
+                connection.close()
+            pool = self.source.pool
+            if pool.sslContext:
+                connection = http.client.HTTPSConnection(pool.host, pool.port, timeout=self.timeout, context=pool.sslContext)
+            else:
+                connection = http.client.HTTPConnection(pool.host, pool.port, timeout=self.timeout)
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+    def request(self, method, key, headers=None):
+        """ Sends a request on the connection of the thread and returns the response, whose body is to be read.
+            A reused connection the server closed in the meantime is replaced once. """
+        target, headers = self.source.prepareRequest(method, key, headers=headers)
+        headers["Host"] = self.source.host
+        for attempt in (0, 1):
+            connection = self.connection(fresh=attempt > 0)
+            try:
+                connection.request(method, target, headers=headers)
+                return connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+                if attempt:
+                    raise
+
+    def fetchFile(self, key):
+        """ Downloads key unless it is already there, retrying an interrupted download from where it stopped.
+            Returns the local path. """
+        path = self.localPath(key)
+        if os.path.exists(path):
+            with self.lock:
+                self.stats["skipped"] += 1
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for attempt in range(self.retries + 1):
+            try:
+                self.download(key, path)
+                return path
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                if attempt == self.retries or isinstance(e, FileNotFoundError):
+                    raise
+                self.connection(fresh=True)
+                time.sleep(0.5*2**attempt)
+
+    def download(self, key, path):
+        part = path + ".part"
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        md5 = hashlib.md5()
+        if offset:
+            with open(part, "rb") as f:
+                for chunk in iter(lambda: f.read(self.chunkSize), b""):
+                    md5.update(chunk)
+        response = self.request("GET", key, {"Range": "bytes={0}-".format(offset)} if offset else None)
+        status = response.status
+        body = response
+        if status == 416:
+            # the part is the whole object already
+            response.read()
+            response = self.request("HEAD", key)
+            response.read()
+            status = response.status
+            total = int(response.getheader("Content-Length", -1))
+            body = None
+        elif status == 206:
+            first, _, total = response.getheader("Content-Range", "").partition(" ")[2].partition("/")
+            if int(first.partition("-")[0]) != offset:
+                response.close()
+                raise IOError("{0}: range starting at {1} requested, {2} received".format(self.source.uri(key), offset, first))
+            total = int(total)
+        elif status == 200:
+            offset = 0
+            md5 = hashlib.md5()
+            total = int(response.getheader("Content-Length", -1))
+        if status == 404:
+            response.read()
+            raise FileNotFoundError("{0} not found".format(self.source.uri(key)))
+        if status >= 300:
+            raise IOError("GET {0} failed with HTTP {1}\n{2}".format(self.source.uri(key), status, response.read()[:500].decode("utf-8", "replace")))
+        etag = (response.getheader("ETag") or "").strip('"')
+        start = time.perf_counter()
+        received = 0
+        if body is not None:
+            with open(part, "ab" if offset else "wb") as f:
+                for chunk in iter(lambda: body.read(self.chunkSize), b""):
+                    f.write(chunk)
+                    md5.update(chunk)
+                    received += len(chunk)
+        size = offset + received
+        with self.lock:
+            self.stats["files"] += 1
+            self.stats["resumed"] += 1 if offset else 0
+            self.stats["bytes"] += received
+            self.stats["seconds"] += time.perf_counter() - start
+        if total >= 0 and size != total:
+            # kept to be resumed
+            raise IOError("{0}: {1} of {2} bytes received".format(self.source.uri(key), size, total))
+        if md5Etag.match(etag) and md5.hexdigest() != etag:
+            os.remove(part)
+            raise ValueError("{0}: MD5 {1} does not match the ETag {2}".format(self.source.uri(key), md5.hexdigest(), etag))
+        os.replace(part, path)
+
+    def fetchTiles(self, tiles, resolution="10m", withCloudMask=True, window=None):
+        """ Downloads the files of the tiles (keys of their metadata.xml, or the (key, size, mtime) of
+            S3TileSource.listTiles) and yields the local path of metadata.xml of every tile as soon as all of its files
+            are there, in the order they complete. Files of at most window tiles (default 2*workers) are queued at once,
+            the tiles are started in the order given. Tiles with a failed file are not yielded, they are in failedTiles
+            as (key, reason). """
+        files = tileFiles(resolution, withCloudMask)
+        window = window or 2*self.workers
+        pending = {}
+        remaining = {}
+        failed = {}
+        tiles = iter(tiles)
+        with ThreadPoolExecutor(self.workers) as executor:
+            def submit():
+                for tile in tiles:
+                    key = tile[0] if isinstance(tile, tuple) else tile
+                    prefix = key.rsplit("/", 1)[0] + "/"
+                    remaining[key] = len(files)
+                    for name in files:
+                        pending[executor.submit(self.fetchFile, prefix + name)] = key
+                    if len(remaining) >= window:
+                        return
+            try:
+                submit()
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key = pending.pop(future)
+                        try:
+                            future.result()
+                        except (OSError, ValueError, http.client.HTTPException) as e:
+                            failed.setdefault(key, str(e))
+                        remaining[key] -= 1
+                        if remaining[key]:
+                            continue
+                        del remaining[key]
+                        if key in failed:
+                            reason = failed.pop(key)
+                            print("Tile {0} not fetched: {1}".format(key, reason))
+                            self.failedTiles.append((key, reason))
+                        else:
+                            yield self.localPath(key)
+                    submit()
+            finally:
+                for future in pending:
+                    future.cancel()
+        self.close()
+
+    def close(self):
+        """ Closes the connections of all worker threads """
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
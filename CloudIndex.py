@@ -0,0 +1,319 @@
+import datetime
+import json
+import os
+import numpy as np
+
+from SentinelImporter import CloudMask, IngestManifest, SentinelImporter
+
+kinds = ("FOOTPRINT", "OPAQUE", "CIRRUS")
+entryType = np.dtype([("xmin", np.float64), ("ymin", np.float64), ("xmax", np.float64), ("ymax", np.float64),
+                      ("epsg", np.int32), ("acquisition", np.int32), ("kind", np.int8), ("area", np.float64)])
+nodeType = np.dtype([("xmin", np.float64), ("ymin", np.float64), ("xmax", np.float64), ("ymax", np.float64),
+                     ("epsgMin", np.int32), ("epsgMax", np.int32), ("first", np.int64), ("count", np.int32)])
+
+def ringArea(coords):
+    """ Area of a ring given as a flat x, y array (shoelace formula) """
+    ring = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    x, y = ring[:, 0], ring[:, 1]
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1)))/2.0
+
+def strOrder(boxes, nodeSize):
+    """ Sort-Tile-Recursive order of the boxes (a structured array with xmin, ymin, xmax, ymax and epsg or
+        epsgMin): by coordinate system, then in vertical slices of about sqrt(n/nodeSize) nodes by x, each slice by y """
+    epsg = boxes["epsg"] if "epsg" in boxes.dtype.names else boxes["epsgMin"]
+    xc = (boxes["xmin"] + boxes["xmax"])/2
+    yc = (boxes["ymin"] + boxes["ymax"])/2
+    leaves = -(-len(boxes)//nodeSize)
+    sliceSize = int(np.ceil(np.sqrt(leaves)))*nodeSize
+    order = np.lexsort((xc, epsg))
+    slices = np.arange(len(boxes))//sliceSize
+    return order[np.lexsort((yc[order], epsg[order], slices))]
+
+def packLevel(boxes, nodeSize):
+    """ Nodes over consecutive groups of nodeSize boxes """
+    starts = np.arange(0, len(boxes), nodeSize)
+    epsgMin = boxes["epsg"] if "epsg" in boxes.dtype.names else boxes["epsgMin"]
+    epsgMax = boxes["epsg"] if "epsg" in boxes.dtype.names else boxes["epsgMax"]
+    nodes = np.empty(len(starts), dtype=nodeType)
+    for name, reduce, values in (("xmin", np.minimum, boxes["xmin"]), ("ymin", np.minimum, boxes["ymin"]),
+                                 ("xmax", np.maximum, boxes["xmax"]), ("ymax", np.maximum, boxes["ymax"]),
+                                 ("epsgMin", np.minimum, epsgMin), ("epsgMax", np.maximum, epsgMax)):
+        nodes[name] = reduce.reduceat(values, starts)
+    nodes["first"] = starts
+    nodes["count"] = np.diff(np.append(starts, len(boxes)))
+    return nodes
+
+def packTree(entries, nodeSize=32):
+    """ Bulk loads an STR packed R-tree. Returns (entries in leaf order, nodes, levels): nodes holds all levels from
+        the root level down to the leaves, levels the offsets of the levels in nodes (plus the end). first/count of
+        a node are the range of its children in the next level (of entries for leaves). """
+    entries = entries[strOrder(entries, nodeSize)]
+    levels = []
+    boxes = entries
+    while True:
+        nodes = packLevel(boxes, nodeSize)
+        levels.append(nodes)
+        if len(nodes) <= nodeSize:
+            break
+        order = strOrder(nodes, nodeSize)
+        nodes = nodes[order]
+        levels[-1] = nodes
+        boxes = nodes
+    if len(levels[-1]) > 1:
+        levels.append(packLevel(levels[-1], len(levels[-1])))
+    levels.reverse()
+    offsets = np.cumsum([0] + [len(level) for level in levels])
+    return (entries, np.concatenate(levels), offsets)
+
+class CloudIndex(object):
+    """ Persistent spatial index of the cloud mask polygons (OPAQUE, CIRRUS) and footprints (tileDataGeometry of
+        tileInfo.json) of tiles, to find the least cloudy acquisitions of an area without touching the geodatabase.
+        Tiles are added in memory (see addTile, or pass the index to SentinelImporter.addTiles which adds every tile
+        it adds from the records it parsed anyway) and written as segments of flushSize tiles. Every segment is an
+        STR packed R-tree over the bounding boxes of its entries (files folder/<segment>.entries.npy and .nodes.npy,
+        memory mapped when opened) and a table of its acquisitions (<segment>.acquisitions.npz: path, tile,
+        sensingTime). Segments are merged into one once there are more than maxSegments of them.
+        Coordinates are those of the tiles (UTM), every query is in one coordinate system (epsg). A tile added again
+        replaces its previous entries. """
+
+    def __init__(self, folder, flushSize=1000, maxSegments=8, nodeSize=32):
+        self.folder = folder
+        self.flushSize = flushSize
+        self.maxSegments = maxSegments
+        self.nodeSize = nodeSize
+        self.manifestPath = os.path.join(folder, "segments.json")
+        self.pendingEntries = []
+        self.pendingAcquisitions = []
+        os.makedirs(folder, exist_ok=True)
+        manifest = {"segments": [], "next": 1}
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath, "r") as f:
+                manifest = json.load(f)
+        self.next = manifest["next"]
+        self.segments = [self.openSegment(segment) for segment in manifest["segments"]]
+        self.markReplaced()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.flush()
+
+    def segmentPath(self, name, part):
+        return os.path.join(self.folder, "{0}.{1}".format(name, part))
+
+    def openSegment(self, segment):
+        with np.load(self.segmentPath(segment["name"], "acquisitions.npz")) as data:
+            acquisitions = {name: data[name] for name in ("path", "tile", "sensingTime")}
+        return {"name": segment["name"], "levels": segment["levels"], "acquisitions": acquisitions,
+                "alive": np.ones(len(acquisitions["path"]), dtype=bool),
+                "entries": np.load(self.segmentPath(segment["name"], "entries.npy"), mmap_mode="r"),
+                "nodes": np.load(self.segmentPath(segment["name"], "nodes.npy"), mmap_mode="r")}
+
+    def markReplaced(self):
+        """ Only the last acquisition of a path is alive """
+        latest = {}
+        for s, segment in enumerate(self.segments):
+            segment["alive"][:] = True
+            for i, path in enumerate(segment["acquisitions"]["path"]):
+                if path in latest:
+                    self.segments[latest[path][0]]["alive"][latest[path][1]] = False
+                latest[path] = (s, i)
+
+    def saveManifest(self):
+        temp = self.manifestPath + ".tmp"
+        with open(temp, "w") as f:
+            json.dump({"segments": [{"name": s["name"], "levels": s["levels"]} for s in self.segments], "next": self.next}, f)
+        os.replace(temp, self.manifestPath)
+
+    def addTile(self, tileMetadataPath, preparedTile=None, maskRecords=None):
+        """ Adds the footprint and the cloud mask polygons of a tile. tileInfo.json and the mask records are taken
+            from preparedTile (see prepareTile) or maskRecords (of CloudMask.iterMaskRecords) if given. """
+        folder = os.path.dirname(tileMetadataPath)
+        if preparedTile:
+            tileInfo = preparedTile["tileInfo"]
+            maskRecords = maskRecords if maskRecords is not None else preparedTile["maskRecords"]
+        else:
+            with open(os.path.join(folder, "tileInfo.json"), "r") as f:
+                tileInfo = json.load(f)
+        if maskRecords is None:
+            maskRecords = CloudMask.iterMaskRecords(os.path.join(folder, "qi", "MSK_CLOUDS_B00.gml"))
+
+        acquisition = len(self.pendingAcquisitions)
+        geometry = tileInfo["tileDataGeometry"]
+        epsg = int(geometry["crs"]["properties"]["name"].split(":")[-1])
+        sensingTime = None
+        for fid, ftype, tile, ts, wkid, coords in maskRecords:
+            if ftype not in kinds[1:]:
+                continue
+            x, y = coords[0::2], coords[1::2]
+            self.pendingEntries.append((min(x), min(y), max(x), max(y), wkid, acquisition, kinds.index(ftype), ringArea(coords)))
+            sensingTime = ts
+        coords = np.array(geometry["coordinates"][0], dtype=np.float64)
+        self.pendingEntries.append((coords[:, 0].min(), coords[:, 1].min(), coords[:, 0].max(), coords[:, 1].max(),
+                                    epsg, acquisition, 0, ringArea(coords.ravel())))
+        if sensingTime is None:
+            sensingTime = datetime.datetime.strptime(tileInfo["timestamp"][:19], "%Y-%m-%dT%H:%M:%S")
+        tileName = "T{0}{1}{2}".format(tileInfo.get("utmZone", ""), tileInfo.get("latitudeBand", ""), tileInfo.get("gridSquare", ""))
+        self.pendingAcquisitions.append((IngestManifest.key(tileMetadataPath), tileName, np.datetime64(sensingTime, "ms")))
+        if len(self.pendingAcquisitions) >= self.flushSize:
+            self.flush()
+
+    def update(self, tilesFolder, threads=None):
+        """ Adds every tile under tilesFolder """
+        for tile in SentinelImporter.iterTiles(tilesFolder, threads):
+            try:
+                self.addTile(tile)
+            except Exception as e:
+                print("Exception while indexing {0}\n{1}".format(tile, e))
+        self.flush()
+        return self
+
+    def flush(self):
+        """ Writes the tiles added since the last flush as a new segment """
+        if not self.pendingAcquisitions:
+            return
+        entries = np.array(self.pendingEntries, dtype=entryType)
+        path, tile, sensingTime = zip(*self.pendingAcquisitions)
+        self.writeSegment(entries, {"path": np.array(path), "tile": np.array(tile),
+                                    "sensingTime": np.array(sensingTime, dtype="datetime64[ms]")})
+        self.pendingEntries = []
+        self.pendingAcquisitions = []
+        if len(self.segments) > self.maxSegments:
+            self.compact()
+
+    def writeSegment(self, entries, acquisitions):
+        name = "{0:06d}".format(self.next)
+        self.next += 1
+        entries, nodes, levels = packTree(entries, self.nodeSize)
+        for part, save in (("entries.npy", lambda f: np.save(f, entries)), ("nodes.npy", lambda f: np.save(f, nodes)),
+                           ("acquisitions.npz", lambda f: np.savez(f, **acquisitions))):
+            temp = self.segmentPath(name, part + ".tmp")
+            with open(temp, "wb") as f:
+                save(f)
+            os.replace(temp, self.segmentPath(name, part))
+        self.segments.append(self.openSegment({"name": name, "levels": [int(level) for level in levels]}))
+        self.markReplaced()
+        self.saveManifest()
+
+    def compact(self):
+        """ Merges all segments into one, without the replaced acquisitions """
+        self.flush()
+        if len(self.segments) < 2:
+            return
+        entries = []
+        acquisitions = {"path": [], "tile": [], "sensingTime": []}
+        for segment in self.segments:
+            alive = np.flatnonzero(segment["alive"])
+            renumber = np.full(len(segment["alive"]), -1, dtype=np.int64)
+            renumber[alive] = np.arange(len(alive)) + sum(len(paths) for paths in acquisitions["path"])
+            for name in acquisitions:
+                acquisitions[name].append(segment["acquisitions"][name][alive])
+            kept = np.array(segment["entries"][segment["alive"][segment["entries"]["acquisition"]]])
+            kept["acquisition"] = renumber[kept["acquisition"]]
+            entries.append(kept)
+        old = self.segments
+        self.segments = []
+        self.writeSegment(np.concatenate(entries), dict((name, np.concatenate(values)) for name, values in acquisitions.items()))
+        for segment in old:
+            for part in ("entries.npy", "nodes.npy", "acquisitions.npz"):
+                try:
+                    os.remove(self.segmentPath(segment["name"], part))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def search(segment, bbox, epsg, alive=None):
+        """ Indices of the entries of a segment whose boxes intersect bbox, level by level over all candidate nodes.
+            Only the entries of alive acquisitions (by default those of segment["alive"]) are returned. """
+        alive = segment["alive"] if alive is None else alive
+        nodes, levels = segment["nodes"], segment["levels"]
+        candidates = np.arange(levels[0], levels[1])
+        for level in range(len(levels) - 1):
+            node = nodes[candidates]
+            hit = ((node["xmin"] <= bbox[2]) & (node["xmax"] >= bbox[0]) & (node["ymin"] <= bbox[3]) & (node["ymax"] >= bbox[1]) &
+                   (node["epsgMin"] <= epsg) & (node["epsgMax"] >= epsg))
+            first, count = node["first"][hit], node["count"][hit].astype(np.int64)
+            if not len(count):
+                return np.array([], dtype=np.int64)
+            # the children of all hit nodes, as indices in the next level (or in the entries after the leaves)
+            candidates = np.repeat(first - (np.cumsum(count) - count), count) + np.arange(count.sum())
+            if level + 2 < len(levels):
+                candidates += levels[level + 1]
+        entries = segment["entries"][candidates]
+        hit = ((entries["xmin"] <= bbox[2]) & (entries["xmax"] >= bbox[0]) & (entries["ymin"] <= bbox[3]) &
+               (entries["ymax"] >= bbox[1]) & (entries["epsg"] == epsg) & alive[entries["acquisition"]])
+        return candidates[hit]
+
+    def query(self, bbox, epsg, start=None, end=None, tiles=None, maxCloudArea=None, maxCloudFraction=None, types=("OPAQUE", "CIRRUS")):
+        """ The acquisitions whose footprint intersects bbox (xmin, ymin, xmax, ymax in the coordinate system epsg)
+            as dicts sorted by sensingTime: path, tile, sensingTime, coverArea (of bbox covered by the footprint),
+            cloudArea (of the polygons of types in bbox), cloudFraction, and the cloud area of every type.
+            The areas are estimates from the bounding boxes: a polygon (or footprint) partly in bbox counts with its
+            area times the share of its bounding box in bbox. maxCloudArea (in square units of epsg) and
+            maxCloudFraction leave out cloudier acquisitions. """
+        results = []
+        typeCodes = [kinds.index(name) for name in types]
+        segments = [(segment, segment["alive"]) for segment in self.segments]
+        if self.pendingAcquisitions:
+            # the acquisitions replaced by pending tiles are left out of this query only, flush marks them for good
+            pending = self.pendingSegment()
+            replaced = list(pending["acquisitions"]["path"])
+            segments = [(segment, alive & ~np.isin(segment["acquisitions"]["path"], replaced)) for segment, alive in segments]
+            segments.append((pending, pending["alive"]))
+        for segment, alive in segments:
+            entries = segment["entries"][self.search(segment, bbox, epsg, alive)]
+            if not len(entries):
+                continue
+            width = np.clip(np.minimum(entries["xmax"], bbox[2]) - np.maximum(entries["xmin"], bbox[0]), 0, None)
+            height = np.clip(np.minimum(entries["ymax"], bbox[3]) - np.maximum(entries["ymin"], bbox[1]), 0, None)
+            boxArea = (entries["xmax"] - entries["xmin"])*(entries["ymax"] - entries["ymin"])
+            share = np.where(boxArea > 0, width*height/np.where(boxArea > 0, boxArea, 1), 1.0)
+            area = entries["area"]*share
+            acquisitions = segment["acquisitions"]
+            count = len(acquisitions["path"])
+            footprints = entries["kind"] == 0
+            cover = np.bincount(entries["acquisition"][footprints], area[footprints], minlength=count)
+            typeAreas = dict((kinds[code], np.bincount(entries["acquisition"][entries["kind"] == code],
+                                                       area[entries["kind"] == code], minlength=count)) for code in typeCodes)
+            selected = np.zeros(count, dtype=bool)
+            selected[entries["acquisition"][footprints]] = True
+            if start is not None:
+                selected &= acquisitions["sensingTime"] >= np.datetime64(start, "ms")
+            if end is not None:
+                selected &= acquisitions["sensingTime"] <= np.datetime64(end, "ms")
+            if tiles is not None:
+                selected &= np.isin(acquisitions["tile"], list(tiles))
+            for i in np.flatnonzero(selected):
+                cloudArea = sum(float(typeAreas[name][i]) for name in types)
+                result = {"path": str(acquisitions["path"][i]), "tile": str(acquisitions["tile"][i]),
+                          "sensingTime": acquisitions["sensingTime"][i], "coverArea": float(cover[i]), "cloudArea": cloudArea,
+                          "cloudFraction": min(1.0, cloudArea/float(cover[i])) if cover[i] else 0.0}
+                for name in types:
+                    result[name] = float(typeAreas[name][i])
+                if maxCloudArea is not None and result["cloudArea"] > maxCloudArea:
+                    continue
+                if maxCloudFraction is not None and result["cloudFraction"] > maxCloudFraction:
+                    continue
+                results.append(result)
+        results.sort(key=lambda result: result["sensingTime"])
+        return results
+
+    def leastCloudy(self, bbox, epsg, count=1, minCover=0.0, **filters):
+        """ The count acquisitions of query with the smallest cloud fraction, of those covering at least minCover
+            (a fraction) of bbox """
+        area = (bbox[2] - bbox[0])*(bbox[3] - bbox[1])
+        results = [r for r in self.query(bbox, epsg, **filters) if r["coverArea"] >= minCover*area]
+        return sorted(results, key=lambda result: (result["cloudFraction"], result["sensingTime"]))[:count]
+
+    def pendingSegment(self):
+        """ The tiles not flushed yet, as an unpacked segment with a single node """
+        entries = np.array(self.pendingEntries, dtype=entryType)
+        path, tile, sensingTime = zip(*self.pendingAcquisitions)
+        latest = dict((p, i) for i, p in enumerate(path))
+        alive = np.array([latest[p] == i for i, p in enumerate(path)], dtype=bool)
+        return {"entries": entries, "nodes": packLevel(entries, max(1, len(entries))), "levels": [0, 1], "alive": alive,
+                "acquisitions": {"path": np.array(path), "tile": np.array(tile), "sensingTime": np.array(sensingTime, dtype="datetime64[ms]")}}
@@ -0,0 +1,256 @@
+import os
+import numpy as np
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+from SentinelImporter import CloudMask, SentinelImporter, isInFolder
+
+maskTypes = ("OPAQUE", "CIRRUS")
+
+def readGeocoding(tileMetadataPath, resolution=20):
+    """ Reads (epsg, ulx, uly, cellSize, nrows, ncols) of the grid of resolution (10, 20 or 60) from Tile_Geocoding of
+        a metadata.xml, the reading stops at the end of Tile_Geocoding. """
+    resolution = str(resolution)
+    values = {}
+    for event, elem in ET.iterparse(tileMetadataPath, events=("end",)):
+        tag = elem.tag.split("}")[-1]
+        if tag == "HORIZONTAL_CS_CODE":
+            values["epsg"] = int(elem.text.split(":")[-1])
+        elif tag == "Size" and elem.get("resolution") == resolution:
+            values["nrows"] = int(elem.find("NROWS").text)
+            values["ncols"] = int(elem.find("NCOLS").text)
+        elif tag == "Geoposition" and elem.get("resolution") == resolution:
+            values["ulx"] = float(elem.find("ULX").text)
+            values["uly"] = float(elem.find("ULY").text)
+        elif tag == "Tile_Geocoding":
+            break
+    if len(values) != 5:
+        raise ValueError("No geocoding of resolution {0} in {1}".format(resolution, tileMetadataPath))
+    return (values["epsg"], values["ulx"], values["uly"], float(resolution), values["nrows"], values["ncols"])
+
+def rasterizeRings(rings, ulx, uly, cellSize, nrows, ncols, blockRows=512):
+    """ Burns the union of the polygons (exterior rings as flat x, y arrays in map coordinates, e.g. the coords of
+        CloudMask.iterMaskRecords) into a grid with upper left corner ulx, uly. A pixel is inside when its center is
+        (even-odd rule per ring). All edges are intersected with the pixel center rows at once, the spans between
+        pairs of crossings are filled block by block of blockRows rows through a cumulative sum.
+        Returns the mask bit-packed along the rows, an uint8 array of shape (nrows, ceil(ncols/8)). """
+    packed = np.zeros((nrows, (ncols + 7)//8), dtype=np.uint8)
+    if not rings:
+        return packed
+    xs, ys, ids = [], [], []
+    for i, coords in enumerate(rings):
+        ring = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        if len(ring) < 3:
+            continue
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack([ring, ring[:1]])
+        xs.append((ring[:, 0] - ulx)/cellSize)
+        ys.append((uly - ring[:, 1])/cellSize)
+        ids.append(np.full(len(ring) - 1, i, dtype=np.int64))
+    if not ids:
+        return packed
+    # edges of all rings, in pixel coordinates (rows down)
+    x0 = np.concatenate([x[:-1] for x in xs])
+    x1 = np.concatenate([x[1:] for x in xs])
+    y0 = np.concatenate([y[:-1] for y in ys])
+    y1 = np.concatenate([y[1:] for y in ys])
+    ring = np.concatenate(ids)
+    # rows r whose center r + 0.5 is in [min(y0, y1), max(y0, y1)), horizontal edges cross none
+    first = np.clip(np.ceil(np.minimum(y0, y1) - 0.5), 0, nrows).astype(np.int64)
+    last = np.clip(np.ceil(np.maximum(y0, y1) - 0.5), 0, nrows).astype(np.int64)
+    counts = last - first
+    crossing = counts > 0
+    if not crossing.any():
+        return packed
+    x0, x1, y0, y1, ring, first, counts = (a[crossing] for a in (x0, x1, y0, y1, ring, first, counts))
+    edge = np.repeat(np.arange(len(counts)), counts)
+    rows = first[edge] + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    x = x0[edge] + (rows + 0.5 - y0[edge])*(x1[edge] - x0[edge])/(y1[edge] - y0[edge])
+    order = np.lexsort((x, rows, ring[edge]))
+    rows = rows[order][0::2]
+    # columns c whose center c + 0.5 is in [start, end)
+    start = np.clip(np.ceil(x[order][0::2] - 0.5), 0, ncols).astype(np.int64)
+    end = np.clip(np.ceil(x[order][1::2] - 0.5), 0, ncols).astype(np.int64)
+    spans = end > start
+    rows, start, end = rows[spans], start[spans], end[spans]
+    order = np.argsort(rows, kind="mergesort")
+    rows, start, end = rows[order], start[order], end[order]
+    if not len(rows):
+        return packed
+    # only the columns between the spans, starting on a byte
+    left = int(start.min())//8*8
+    width = int(end.max()) - left
+    bounds = np.searchsorted(rows, np.arange(rows[0], rows[-1] + blockRows + 1, blockRows))
+    for i, j in zip(bounds[:-1], bounds[1:]):
+        if i == j:
+            continue
+        top = int(rows[i])
+        height = int(rows[j - 1]) - top + 1
+        diff = np.zeros((height, width + 1), dtype=np.int16)
+        np.add.at(diff, (rows[i:j] - top, start[i:j] - left), 1)
+        np.add.at(diff, (rows[i:j] - top, end[i:j] - left), -1)
+        bits = np.packbits(np.cumsum(diff[:, :width], axis=1, dtype=np.int16) > 0, axis=1)
+        packed[top:top + height, left//8:left//8 + bits.shape[1]] = bits
+    return packed
+
+def rasterizeMask(maskGmlFile, ulx, uly, cellSize, nrows, ncols):
+    """ Rasterizes the polygons of a MSK_CLOUDS_B00.gml by type. Returns (layers, tile, timestamp), layers is an uint8
+        array of shape (len(maskTypes), nrows, ceil(ncols/8)) with the bit-packed mask of every type of maskTypes. """
+    rings = dict((name, []) for name in maskTypes)
+    tile = timestamp = None
+    for fid, ftype, tile, timestamp, wkid, coords in CloudMask.iterMaskRecords(maskGmlFile):
+        if ftype in rings:
+            rings[ftype].append(coords)
+    layers = np.stack([rasterizeRings(rings[name], ulx, uly, cellSize, nrows, ncols) for name in maskTypes])
+    return (layers, tile, timestamp)
+
+class CloudRasterStore(object):
+    """ Cloud masks of many tiles rasterized on their 20m (or 60m) grid, to get cloud fractions of an area without a
+        geoprocessing overlay. Every tile is a .npy file of bit-packed layers (see rasterizeMask), read memory mapped,
+        and a row of the index (index.npz in folder) with
+            path, size, mtime       - of MSK_CLOUDS_B00.gml, used to update the store incrementally
+            raster                  - name of the .npy file in folder
+            tile, sensingTime       - from the gml:id of the mask
+            epsg, ulx, uly          - coordinate system and upper left corner of the grid
+            cellSize, nrows, ncols  - of the grid
+    """
+    columns = {"path": "U", "size": np.int64, "mtime": np.float64, "raster": "U", "tile": "U", "sensingTime": "datetime64[ms]",
+               "epsg": np.int32, "ulx": np.float64, "uly": np.float64, "cellSize": np.float64, "nrows": np.int32, "ncols": np.int32}
+
+    def __init__(self, folder, resolution=20):
+        self.folder = folder
+        self.resolution = resolution
+        self.indexPath = os.path.join(folder, "index.npz")
+        if os.path.exists(self.indexPath):
+            with np.load(self.indexPath) as data:
+                self.data = {name: data[name] for name in self.columns}
+        else:
+            self.data = {name: np.array([], dtype=dtype) for name, dtype in self.columns.items()}
+
+    def __len__(self):
+        return len(self.data["path"])
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    def save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        temp = self.indexPath + ".tmp"
+        with open(temp, "wb") as f:
+            np.savez(f, **self.data)
+        os.replace(temp, self.indexPath)
+
+    def rasterizeTile(self, tileMetadataPath, st=None):
+        """ Rasterizes the cloud mask of a tile into folder, returns its index row """
+        maskGmlFile = os.path.join(os.path.dirname(tileMetadataPath), "qi", "MSK_CLOUDS_B00.gml")
+        st = st or os.stat(maskGmlFile)
+        epsg, ulx, uly, cellSize, nrows, ncols = readGeocoding(tileMetadataPath, self.resolution)
+        layers, tile, timestamp = rasterizeMask(maskGmlFile, ulx, uly, cellSize, nrows, ncols)
+        name = "{0}_{1:%Y%m%dT%H%M%S}_{2}m.npy".format(tile, timestamp, self.resolution)
+        temp = os.path.join(self.folder, name + ".tmp")
+        with open(temp, "wb") as f:
+            np.save(f, layers)
+        os.replace(temp, os.path.join(self.folder, name))
+        return {"path": maskGmlFile, "size": st.st_size, "mtime": st.st_mtime, "raster": name, "tile": tile,
+                "sensingTime": np.datetime64(timestamp, "ms"), "epsg": epsg, "ulx": ulx, "uly": uly,
+                "cellSize": cellSize, "nrows": nrows, "ncols": ncols}
+
+    def update(self, tilesFolder, threads=None):
+        """ Rasterizes the masks of the new and changed tiles under tilesFolder, drops the rows of tiles which are gone.
+            Unchanged masks (same size and mtime) are not read again. """
+        os.makedirs(self.folder, exist_ok=True)
+        known = {path: i for i, path in enumerate(self.data["path"])}
+        keep = np.zeros(len(self), dtype=bool)
+        keep[[i for path, i in known.items() if not isInFolder(path, tilesFolder)]] = True
+
+        records = []
+        for tile in SentinelImporter.iterTiles(tilesFolder, threads):
+            maskGmlFile = os.path.join(os.path.dirname(tile), "qi", "MSK_CLOUDS_B00.gml")
+            try:
+                st = os.stat(maskGmlFile)
+                i = known.get(maskGmlFile)
+                if i is not None and self.data["size"][i] == st.st_size and self.data["mtime"][i] == st.st_mtime:
+                    keep[i] = True
+                    continue
+                records.append(self.rasterizeTile(tile, st))
+            except Exception as e:
+                print("Exception while rasterizing the cloud mask of {0}\n{1}".format(tile, e))
+
+        files = set(r["raster"] for r in records)
+        for name in self.data["raster"][~keep]:
+            if name not in files and os.path.exists(os.path.join(self.folder, name)):
+                os.remove(os.path.join(self.folder, name))
+        for name, dtype in self.columns.items():
+            added = np.array([r[name] for r in records], dtype=dtype)
+            self.data[name] = np.concatenate([self.data[name][keep], added]) if len(added) else self.data[name][keep]
+        print("Cloud rasters updated, {0} masks rasterized, {1} tiles in store.".format(len(records), len(self)))
+        return self
+
+    def layers(self, i):
+        """ The bit-packed layers of row i, memory mapped """
+        return np.load(os.path.join(self.folder, self.data["raster"][i]), mmap_mode="r")
+
+    def window(self, i, bbox):
+        """ (row, col) ranges of the pixels of row i whose centers are in bbox, None if there are none """
+        ulx, uly, cellSize = self.data["ulx"][i], self.data["uly"][i], self.data["cellSize"][i]
+        c0 = max(0, int(np.ceil((bbox[0] - ulx)/cellSize - 0.5)))
+        c1 = min(int(self.data["ncols"][i]), int(np.ceil((bbox[2] - ulx)/cellSize - 0.5)))
+        r0 = max(0, int(np.ceil((uly - bbox[3])/cellSize - 0.5)))
+        r1 = min(int(self.data["nrows"][i]), int(np.ceil((uly - bbox[1])/cellSize - 0.5)))
+        return ((r0, r1), (c0, c1)) if r1 > r0 and c1 > c0 else None
+
+    def countCloudy(self, i, bbox, types=maskTypes):
+        """ Returns (pixels in bbox, cloudy pixels of every type, cloudy pixels of any of types) of row i """
+        window = self.window(i, bbox)
+        if window is None:
+            return (0, dict((name, 0) for name in types), 0)
+        (r0, r1), (c0, c1) = window
+        layers = self.layers(i)[:, r0:r1, c0//8:(c1 + 7)//8]
+        shift = c0 - c0//8*8
+        counts = {}
+        union = None
+        for name in types:
+            bits = np.unpackbits(layers[maskTypes.index(name)], axis=1)[:, shift:shift + c1 - c0]
+            counts[name] = int(np.count_nonzero(bits))
+            union = bits if union is None else union | bits
+        return ((r1 - r0)*(c1 - c0), counts, int(np.count_nonzero(union)) if union is not None else 0)
+
+    def cloudFraction(self, bbox, epsg, start=None, end=None, tiles=None, types=maskTypes):
+        """ Cloud fraction of bbox (xmin, ymin, xmax, ymax in the coordinate system epsg, tiles in other coordinate
+            systems are left out) for every sensing date between start and end. The pixels of all tiles of a date are
+            added up. Returns a list of dicts sorted by date:
+                date, tiles, pixels, cloudy, fraction (cloudy by any of types), and the fraction of every type. """
+        mask = self.data["epsg"] == epsg
+        if start is not None:
+            mask &= self.data["sensingTime"] >= np.datetime64(start, "ms")
+        if end is not None:
+            mask &= self.data["sensingTime"] <= np.datetime64(end, "ms")
+        if tiles is not None:
+            mask &= np.isin(self.data["tile"], list(tiles))
+        # bounding boxes of the grids
+        xmax = self.data["ulx"] + self.data["ncols"]*self.data["cellSize"]
+        ymin = self.data["uly"] - self.data["nrows"]*self.data["cellSize"]
+        mask &= (self.data["ulx"] < bbox[2]) & (xmax > bbox[0]) & (ymin < bbox[3]) & (self.data["uly"] > bbox[1])
+
+        dates = {}
+        for i in np.flatnonzero(mask):
+            pixels, counts, cloudy = self.countCloudy(i, bbox, types)
+            if not pixels:
+                continue
+            date = self.data["sensingTime"][i].astype("datetime64[D]")
+            result = dates.setdefault(date, dict([("date", date), ("tiles", []), ("pixels", 0), ("cloudy", 0)] + [(name, 0) for name in types]))
+            result["tiles"].append(str(self.data["tile"][i]))
+            result["pixels"] += pixels
+            result["cloudy"] += cloudy
+            for name in types:
+                result[name] += counts[name]
+        results = []
+        for date in sorted(dates):
+            result = dates[date]
+            for name in types:
+                result[name] = result[name]/result["pixels"]
+            result["fraction"] = result["cloudy"]/result["pixels"]
+            results.append(result)
+        return results
@@ -0,0 +1,213 @@
+from array import array
+from collections import OrderedDict
+import numpy as np
+
+from CloudRaster import rasterizeRings
+
+def traceOutlines(mask, ulx, uly, cellSize):
+    """ Outlines of the True pixels of mask (a 2D bool array with upper left corner ulx, uly) as rings along the pixel
+        edges, with a corner only where the direction changes. The pixels of a ring are on its right, so exteriors
+        are clockwise and holes counter-clockwise. Pixels touching at a corner only are in different rings.
+        Returns a list of (ring, pixel), ring is a closed (n, 2) array of map coordinates, pixel the map coordinates
+        of the center of a pixel on the right of the first edge. """
+    m = np.pad(np.asarray(mask, dtype=bool), 1, mode="constant")
+    width = m.shape[1] + 1
+    # edges between vertically (and horizontally) adjacent pixels, directions 0 east, 1 south, 2 west, 3 north
+    r, c = np.nonzero(m[1:, :] != m[:-1, :])
+    below = m[r + 1, c]
+    r0, c0, r2, c2 = r[below] + 1, c[below], r[~below] + 1, c[~below]
+    r, c = np.nonzero(m[:, :-1] != m[:, 1:])
+    left = m[r, c]
+    r1, c1, r3, c3 = r[left], c[left] + 1, r[~left], c[~left] + 1
+    start = np.concatenate([r0*width + c0, r1*width + c1, r2*width + c2 + 1, (r3 + 1)*width + c3])
+    end = np.concatenate([r0*width + c0 + 1, (r1 + 1)*width + c1, r2*width + c2, r3*width + c3])
+    direction = np.concatenate([np.full(len(r0), 0), np.full(len(r1), 1), np.full(len(r2), 2), np.full(len(r3), 3)])
+    if not len(start):
+        return []
+    # the next edge starts where an edge ends, at a vertex with two of them (pixels touching at a corner) turn right
+    order = np.argsort(start, kind="mergesort")
+    sortedStart = start[order]
+    first = np.searchsorted(sortedStart, end, "left")
+    count = np.searchsorted(sortedStart, end, "right") - first
+    other = order[np.minimum(first + 1, len(order) - 1)]
+    following = np.where((count == 2) & (direction[other] == (direction + 1) % 4), other, order[first])
+    previous = np.empty_like(following)
+    previous[following] = np.arange(len(following))
+    corner = (direction[previous] != direction).tolist()
+    following = following.tolist()
+    starts = start.tolist()
+
+    rings = []
+    visited = bytearray(len(following))
+    for e in range(len(following)):
+        if visited[e] or not corner[e]:
+            continue
+        vertices = []
+        i = e
+        while not visited[i]:
+            visited[i] = 1
+            if corner[i]:
+                vertices.append(starts[i])
+            i = following[i]
+        vertices.append(vertices[0])
+        vertices = np.array(vertices)
+        ring = np.column_stack([ulx + (vertices % width - 1)*cellSize, uly - (vertices//width - 1)*cellSize])
+        # the pixel on the right of the first edge
+        r, c = vertices[0]//width, vertices[0] % width
+        pr, pc = ((r, c), (r, c - 1), (r - 1, c - 1), (r - 1, c))[direction[e]]
+        rings.append((ring, (ulx + (pc - 0.5)*cellSize, uly - (pr - 0.5)*cellSize)))
+    return rings
+
+def signedArea(ring):
+    """ Shoelace area of a closed (n, 2) ring, negative for clockwise rings """
+    x, y = ring[:-1, 0], ring[:-1, 1]
+    return (np.dot(x, ring[1:, 1]) - np.dot(y, ring[1:, 0]))/2.0
+
+def contains(ring, x, y):
+    """ Even-odd test of a point against a closed (n, 2) ring """
+    x0, y0, x1, y1 = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+    crossing = (y0 > y) != (y1 > y)
+    xs = x0[crossing] + (y - y0[crossing])*(x1[crossing] - x0[crossing])/(y1[crossing] - y0[crossing])
+    return bool(np.count_nonzero(xs > x) % 2)
+
+def groupArgmax(values, groupStarts):
+    """ Maximum and index of the (first) maximum of every group of consecutive values """
+    maxima = np.maximum.reduceat(values, groupStarts)
+    group = np.repeat(np.arange(len(groupStarts)), np.diff(np.append(groupStarts, len(values))))
+    candidates = np.flatnonzero(values == maxima[group])
+    _, firsts = np.unique(group[candidates], return_index=True)
+    return (maxima, candidates[firsts])
+
+def simplifyRings(rings, tolerance):
+    """ Douglas-Peucker simplification of closed (n, 2) rings, all rings at once: every iteration splits all the
+        segments which still have a vertex farther than tolerance at their farthest vertex. A ring is split first
+        at the vertex farthest from its first one. Rings collapsing to fewer than three corners are returned as given. """
+    if not rings:
+        return []
+    sizes = np.array([len(ring) for ring in rings])
+    offsets = np.cumsum(sizes) - sizes
+    points = np.concatenate(rings).astype(np.float64)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[offsets] = True
+    keep[offsets + sizes - 1] = True
+
+    ringOf = np.repeat(np.arange(len(rings)), sizes)
+    distances = np.hypot(*(points - points[offsets][ringOf]).T)
+    _, farthest = groupArgmax(distances, offsets)
+    keep[farthest] = True
+    starts = np.concatenate([offsets, farthest])
+    ends = np.concatenate([farthest, offsets + sizes - 1])
+    while len(starts):
+        lengths = ends - starts - 1
+        inner = lengths > 0
+        starts, ends, lengths = starts[inner], ends[inner], lengths[inner]
+        if not len(starts):
+            break
+        groupStarts = np.cumsum(lengths) - lengths
+        segment = np.repeat(np.arange(len(starts)), lengths)
+        index = starts[segment] + 1 + np.arange(lengths.sum()) - groupStarts[segment]
+        a, b = points[starts][segment], points[ends][segment]
+        ab, ap = b - a, points[index] - a
+        norm = np.hypot(ab[:, 0], ab[:, 1])
+        cross = np.abs(ab[:, 0]*ap[:, 1] - ab[:, 1]*ap[:, 0])
+        distances = np.where(norm > 0, cross/np.where(norm > 0, norm, 1), np.hypot(ap[:, 0], ap[:, 1]))
+        maxima, at = groupArgmax(distances, groupStarts)
+        split = maxima > tolerance
+        middle = index[at[split]]
+        keep[middle] = True
+        starts, ends = np.concatenate([starts[split], middle]), np.concatenate([middle, ends[split]])
+
+    simplified = []
+    for ring, offset, size in zip(rings, offsets, sizes):
+        kept = points[offset:offset + size][keep[offset:offset + size]]
+        simplified.append(kept if len(kept) >= 4 else np.asarray(ring, dtype=np.float64))
+    return simplified
+
+def flatRing(ring):
+    """ A (n, 2) ring as the flat array('i') of the records """
+    return array("i", np.rint(ring).astype(np.int32).ravel().tolist())
+
+class MaskSimplifier(object):
+    """ Simplifies the records of a tile's cloud mask (see CloudMask.iterMaskRecords) before they are inserted:
+        the polygons of every mask type are burnt into a grid of cellSize (20 or 60, aligned to origin), so adjacent
+        and overlapping polygons of a type merge, the outlines of the merged areas are traced along the pixel edges
+        (with their holes) and simplified by Douglas-Peucker with tolerance in map units. The vertices stay on the
+        grid. Areas smaller than a pixel (no pixel center inside) are lost, as at the resolution of the grid.
+        With merge=False every polygon is simplified on its own and its vertices snapped to the grid.
+        Merged features get new ids (type.n), their coords are a list of rings (exterior first) when they have holes.
+        stats counts the features and vertices before and after, see summary. Pass it to a CloudMaskWriter:
+            CloudMaskWriter(cloudMaskFC, simplifier=MaskSimplifier(tolerance=30)) """
+
+    def __init__(self, tolerance=30.0, cellSize=20, origin=(0, 0), merge=True):
+        self.tolerance = tolerance
+        self.cellSize = cellSize
+        self.origin = origin
+        self.merge = merge
+        self.stats = {"tiles": 0, "featuresIn": 0, "featuresOut": 0, "verticesIn": 0, "verticesOut": 0}
+
+    def apply(self, records):
+        """ Returns the simplified records of one tile """
+        types = OrderedDict()
+        for record in records:
+            types.setdefault(record[1], []).append(record)
+        result = []
+        for ftype, typeRecords in types.items():
+            result.extend(self.mergeType(ftype, typeRecords) if self.merge else self.simplifyEach(typeRecords))
+        self.stats["tiles"] += 1
+        self.stats["featuresIn"] += sum(len(typeRecords) for typeRecords in types.values())
+        self.stats["verticesIn"] += sum(len(record[5])//2 for typeRecords in types.values() for record in typeRecords)
+        self.stats["featuresOut"] += len(result)
+        self.stats["verticesOut"] += sum(sum(len(ring) for ring in record[5])//2 if isinstance(record[5], list) else len(record[5])//2
+                                         for record in result)
+        return result
+
+    def snap(self, values, axis):
+        return np.rint((values - self.origin[axis])/self.cellSize)*self.cellSize + self.origin[axis]
+
+    def simplifyEach(self, records):
+        rings = [np.frombuffer(record[5], dtype=np.int32).reshape(-1, 2).astype(np.float64) for record in records]
+        result = []
+        for record, ring in zip(records, simplifyRings(rings, self.tolerance)):
+            ring = np.column_stack([self.snap(ring[:, 0], 0), self.snap(ring[:, 1], 1)])
+            ring = ring[np.append(True, np.any(ring[1:] != ring[:-1], axis=1))]
+            if len(ring) >= 4:
+                result.append(record[:5] + (flatRing(ring),))
+        return result
+
+    def mergeType(self, ftype, records):
+        fid, ftype, tile, timestamp, wkid, coords = records[0]
+        rings = [record[5] for record in records]
+        xs = np.concatenate([np.frombuffer(ring, dtype=np.int32)[0::2] for ring in rings])
+        ys = np.concatenate([np.frombuffer(ring, dtype=np.int32)[1::2] for ring in rings])
+        # the grid around the polygons with a pixel of margin
+        ulx = np.floor((xs.min() - self.origin[0])/self.cellSize)*self.cellSize + self.origin[0] - self.cellSize
+        uly = np.ceil((ys.max() - self.origin[1])/self.cellSize)*self.cellSize + self.origin[1] + self.cellSize
+        ncols = int(np.ceil((xs.max() - ulx)/self.cellSize)) + 1
+        nrows = int(np.ceil((uly - ys.min())/self.cellSize)) + 1
+        mask = np.unpackbits(rasterizeRings(rings, ulx, uly, self.cellSize, nrows, ncols), axis=1)[:, :ncols].astype(bool)
+        traced = traceOutlines(mask, ulx, uly, self.cellSize)
+        simplified = simplifyRings([ring for ring, pixel in traced], self.tolerance)
+
+        exteriors, holes = [], []
+        for (ring, pixel), simple in zip(traced, simplified):
+            (holes if signedArea(ring) > 0 else exteriors).append((ring, pixel, simple))
+        polygons = [[simple] for ring, pixel, simple in exteriors]
+        areas = [-signedArea(exterior) for exterior, pixel, simple in exteriors]
+        for ring, pixel, simple in holes:
+            # the pixel right of a hole's edge is in the area around the hole, the smallest exterior containing it
+            around = [i for i, (exterior, p, s) in enumerate(exteriors)
+                      if exterior[:, 0].min() < pixel[0] < exterior[:, 0].max() and exterior[:, 1].min() < pixel[1] < exterior[:, 1].max()
+                      and contains(exterior, pixel[0], pixel[1])]
+            if around:
+                polygons[min(around, key=areas.__getitem__)].append(simple)
+        result = []
+        for n, polygon in enumerate(polygons):
+            coords = [flatRing(ring) for ring in polygon]
+            result.append(("{0}.{1}".format(ftype, n), ftype, tile, timestamp, wkid, coords if len(coords) > 1 else coords[0]))
+        return result
+
+    def summary(self):
+        stats = self.stats
+        return "Cloud masks of {0} tiles simplified: {1} -> {2} features, {3} -> {4} vertices ({5:.1f}x fewer)".format(
+                stats["tiles"], stats["featuresIn"], stats["featuresOut"], stats["verticesIn"], stats["verticesOut"],
+                stats["verticesIn"]/float(stats["verticesOut"]) if stats["verticesOut"] else 0.0)
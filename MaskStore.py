@@ -0,0 +1,233 @@
+import arcpy
+import datetime
+import json
+import os
+import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+from SentinelImporter import CloudMask, CloudMaskWriter, SentinelImporter, isInFolder
+from UtmTransform import spatialReference
+
+magic = b"S2MASK01"
+alignment = 64
+columns = ("coords", "ringOffsets", "featureOffsets", "id", "type", "tile", "timestamp", "wkid")
+
+def writeMaskFile(path, records):
+    """ Writes the records of CloudMask.iterMaskRecords as one mask file: a magic, the length of a JSON header
+        describing the arrays (dtype, shape, offset) and the arrays themselves, each starting on a 64 byte boundary:
+            coords          int32 x, y pairs of all rings
+            ringOffsets     int64 index of the first pair of every ring in coords (plus the end)
+            featureOffsets  int64 index of the first ring of every feature in ringOffsets (plus the end)
+            id, type, tile  S20 attributes of every feature
+            timestamp       datetime64[s] of every feature
+            wkid            int32 coordinate system of every feature
+        Returns the number of features and vertices. """
+    coords, ringOffsets, featureOffsets, ids, types, tiles, timestamps, wkids = [], [0], [0], [], [], [], [], []
+    for fid, ftype, tile, ts, wkid, rings in records:
+        # a list of rings for the merged polygons with holes of MaskSimplifier
+        for ring in rings if isinstance(rings, list) else [rings]:
+            coords.append(np.frombuffer(ring, dtype=np.int32) if len(ring) else np.empty(0, dtype=np.int32))
+            ringOffsets.append(ringOffsets[-1] + len(ring)//2)
+        featureOffsets.append(len(ringOffsets) - 1)
+        ids.append(fid)
+        types.append(ftype)
+        tiles.append(tile)
+        timestamps.append(ts)
+        wkids.append(wkid)
+    arrays = {"coords": np.concatenate(coords) if coords else np.empty(0, dtype=np.int32),
+              "ringOffsets": np.array(ringOffsets, dtype=np.int64),
+              "featureOffsets": np.array(featureOffsets, dtype=np.int64),
+              "id": np.array(ids, dtype="S20"), "type": np.array(types, dtype="S20"), "tile": np.array(tiles, dtype="S20"),
+              "timestamp": np.array(timestamps, dtype="datetime64[s]"), "wkid": np.array(wkids, dtype=np.int32)}
+    header = {"arrays": {}}
+    offset = 0
+    for name in columns:
+        header["arrays"][name] = {"dtype": arrays[name].dtype.str, "shape": list(arrays[name].shape), "offset": offset}
+        offset += -(-arrays[name].nbytes//alignment)*alignment
+    headerBytes = json.dumps(header).encode("utf-8")
+    start = -(-(len(magic) + 4 + len(headerBytes))//alignment)*alignment
+    temp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(temp, "wb") as f:
+        f.write(magic + struct.pack("<I", len(headerBytes)) + headerBytes)
+        for name in columns:
+            f.seek(start + header["arrays"][name]["offset"])
+            f.write(arrays[name].tobytes())
+        f.truncate(start + offset)
+    os.replace(temp, path)
+    return (len(ids), len(arrays["coords"])//2)
+
+def readMaskFile(path):
+    """ Maps the arrays of a mask file (see writeMaskFile) read only into memory, returns a dict of them """
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("{0} is not a mask file".format(path))
+        length = struct.unpack("<I", f.read(4))[0]
+        header = json.loads(f.read(length).decode("utf-8"))
+    start = -(-(len(magic) + 4 + length)//alignment)*alignment
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        offset = start + spec["offset"]
+        arrays[name] = buffer[offset:offset + int(np.prod(shape))*dtype.itemsize].view(dtype).reshape(shape)
+    return arrays
+
+def wkbPolygon(rings):
+    """ WKB of a polygon from its rings as int32 arrays of x, y pairs """
+    parts = [struct.pack("=BII", 1 if sys.byteorder == "little" else 0, 3, len(rings))]
+    for ring in rings:
+        parts.append(struct.pack("=I", len(ring)//2))
+        parts.append(ring.astype(np.float64).tobytes())
+    return b"".join(parts)
+
+def maskIdentity(maskGmlFile):
+    """ (Tile, Timestamp) of a mask from the gml:id of its root element """
+    for event, elem in ET.iterparse(maskGmlFile, events=("start",)):
+        rids = elem.attrib["{" + CloudMask.ns["gml"] + "}id"].split("_")
+        return (rids[8], datetime.datetime.strptime(rids[6], "%Y%m%dT%H%M%S"))
+
+def storeMask(args):
+    """ Writes the mask file of a MSK_CLOUDS_B00.gml into folder (in a worker process of MaskStore.update),
+        returns its index row """
+    maskGmlFile, folder = args
+    st = os.stat(maskGmlFile)
+    records = list(CloudMask.iterMaskRecords(maskGmlFile))
+    tile, timestamp = (records[0][2], records[0][3]) if records else maskIdentity(maskGmlFile)
+    name = "{0}_{1:%Y%m%dT%H%M%S}.mask".format(tile, timestamp)
+    features, vertices = writeMaskFile(os.path.join(folder, name), records)
+    return {"path": maskGmlFile, "size": st.st_size, "mtime": st.st_mtime, "maskFile": name, "tile": tile,
+            "timestamp": np.datetime64(timestamp, "s"), "features": features, "vertices": vertices}
+
+class MaskStore(object):
+    """ The cloud mask features of many tiles in a columnar format which is mapped into memory instead of parsed:
+        one mask file per tile (see writeMaskFile) and an index (index.npz in folder) with
+            path, size, mtime       - of MSK_CLOUDS_B00.gml, used to update the store incrementally
+            maskFile                - name of the mask file in folder
+            tile, timestamp         - of the mask
+            features, vertices      - counts of the mask file
+        Once the masks are stored, (re)building a cloud mask featureclass replays the buffers (see insertInto)
+        instead of parsing every GML again. """
+    columns = {"path": "U", "size": np.int64, "mtime": np.float64, "maskFile": "U", "tile": "U",
+               "timestamp": "datetime64[s]", "features": np.int64, "vertices": np.int64}
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.indexPath = os.path.join(folder, "index.npz")
+        if os.path.exists(self.indexPath):
+            with np.load(self.indexPath) as data:
+                self.data = {name: data[name] for name in self.columns}
+        else:
+            self.data = {name: np.array([], dtype=dtype) for name, dtype in self.columns.items()}
+
+    def __len__(self):
+        return len(self.data["path"])
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    def save(self):
+        os.makedirs(self.folder, exist_ok=True)
+        temp = self.indexPath + ".tmp"
+        with open(temp, "wb") as f:
+            np.savez(f, **self.data)
+        os.replace(temp, self.indexPath)
+
+    def update(self, tilesFolder, workers=None, threads=None):
+        """ Stores the masks of the new and changed tiles under tilesFolder, drops those of tiles which are gone.
+            Unchanged masks (same size and mtime) are not read again. With workers=N the GML files are parsed and
+            written in N worker processes. """
+        os.makedirs(self.folder, exist_ok=True)
+        known = {path: i for i, path in enumerate(self.data["path"])}
+        keep = np.zeros(len(self), dtype=bool)
+        keep[[i for path, i in known.items() if not isInFolder(path, tilesFolder)]] = True
+
+        changed = []
+        for tile in SentinelImporter.iterTiles(tilesFolder, threads):
+            maskGmlFile = os.path.join(os.path.dirname(tile), "qi", "MSK_CLOUDS_B00.gml")
+            try:
+                st = os.stat(maskGmlFile)
+            except OSError:
+                continue
+            i = known.get(maskGmlFile)
+            if i is not None and self.data["size"][i] == st.st_size and self.data["mtime"][i] == st.st_mtime:
+                keep[i] = True
+            else:
+                changed.append(maskGmlFile)
+
+        records = []
+        pool = ProcessPoolExecutor(workers) if workers and workers > 1 else None
+        try:
+            futures = [(maskGmlFile, pool.submit(storeMask, (maskGmlFile, self.folder)) if pool else None) for maskGmlFile in changed]
+            for maskGmlFile, future in futures:
+                try:
+                    records.append(future.result() if future else storeMask((maskGmlFile, self.folder)))
+                except Exception as e:
+                    print("Exception while storing {0}\n{1}".format(maskGmlFile, e))
+        finally:
+            if pool:
+                pool.shutdown()
+
+        files = set(r["maskFile"] for r in records)
+        for name in self.data["maskFile"][~keep]:
+            if name not in files and os.path.exists(os.path.join(self.folder, name)):
+                os.remove(os.path.join(self.folder, name))
+        for name, dtype in self.columns.items():
+            added = np.array([r[name] for r in records], dtype=dtype)
+            self.data[name] = np.concatenate([self.data[name][keep], added]) if len(added) else self.data[name][keep]
+        print("Mask store updated, {0} masks stored, {1} tiles in store.".format(len(records), len(self)))
+        return self
+
+    def arrays(self, i):
+        """ The memory mapped arrays of the mask file of row i """
+        return readMaskFile(os.path.join(self.folder, self.data["maskFile"][i]))
+
+    def rows(self, predicate=None):
+        """ Rows for which predicate(store) is True, e.g. lambda s: s["tile"] == "T33UVR" """
+        if predicate is None:
+            return np.arange(len(self))
+        return np.flatnonzero(np.asarray(predicate(self), dtype=bool))
+
+    def iterRecords(self, rows=None):
+        """ Yields (Id, Type, Tile, Timestamp, wkid, coords) records like CloudMask.iterMaskRecords, coords is an int32
+            view of the first ring of the feature in the mapped file. """
+        for i in self.rows() if rows is None else rows:
+            a = self.arrays(i)
+            ringOffsets, featureOffsets, coords = a["ringOffsets"], a["featureOffsets"], a["coords"]
+            timestamps = a["timestamp"].astype(datetime.datetime)
+            for f in range(len(a["id"])):
+                ring = featureOffsets[f]
+                yield (a["id"][f].decode("utf-8"), a["type"][f].decode("utf-8"), a["tile"][f].decode("utf-8"), timestamps[f],
+                       int(a["wkid"][f]), coords[2*ringOffsets[ring]:2*ringOffsets[ring + 1]])
+
+    def iterFeatures(self, rows=None):
+        """ Yields (Id, Type, Tile, Timestamp, Polygon) features of the stored masks, the polygons are built from WKB
+            of the buffers (all rings of a feature). """
+        for i in self.rows() if rows is None else rows:
+            a = self.arrays(i)
+            ringOffsets, featureOffsets, coords = a["ringOffsets"], a["featureOffsets"], a["coords"]
+            timestamps = a["timestamp"].astype(datetime.datetime)
+            for f in range(len(a["id"])):
+                rings = [coords[2*ringOffsets[r]:2*ringOffsets[r + 1]] for r in range(featureOffsets[f], featureOffsets[f + 1])]
+                yield (a["id"][f].decode("utf-8"), a["type"][f].decode("utf-8"), a["tile"][f].decode("utf-8"), timestamps[f],
+                       arcpy.FromWKB(bytearray(wkbPolygon(rings)), spatialReference(int(a["wkid"][f]))))
+
+    def insertInto(self, cloudMaskFC, rows=None, batchSize=5000, metrics=None):
+        """ Inserts the stored features (of rows, all by default) into a cloud mask featureclass (see
+            CloudMask.createFeatureClass) or a CloudMaskWriter. Returns the number of features. """
+        writer = cloudMaskFC if isinstance(cloudMaskFC, CloudMaskWriter) else CloudMaskWriter(cloudMaskFC, batchSize, metrics)
+        count = 0
+        try:
+            for i in self.rows() if rows is None else rows:
+                writer.write(self.iterFeatures([i]))
+                count += int(self.data["features"][i])
+        finally:
+            if writer is not cloudMaskFC:
+                writer.close()
+        return count
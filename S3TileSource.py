@@ -0,0 +1,338 @@
+import asyncio
+import calendar
+import datetime
+import hashlib
+import hmac
+import io
+import json
+import os
+import ssl
+from urllib.parse import quote, urlsplit
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+from SentinelImporter import CloudMask, CloudMaskWriter, SentinelImporter, readTileHeader
+
+emptyPayloadHash = hashlib.sha256(b"").hexdigest()
+
+class HttpConnectionPool(object):
+    """ Keep-alive HTTP/1.1 connections to one host on asyncio streams, at most maxConnections of them in use at once.
+        A request on a reused connection which the server closed in the meantime is sent again on a new one. """
+
+    def __init__(self, host, port, sslContext=None, maxConnections=16, timeout=60, hostHeader=None):
+        self.host = host
+        self.port = port
+        self.sslContext = sslContext
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self.hostHeader = hostHeader or host
+        self.idle = []
+        self.slots = None
+        self.opened = 0
+
+    async def request(self, method, target, headers, body=b""):
+        """ Returns (status, headers with lower case names, body) """
+        if self.slots is None:
+            # created in the running loop (python 3.6 binds it to the current loop)
+            self.slots = asyncio.Semaphore(self.maxConnections)
+        async with self.slots:
+            for attempt in (0, 1):
+                reused = bool(self.idle)
+                if reused:
+                    reader, writer = self.idle.pop()
+                else:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.sslContext), self.timeout)
+                    self.opened += 1
+                try:
+                    status, responseHeaders, data, keepAlive = await asyncio.wait_for(
+                            self.exchange(reader, writer, method, target, headers, body), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keepAlive:
+                    self.idle.append((reader, writer))
+                else:
+                    writer.close()
+                return (status, responseHeaders, data)
+
+    async def exchange(self, reader, writer, method, target, headers, body):
+        lines = ["{0} {1} HTTP/1.1".format(method, target), "Host: " + self.hostHeader]
+        lines.extend("{0}: {1}".format(name, value) for name, value in headers.items())
+        if body:
+            lines.append("Content-Length: {0}".format(len(body)))
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise ConnectionResetError("Connection closed by {0}".format(self.host))
+        version, status = statusLine.split(None, 2)[:2]
+        status = int(status)
+        responseHeaders = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            responseHeaders[name.strip().lower()] = value.strip()
+        keepAlive = version == b"HTTP/1.1" and responseHeaders.get("connection", "").lower() != "close"
+
+        if method == "HEAD" or status in (204, 304):
+            data = b""
+        elif responseHeaders.get("transfer-encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                parts.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b"".join(parts)
+        elif "content-length" in responseHeaders:
+            data = await reader.readexactly(int(responseHeaders["content-length"]))
+        else:
+            data = await reader.read()
+            keepAlive = False
+        return (status, responseHeaders, data, keepAlive)
+
+    def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+class S3TileSource(object):
+    """ Tiles of a bucket in the layout of the Sentinel-2 L2A bucket on AWS
+            tiles/<utmZone>/<latitudeBand>/<gridSquare>/<year>/<month>/<day>/<sequence>/
+        read over HTTP instead of from a local mirror. Only metadata.xml (its head and tail by ranged reads), tileInfo.json
+        and qi/MSK_CLOUDS_B00.gml are fetched, through pooled keep-alive connections with at most concurrency requests
+        in flight, and handed to the parsers of SentinelImporter.
+        endpoint can be any S3 compatible server, e.g. http://127.0.0.1:9000 for a local stand-in (see benchmark/s3server.py),
+        the bucket is addressed path style. Requests are signed (AWS signature version 4) with the given credentials or
+        those of AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY and AWS_SESSION_TOKEN, without any they are anonymous.
+        requesterPays adds the header the sentinel-s2-l2a bucket requires. """
+
+    headerFields = ("SENSING_TIME", "HORIZONTAL_CS_CODE", "CLOUD_COVERAGE_PERCENTAGE", "VEGETATION_PERCENTAGE")
+    tailFields = ("CLOUD_COVERAGE_PERCENTAGE", "VEGETATION_PERCENTAGE")
+
+    def __init__(self, bucket, endpoint=None, region="eu-central-1", requesterPays=False, accessKey=None, secretKey=None,
+                 sessionToken=None, concurrency=16, timeout=60, headBytes=32768, tailBytes=16384):
+        endpoint = urlsplit(endpoint or "https://s3.{0}.amazonaws.com".format(region))
+        secure = endpoint.scheme == "https"
+        self.bucket = bucket
+        self.region = region
+        self.requesterPays = requesterPays
+        self.accessKey = accessKey or os.environ.get("AWS_ACCESS_KEY_ID")
+        self.secretKey = secretKey or os.environ.get("AWS_SECRET_ACCESS_KEY")
+        self.sessionToken = sessionToken or os.environ.get("AWS_SESSION_TOKEN")
+        self.concurrency = concurrency
+        self.headBytes = headBytes
+        self.tailBytes = tailBytes
+        self.host = endpoint.netloc
+        self.basePath = endpoint.path.rstrip("/")
+        self.pool = HttpConnectionPool(endpoint.hostname, endpoint.port or (443 if secure else 80),
+                                       ssl.create_default_context() if secure else None, concurrency, timeout, endpoint.netloc)
+        self.loop = asyncio.new_event_loop()
+        self.requests = 0
+        self.bytesRead = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.loop.close()
+
+    def uri(self, key):
+        return "s3://{0}/{1}".format(self.bucket, key)
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def sign(self, method, path, query, headers):
+        """ Adds the AWS signature version 4 headers """
+        now = datetime.datetime.utcnow()
+        amzDate = now.strftime("%Y%m%dT%H%M%SZ")
+        headers["x-amz-date"] = amzDate
+        headers["x-amz-content-sha256"] = emptyPayloadHash
+        if self.sessionToken:
+            headers["x-amz-security-token"] = self.sessionToken
+        canonical = dict((name.lower(), " ".join(str(value).split())) for name, value in headers.items())
+        canonical["host"] = self.host
+        signedHeaders = ";".join(sorted(canonical))
+        canonicalRequest = "\n".join([method, path, query, "".join("{0}:{1}\n".format(name, canonical[name]) for name in sorted(canonical)),
+                                      signedHeaders, emptyPayloadHash])
+        scope = "{0}/{1}/s3/aws4_request".format(amzDate[:8], self.region)
+        stringToSign = "\n".join(["AWS4-HMAC-SHA256", amzDate, scope, hashlib.sha256(canonicalRequest.encode("utf-8")).hexdigest()])
+        key = ("AWS4" + self.secretKey).encode("utf-8")
+        for part in (amzDate[:8], self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+        signature = hmac.new(key, stringToSign.encode("utf-8"), hashlib.sha256).hexdigest()
+        headers["Authorization"] = "AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, Signature={3}".format(
+                self.accessKey, scope, signedHeaders, signature)
+
+    def prepareRequest(self, method, key="", query=None, headers=None):
+        """ Returns the request target of the key (or of the bucket with a query) and the headers, signed if there are
+            credentials. Also used by requests not sent through the pool, see BandFetcher. """
+        path = "{0}/{1}/{2}".format(self.basePath, self.bucket, quote(key, safe="/-_.~"))
+        query = "&".join("{0}={1}".format(quote(name, safe="-_.~"), quote(value, safe="-_.~")) for name, value in sorted((query or {}).items()))
+        headers = dict(headers or {})
+        if self.requesterPays:
+            headers["x-amz-request-payer"] = "requester"
+        if self.accessKey and self.secretKey:
+            self.sign(method, path, query, headers)
+        return (path + ("?" + query if query else ""), headers)
+
+    async def request(self, key="", query=None, byteRange=None):
+        """ GET of an object (or of the bucket with a query), returns (status, headers, body). byteRange is the value
+            of the Range header without the unit, e.g. "0-1023" or "-1024" for the last KB. """
+        target, headers = self.prepareRequest("GET", key, query, {"Range": "bytes=" + byteRange} if byteRange else None)
+        status, responseHeaders, data = await self.pool.request("GET", target, headers)
+        self.requests += 1
+        self.bytesRead += len(data)
+        if status == 404:
+            raise FileNotFoundError("{0} not found".format(self.uri(key)))
+        if status >= 300:
+            raise IOError("GET {0} failed with HTTP {1}\n{2}".format(self.uri(key), status, data[:500].decode("utf-8", "replace")))
+        return (status, responseHeaders, data)
+
+    async def get(self, key, byteRange=None):
+        return (await self.request(key, byteRange=byteRange))[2]
+
+    async def listObjects(self, prefix, delimiter="/"):
+        """ Returns ([(key, size, mtime)], [common prefixes]) of all pages of a ListObjectsV2 listing """
+        objects = []
+        prefixes = []
+        query = {"list-type": "2", "prefix": prefix, "delimiter": delimiter}
+        while True:
+            root = ET.fromstring((await self.request(query=query))[2])
+            token = None
+            truncated = False
+            for child in root:
+                name = child.tag.split("}")[-1]
+                if name == "Contents":
+                    values = dict((e.tag.split("}")[-1], e.text) for e in child)
+                    objects.append((values["Key"], int(values["Size"]), lastModified(values["LastModified"])))
+                elif name == "CommonPrefixes":
+                    prefixes.extend(e.text for e in child if e.tag.split("}")[-1] == "Prefix")
+                elif name == "IsTruncated":
+                    truncated = child.text == "true"
+                elif name == "NextContinuationToken":
+                    token = child.text
+            if not truncated or not token:
+                return (objects, prefixes)
+            query["continuation-token"] = token
+
+    async def findTiles(self, prefix="tiles/"):
+        """ Lists the prefixes level by level (all prefixes of a level concurrently). Like SentinelImporter.scanDirectory
+            a prefix with metadata.xml and tileInfo.json is a tile, its band and qi prefixes are not listed. """
+        tiles = []
+        level = [prefix]
+        while level:
+            listings = await gatherAll(*[self.listObjects(p) for p in level])
+            level = []
+            for objects, prefixes in listings:
+                names = dict((key.rsplit("/", 1)[-1].lower(), (key, size, mtime)) for key, size, mtime in objects)
+                if "metadata.xml" in names and "tileinfo.json" in names:
+                    tiles.append(names["metadata.xml"])
+                    prefixes = [p for p in prefixes if p.rstrip("/").rsplit("/", 1)[-1].lower() not in SentinelImporter.tileDirectories]
+                level.extend(prefixes)
+        return tiles
+
+    def listTiles(self, prefix="tiles/"):
+        """ Returns (key of metadata.xml, size, mtime) of the tiles under prefix, sorted by key """
+        return sorted(self.run(self.findTiles(prefix)))
+
+    async def readHeader(self, key, fields=headerFields):
+        """ readTileHeader over the head and the tail of metadata.xml, fetched concurrently by ranged reads.
+            Fields not found there are read from the whole file. """
+        headFields = [name for name in fields if name not in self.tailFields]
+        tailFields = [name for name in fields if name in self.tailFields]
+        head, tail = await gatherAll(self.get(key, "0-{0}".format(self.headBytes - 1)) if headFields else noData(),
+                                          self.get(key, "-{0}".format(self.tailBytes)) if tailFields else noData())
+        values = {}
+        try:
+            if tailFields:
+                values.update(readTileHeader(io.BytesIO(tail), tailFields, len(tail)))
+            if headFields:
+                values.update(readTileHeader(io.BytesIO(head), headFields))
+        except ET.ParseError:
+            pass
+        missing = [name for name in fields if name not in values]
+        if missing:
+            values.update(readTileHeader(io.BytesIO(await self.get(key)), missing))
+        return values
+
+    async def readTile(self, key, fields=headerFields, withTileInfo=True, withMask=True):
+        """ Returns {"key", "header", "tileInfo", "maskRecords"} of the tile of metadata.xml key, see readHeader and
+            CloudMask.iterMaskRecords (parsed on a thread so the transfers go on meanwhile). """
+        folder = key.rsplit("/", 1)[0]
+        header, tileInfo, mask = await gatherAll(self.readHeader(key, fields) if fields else noData(),
+                                                      self.get(folder + "/tileInfo.json") if withTileInfo else noData(),
+                                                      self.get(folder + "/qi/MSK_CLOUDS_B00.gml") if withMask else noData())
+        tile = {"key": key, "header": header, "tileInfo": None, "maskRecords": None}
+        if withTileInfo:
+            tile["tileInfo"] = json.loads(tileInfo.decode("utf-8"))
+        if withMask:
+            tile["maskRecords"] = await asyncio.get_event_loop().run_in_executor(None, parseMask, mask)
+        return tile
+
+    async def readTileList(self, keys, fields, withTileInfo, withMask):
+        return await asyncio.gather(*[self.readTile(key, fields, withTileInfo, withMask) for key in keys], return_exceptions=True)
+
+    def readTiles(self, keys, fields=headerFields, withTileInfo=True, withMask=True, window=None):
+        """ Yields readTile of every key in the order of keys, {"key", "error"} for the failed ones.
+            window tiles (default 4*concurrency) are read at a time. """
+        for chunk in SentinelImporter.chunks(keys, window or 4*self.concurrency):
+            for key, tile in zip(chunk, self.run(self.readTileList(chunk, fields, withTileInfo, withMask))):
+                yield {"key": key, "error": tile} if isinstance(tile, Exception) else tile
+
+    def appendCloudMasks(self, keys, cloudMaskFC):
+        """ Inserts the cloud masks of the tiles into cloudMaskFC (a featureclass or a CloudMaskWriter),
+            returns (processedTiles, failedTiles) like SentinelImporter.addTiles """
+        processedTiles = []
+        failedTiles = []
+        writer = cloudMaskFC if isinstance(cloudMaskFC, CloudMaskWriter) else CloudMaskWriter(cloudMaskFC)
+        try:
+            for tile in self.readTiles(keys, None, False, True):
+                try:
+                    if "error" in tile:
+                        raise tile["error"]
+                    writer.writeRecords(tile["maskRecords"])
+                    processedTiles.append(tile["key"])
+                except Exception as e:
+                    print("Unable to add cloud mask of {0}\n{1}".format(tile["key"], e))
+                    failedTiles.append(tile["key"])
+        finally:
+            if writer is not cloudMaskFC:
+                writer.close()
+        return (processedTiles, failedTiles)
+
+async def noData():
+    return None
+
+async def gatherAll(*coroutines):
+    """ asyncio.gather which lets all coroutines finish before it raises the first exception """
+    results = await asyncio.gather(*coroutines, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+def parseMask(data):
+    return list(CloudMask.iterMaskRecords(io.BytesIO(data)))
+
+def lastModified(text):
+    """ Seconds since the epoch of a LastModified value like 2018-07-05T12:00:00.000Z """
+    return calendar.timegm(datetime.datetime.strptime(text[:19], "%Y-%m-%dT%H:%M:%S").timetuple()) + float("0" + text[19:].rstrip("Z"))
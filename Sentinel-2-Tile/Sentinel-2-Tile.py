@@ -21,9 +21,13 @@
 # The base path for a Sentinel-2 tile is the metadata.xml. The file must be in same directory as tileInfo.json file and the R10m, R20m and R60m folders.
 
 import os
+import re
 import json
+import hashlib
+import threading
 import arcpy
-from functools import lru_cache
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     import xml.etree.cElementTree as ET
@@ -31,8 +35,9 @@ except ImportError:
     import xml.etree.ElementTree as ET
 
 ns = {'n1': 'https://psd-12.sentinel2.eo.esa.int/PSD/S2_PDI_Level-2A_Tile_Metadata.xsd', 
-        'n2': 'https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-2A_Tile_Metadata.xsd',
-        'nx': ''} # nx is set either to n1 or n2 depending on the processed metadata file
+        'n2': 'https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-2A_Tile_Metadata.xsd'}
+# root tags of the supported metadata files, the namespace of a file is resolved from its root (see tileNamespaces)
+tileRootTags = ['{' + ns[n] + '}Level-2A_Tile_ID' for n in ('n1', 'n2')]
 
 bandProperties = {
                   13: {'bandName': 'B00', 'bandIndex': 0, 'filename': '../qi/CLD_20m.jp2', 'wavelengthMin': 0.0, 'wavelengthMax': 0.0 },
@@ -105,7 +110,7 @@ class RasterTypeFactory():
                     'supportsOrthorectification': False,
                     'enableClipToFootprint': True,
                     'isRasterProduct': True,
-                    # #'crawlerName': 'Sentinel2Tile10mCrawler',
+                    'crawlerName': 'Sentinel2Tile10mCrawler',
                     'productDefinitionName': 'Sentinel-2_L2A_Tile',
                     'supportedUriFilters': [
                                             {
@@ -146,7 +151,7 @@ class RasterTypeFactory():
                     'supportsOrthorectification': False,
                     'enableClipToFootprint': True,
                     'isRasterProduct': True,
-                    # #'crawlerName': 'Sentinel2Tile10mCrawler',
+                    'crawlerName': 'Sentinel2Tile20mCrawler',
                     'productDefinitionName': 'Sentinel-2_L2A_Tile',
                     'supportedUriFilters': [
                                             {
@@ -187,7 +192,7 @@ class RasterTypeFactory():
                     'supportsOrthorectification': False,
                     'enableClipToFootprint': True,
                     'isRasterProduct': True,
-                    # #'crawlerName': 'Sentinel2Tile10mCrawler',
+                    'crawlerName': 'Sentinel2Tile20mCrawler',
                     'productDefinitionName': 'Sentinel-2_L2A_Tile',
                     'supportedUriFilters': [
                                             {
@@ -234,47 +239,36 @@ class Utilities():
         # check for tileInfo.json
         # check for directory and jp2 files
         isS2Tile = False
-        tree = cacheElementTree(path)
-        if tree is not None:
-            element = tree.getroot()
-            if element is not None:
-                isS2Tile = element.tag ==  r'{https://psd-12.sentinel2.eo.esa.int/PSD/S2_PDI_Level-2A_Tile_Metadata.xsd}Level-2A_Tile_ID'            
+        try:
+            # only the root tag is kept in the cache, not the whole tree
+            tag = parseCache.get(path, readRootTag, len)
+        except ET.ParseError as e:
+            print("Exception while parsing {0}\n{1}".format(path,e))
+            return isS2Tile
+        isS2Tile = tag in tileRootTags
 
         return isS2Tile
 
     def getProductType(self, path):
         return 'Sentinel-2_L2A_Tile'
 
-    def getProductName(self, path):
+    def getTileMetadata(self, path):
         folder, filename = os.path.split(path)
         if filename != 'metadata.xml':
             folder, parent = os.path.split(folder)
-        with open(os.path.join(folder, 'tileInfo.json'), 'r') as f:
-            tileInfo = json.load(f)
-        if 'productName' in tileInfo:
-            return tileInfo['productName']
-        return None
+        return TileMetadata.get(os.path.join(folder, 'metadata.xml'))
+
+    def getProductName(self, path):
+        return self.getTileMetadata(path).productName
 
     def getGroupName(self, path):
-        folder, filename = os.path.split(path)
-        if filename != 'metadata.xml':
-            folder, parent = os.path.split(folder)
-        with open(os.path.join(folder, 'tileInfo.json'), 'r') as f:
-            tileInfo = json.load(f)
-        if 'utmZone' in tileInfo and 'latitudeBand' in tileInfo and 'gridSquare' in tileInfo:
-            return "T{0}{1}{2}".format(tileInfo['utmZone'], tileInfo['latitudeBand'], tileInfo['gridSquare'])
-        return None
+        return self.getTileMetadata(path).groupName
 
     def getDisplayName(self, path):
-        prodName = self.getProductName(path)
-        if prodName:
-            dn = prodName.split('_')
-            if len(dn)>=2:
-                return dn[-2] + "_" + dn[-1]
-        return None
+        return self.getTileMetadata(path).displayName
 
     def getBandAngles(self, tree):
-        angles = tree.find('./nx:Geometric_Info/Tile_Angles/Mean_Viewing_Incidence_Angle_List', ns)
+        angles = tree.find('./nx:Geometric_Info/Tile_Angles/Mean_Viewing_Incidence_Angle_List', tileNamespaces(tree.getroot()))
         bandAngles = {}
         if angles is not None:
             for band_info in angles:
@@ -289,16 +283,177 @@ class Utilities():
                 bandAngles[bandAngle['SourceBandIndex']] = bandAngle
         return bandAngles
 
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
+# Tile metadata, read once per tile and shared by the Builder and Utilities
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
+
+
+class TileMetadata(object):
+    """ The values of metadata.xml and tileInfo.json the builder needs. Each file is read exactly once,
+        use TileMetadata.get(path) to share the instance of a tile while its metadata.xml does not change. """
+
+    __slots__ = ('path', 'folder', 'namespace', 'epsg', 'footprint', 'geopositions', 'sizes', 'sensingTime',
+                 'cloudCoverage', 'vegetationPercentage', 'bandAngles', 'productName', 'groupName', 'displayName')
+
+    def __init__(self, path):
+        self.path = path
+        self.folder = os.path.dirname(path)
+
+        root = ET.parse(path).getroot()
+        nsx = tileNamespaces(root)
+        self.namespace = nsx['nx']
+
+        self.epsg = 0
+        projectionNode = root.find('./nx:Geometric_Info/Tile_Geocoding/HORIZONTAL_CS_CODE', nsx)
+        if projectionNode is not None:
+            self.epsg = int((projectionNode.text).split(":")[1])
+
+        self.geopositions = {}
+        for geopos in root.findall('./nx:Geometric_Info/Tile_Geocoding/Geoposition', nsx):
+            self.geopositions[geopos.attrib['resolution']] = (int(geopos.find("ULX").text), int(geopos.find("ULY").text),
+                                                               int(geopos.find("XDIM").text), int(geopos.find("YDIM").text))
+        self.sizes = {}
+        for size in root.findall('./nx:Geometric_Info/Tile_Geocoding/Size', nsx):
+            self.sizes[size.attrib['resolution']] = (int(size.find("NROWS").text), int(size.find("NCOLS").text))
+
+        sensing_time = root.find('./nx:General_Info/SENSING_TIME', nsx)
+        self.sensingTime = sensing_time.text if sensing_time is not None else None
+
+        self.cloudCoverage = None
+        self.vegetationPercentage = None
+        quality_indi = root.find('./nx:Quality_Indicators_Info', nsx)
+        if quality_indi is not None:
+            cloudCoverage = quality_indi.find('./L2A_Image_Content_QI/CLOUD_COVERAGE_PERCENTAGE')
+            if cloudCoverage is not None:
+                self.cloudCoverage = float(cloudCoverage.text)
+            vegetationPercentage = quality_indi.find('./L2A_Image_Content_QI/VEGETATION_PERCENTAGE')
+            if vegetationPercentage is not None:
+                self.vegetationPercentage = float(vegetationPercentage.text)
+
+        self.bandAngles = {}
+        angles = root.find('./nx:Geometric_Info/Tile_Angles/Mean_Viewing_Incidence_Angle_List', nsx)
+        if angles is not None:
+            for band_info in angles:
+                azimut_angle = band_info.find('AZIMUTH_ANGLE')
+                bandAngle = {'SourceBandIndex': int(band_info.attrib['bandId']),
+                             'ZenithAngle': float(band_info.find('ZENITH_ANGLE').text),
+                             'AzimuthAngle': float(azimut_angle.text),
+                             'Unit': azimut_angle.attrib['unit']}
+                self.bandAngles[bandAngle['SourceBandIndex']] = bandAngle
+
+        with open(os.path.join(self.folder, 'tileInfo.json'), 'r') as f:
+            tileInfo = json.load(f)
+        self.footprint = []
+        if ('tileDataGeometry' in tileInfo) and ('coordinates' in tileInfo['tileDataGeometry']):
+            self.footprint = [(vertex[0], vertex[1]) for vertex in tileInfo['tileDataGeometry']['coordinates'][0]]
+        self.productName = tileInfo.get('productName')
+        self.groupName = None
+        if 'utmZone' in tileInfo and 'latitudeBand' in tileInfo and 'gridSquare' in tileInfo:
+            self.groupName = "T{0}{1}{2}".format(tileInfo['utmZone'], tileInfo['latitudeBand'], tileInfo['gridSquare'])
+        self.displayName = None
+        if self.productName:
+            dn = self.productName.split('_')
+            if len(dn)>=2:
+                self.displayName = dn[-2] + "_" + dn[-1]
+
+    @classmethod
+    def get(cls, path):
+        """ Returns the metadata of the tile, cached in parseCache until metadata.xml changes """
+        return parseCache.get(path, cls, cls.estimatedBytes)
+
+    def estimatedBytes(self):
+        # the band angles dominate, the names, times and geopositions take a few KB
+        return 4096 + 512 * len(self.bandAngles)
+
+
+class WorldFiles(object):
+    """ Georeferences the band images of a tile with .j2w world files next to them. Files that already have the
+        expected content are left alone, the missing or outdated ones are written together, each to a temporary
+        file renamed into place.
+        ArcGIS reads world files only next to the image, so with a cacheFolder (e.g. for read-only archives) the
+        source tree is not written at all: a small VRT with the same geotransform is written per image under
+        cacheFolder and the raster function references the VRTs instead of the JP2 files. """
+
+    vrtTemplate = (
+        '<VRTDataset rasterXSize="{ncols}" rasterYSize="{nrows}">\n'
+        '  <GeoTransform>{ulx}, {xdim}, 0, {uly}, 0, {ydim}</GeoTransform>\n'
+        '  <VRTRasterBand dataType="{dataType}" band="1">\n'
+        '    <SimpleSource>\n'
+        '      <SourceFilename relativeToVRT="0">{image}</SourceFilename>\n'
+        '      <SourceBand>1</SourceBand>\n'
+        '    </SimpleSource>\n'
+        '  </VRTRasterBand>\n'
+        '</VRTDataset>\n')
+
+    def __init__(self, cacheFolder=None):
+        self.cacheFolder = cacheFolder
+
+    def worldFile(self, metadata, resolution):
+        ulx, uly, xdim, ydim = metadata.geopositions[resolution[:-1]]
+        return (resolution[:-1] + "\n0\n-0\n-" + resolution[:-1] + "\n" +
+                str(ulx + xdim/2) + "\n" + str(uly + ydim/2) + "\n")
+
+    def vrtFile(self, metadata, resolution, image):
+        ulx, uly, xdim, ydim = metadata.geopositions[resolution[:-1]]
+        nrows, ncols = metadata.sizes.get(resolution[:-1], (109800 // abs(xdim), 109800 // abs(xdim)))
+        # the cloud probability band is 8 bit, the reflectance bands 16 bit
+        dataType = 'Byte' if os.path.basename(image).startswith('CLD') else 'UInt16'
+        return self.vrtTemplate.format(ncols=ncols, nrows=nrows, ulx=ulx, xdim=xdim, uly=uly, ydim=ydim,
+                                       dataType=dataType, image=os.path.abspath(image))
+
+    def cachePath(self, metadata, image):
+        tileKey = hashlib.sha1(os.path.abspath(metadata.folder).encode('utf-8')).hexdigest()[:16]
+        relative = os.path.normpath(os.path.relpath(image, metadata.folder))
+        return os.path.join(self.cacheFolder, tileKey, relative[:-3] + 'vrt')
+
+    def prepare(self, metadata, resolution, images):
+        """ Makes sure the images are georeferenced and returns the paths to use in the raster function. """
+        if self.cacheFolder:
+            sidecars = [(self.cachePath(metadata, im), self.vrtFile(metadata, resolution, im)) for im in images]
+            paths = [sidecar for sidecar, content in sidecars]
+        else:
+            content = self.worldFile(metadata, resolution)
+            sidecars = [(im[:-3] + 'j2w', content) for im in images]
+            paths = images
+
+        outdated = [(sidecar, content) for sidecar, content in sidecars if not self.isCurrent(sidecar, content)]
+        for sidecar, content in outdated:
+            self.write(sidecar, content)
+        return paths
+
+    @staticmethod
+    def isCurrent(path, content):
+        try:
+            with open(path, 'r') as f:
+                return f.read() == content
+        except (IOError, OSError):
+            return False
+
+    @staticmethod
+    def write(path, content):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        temp = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(temp, 'w') as f:
+            f.write(content)
+        os.replace(temp, path)
+
+
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
 # Sentinel 2 Tile builder class
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
 
 
 class Sentinel2TileBuilder(object):
+    """ The builder keeps no mutable state between calls (metadata is per tile, the caches are locked),
+        so build can be called from several threads at once, see buildItems. """
 
     def __init__(self, **kwargs):
         self.SensorName = 'Sentinel-2'
         self.utilities = Utilities()
+        # set SENTINEL2_WORLDFILE_CACHE to a local folder to keep the source tiles untouched (see WorldFiles)
+        self.worldFiles = WorldFiles(os.environ.get('SENTINEL2_WORLDFILE_CACHE'))
 
     def canOpen(self, datasetPath):
         # Open the datasetPath and check if the XML metadata file contains the element Level-2A_Tile_ID
@@ -320,36 +475,16 @@ class Sentinel2TileBuilder(object):
             else:
                 return None
 
-            # The metadata file is a XML file
-                #set the correct namespace
-            ns["nx"] = ""
-            with open(path, "r") as f:
-                # check first 2 lines for namespace
-                for i in range(2):
-                    line = f.readline()
-                    ns["nx"] = ns["n1"] if ns["n1"] in line else ns["nx"]
-                    ns["nx"] = ns["n2"] if ns["n2"] in line else ns["nx"]
-
-            tree = cacheElementTree(path)
+            metadata = TileMetadata.get(path)
+            folder = metadata.folder
             # Horizontal CS (can also be a arcpy.SpatialReference object,
             # EPSG code, path to a PRJ file or a WKT string)
-            srsEPSG = 0
-            #Here, using the epsg code to build srs            
-            projectionNode = tree.find('./nx:Geometric_Info/Tile_Geocoding/HORIZONTAL_CS_CODE', ns)
-
-            if projectionNode is not None:
-                srsEPSG = int((projectionNode.text).split(":")[1]) #to get EPSG code
+            srsEPSG = metadata.epsg
 
             # Dataset frame - footprint; this is a list of Vertex coordinates from tileInfo.json
             vertex_array = arcpy.Array()
-            folder, filename = os.path.split(path)
-            with open(os.path.join(folder, 'tileInfo.json'), 'r') as f:
-                tileInfo = json.load(f)
-            if ('tileDataGeometry' in tileInfo) and ('coordinates' in tileInfo['tileDataGeometry']):
-                for vertex in tileInfo['tileDataGeometry']['coordinates'][0]:
-                    x_vertex = vertex[0]
-                    y_vertex = vertex[1]                    
-                    vertex_array.add(arcpy.Point(x_vertex, y_vertex))
+            for x_vertex, y_vertex in metadata.footprint:
+                vertex_array.add(arcpy.Point(x_vertex, y_vertex))
             #the order of vertices must be ul, ur, lr, ll
 
             # Get geometry object for the footprint; the SRS of the
@@ -361,43 +496,31 @@ class Sentinel2TileBuilder(object):
             # Other keyProperties information (Cloud Coverage, Vegeneation Percentage etc)
             keyProperties = {}
             keyProperties['Footprint'] = footprint_geometry
-            keyProperties['BlockName'] = self.utilities.getGroupName(path)
+            keyProperties['BlockName'] = metadata.groupName
             keyProperties['SensorName'] = self.SensorName
             keyProperties['ProductType'] = self.utilities.getProductType(path)
             #Set the Product Name
             if keyProperties['ProductType'] == 'Sentinel-2_L2A_Tile':
-                keyProperties['ProductName'] = self.utilities.getProductName(path)
-                itemURI['GroupName'] = self.utilities.getGroupName(path)
-                itemURI['DisplayName'] = self.utilities.getDisplayName(path)
+                keyProperties['ProductName'] = metadata.productName
+                itemURI['GroupName'] = metadata.groupName
+                itemURI['DisplayName'] = metadata.displayName
 
             # Get the acquisition date of the scene
-            sensing_time = tree.find('./nx:General_Info/SENSING_TIME', ns)            
-            if sensing_time is not None:
-                keyProperties['AcquisitionDate'] = sensing_time.text
-
-            quality_indi = tree.find('./nx:Quality_Indicators_Info', ns) 
-            if quality_indi is not None:
-                # Get the Cloud Coverage
-                cloudCoverage = quality_indi.find('./L2A_Image_Content_QI/CLOUD_COVERAGE_PERCENTAGE')
-                if cloudCoverage is not None:
-                    keyProperties['CloudCoverage'] = float(cloudCoverage.text)
-                    keyProperties['CloudCover'] = float(cloudCoverage.text)
-
-                # Get the Sun Azimuth
-                vegetationPercentage = quality_indi.find('./L2A_Image_Content_QI/VEGETATION_PERCENTAGE')
-                if vegetationPercentage is not None:
-                    keyProperties['VegetationPercentage'] = float(vegetationPercentage.text)
+            if metadata.sensingTime is not None:
+                keyProperties['AcquisitionDate'] = metadata.sensingTime
+
+            # Get the Cloud Coverage and Vegetation Percentage
+            if metadata.cloudCoverage is not None:
+                keyProperties['CloudCoverage'] = metadata.cloudCoverage
+                keyProperties['CloudCover'] = metadata.cloudCoverage
+            if metadata.vegetationPercentage is not None:
+                keyProperties['VegetationPercentage'] = metadata.vegetationPercentage
 
             buildItemsList = list()
             buildItem = {} 
             imparam = [os.path.join(folder, 'R'+resolution.replace("c", "m"), bandProperties[k]['filename']) for k in Rxm[resolution]['bandKeys']]
 
-            geopos = tree.find("./nx:Geometric_Info/Tile_Geocoding/Geoposition[@resolution='" + resolution[:-1] + "']", ns)            
-            for im in imparam:
-                with open(im[:-3]+'j2w', "w") as wf:
-                    wf.write(resolution[:-1] + "\n0\n-0\n-" + resolution[:-1] + "\n")
-                    wf.write(str(int(geopos.find("ULX").text) + int(geopos.find("XDIM").text)/2) + "\n")
-                    wf.write(str(int(geopos.find("ULY").text) + int(geopos.find("YDIM").text)/2) + "\n")
+            imparam = self.worldFiles.prepare(metadata, resolution, imparam)
 
             rfa = {}
             for i in range(len(imparam)):
@@ -409,7 +532,7 @@ class Sentinel2TileBuilder(object):
                 }
             }
 
-            ba = self.utilities.getBandAngles(tree)
+            ba = metadata.bandAngles
             keyProperties['bandProperties'] = [{
                 'BandName': bandProperties[b]['bandName'], 
                 'WavelengthMin': bandProperties[b]['wavelengthMin'],
@@ -420,8 +543,8 @@ class Sentinel2TileBuilder(object):
                 'Unit': ba[bandProperties[b]['bandIndex']]['Unit']
                 } for b in bandProperties if b in Rxm[resolution]['bandKeys']]
 
-            buildItem['itemURI'] = {'displayName': self.utilities.getDisplayName(path) if not (buildItemsList) else None, 
-                                    'groupName': self.utilities.getGroupName(path)}
+            buildItem['itemURI'] = {'displayName': metadata.displayName if not (buildItemsList) else None, 
+                                    'groupName': metadata.groupName}
             buildItem['spatialReference'] = srsEPSG
             buildItem['footprint'] = footprint_geometry
             buildItem['keyProperties'] = keyProperties
@@ -434,6 +557,12 @@ class Sentinel2TileBuilder(object):
             raise
 
 
+    def buildItems(self, itemURIs, threads=4):
+        """ Calls build for all itemURIs on a thread pool and returns the results in the same order. """
+        with ThreadPoolExecutor(threads) as pool:
+            return list(pool.map(self.build, itemURIs))
+
+
 class Sentinel210mTileBuilder(Sentinel2TileBuilder):
 
     def build(self, itemURI):
@@ -455,80 +584,243 @@ class Sentinel220mCloudTileBuilder(Sentinel2TileBuilder):
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
 
 
-# class Sentinel2TileCrawler():
-
-#     def __init__(self, **crawlerProperties):
-#         self.utils = Utilities()
-#         self.paths = crawlerProperties['paths']
-#         self.recurse = crawlerProperties['recurse']
-#         self.filter = '*.jp2'
-#         self.currentPath = None
-#         self.pathGenerator = self.createGenerator()
-
-
-#     def __iter__(self):
-#         return self
-
-#     #this is a generator function
-#     def createGenerator(self):
-#         for p in self.paths:
-#             folder, filename = os.path.split(p)
-#             self.currentPath = folder
-#             path = folder + '\\R20m'
-#             if not os.path.exists(path):
-#                 continue
-
-#             if os.path.isdir(path):
-#                 for root, dirs, files in (os.walk(path)):
-#                     for file in (files):
-#                         if file.endswith(".jp2") and file.startswith("B"):
-#                             filename = os.path.join(root, file)
-#                             yield filename
-#             elif path.endswith(".jp2") and file.startswith("B"):
-#                 yield path
-
-#     def next(self):
-#         ## Return URI dictionary to Builder
-#         try:
-#             uri = self.getNextUri()
-#             print(uri['path'])
-#             return uri
-#         except StopIteration:
-#             print("Returninmg empty dict")
-#             return None
-       
-
-#     def getNextUri(self):
-#         self.curPath = next(self.pathGenerator)
-#         curTag = self.utils.getTag(self.curPath)
-#         productName = self.utils.getProductName(self.curPath)
-        
-#         #If the tag or productName was not found in the metadata file or there was some exception raised, we move on to the next item
-#         if curTag is None or productName is None:
-#             return self.getNextUri()
-
-#         uri = {
-#                 'path': self.curPath,
-#                 'displayName': os.path.basename(self.curPath),
-#                 'tag': curTag,
-#                 'groupName': os.path.split(os.path.dirname(self.curPath))[1],
-#                 'productName': productName,
-#                 'metadata': self.currentPath
-#             }
-#         return uri
-
-
-
-@lru_cache(maxsize=128)
-def cacheElementTree(path):
-        try:
-            tree = ET.parse(path)
-        except ET.ParseError as e:
-            print("Exception while parsing {0}\n{1}".format(path,e))
+class Sentinel2TileCrawler():
+    """ Streams the itemURIs of the tiles under the crawled paths. A path can be a tile folder, its metadata.xml,
+        a folder searched for tiles (recursively if recurse) or a .txt tile list with one metadata.xml path per line.
+        Tile roots are recognised by file names (metadata.xml next to tileInfo.json) and the root tag of metadata.xml,
+        band folders are never entered. The TileMetadata of the next prefetchCount tiles is read on a background
+        thread while ArcGIS builds the current one. """
+
+    tag = None
+    prefetchCount = 8
+    tileDirectories = ('r10m', 'r20m', 'r60m', 'qi', 'auxiliary')
+
+    def __init__(self, **crawlerProperties):
+        self.utils = Utilities()
+        self.paths = crawlerProperties['paths']
+        if isinstance(self.paths, str):
+            self.paths = [self.paths]
+        self.recurse = crawlerProperties.get('recurse', True)
+        self.pathGenerator = self.createGenerator()
+        self.prefetcher = ThreadPoolExecutor(1)
+        self.prefetched = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        uri = self.next()
+        if uri is None:
+            raise StopIteration
+        return uri
+
+    #this is a generator function
+    def createGenerator(self):
+        for p in self.paths:
+            if os.path.isdir(p):
+                for tile in self.findTiles(p):
+                    yield tile
+            elif p.lower().endswith('.txt'):
+                folder = os.path.dirname(p)
+                with open(p, 'r') as f:
+                    for line in f:
+                        line = line.strip()
+                        if line and not line.startswith('#'):
+                            yield os.path.join(folder, line)
+            elif os.path.basename(p).lower() == 'metadata.xml':
+                yield p
+
+    def findTiles(self, folder):
+        stack = [folder]
+        while stack:
+            metadata = None
+            hasTileInfo = False
+            subdirs = []
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        name = entry.name.lower()
+                        if entry.is_dir(follow_symlinks=False):
+                            if name not in self.tileDirectories:
+                                subdirs.append(entry.path)
+                        elif name == 'metadata.xml':
+                            metadata = entry.path
+                        elif name == 'tileinfo.json':
+                            hasTileInfo = True
+            except OSError:
+                continue
+            if metadata and hasTileInfo:
+                yield metadata
+            if self.recurse:
+                stack.extend(reversed(subdirs))
+
+    def prefetch(self):
+        while len(self.prefetched) < self.prefetchCount:
+            try:
+                path = next(self.pathGenerator)
+            except StopIteration:
+                break
+            self.prefetched.append((path, self.prefetcher.submit(self.readTile, path)))
+
+    def readTile(self, path):
+        # reads the root tag only, the full metadata is parsed for S2 tiles only
+        if not self.utils.isS2Tile(path):
             return None
+        return TileMetadata.get(path)
 
-        return tree
+    def next(self):
+        ## Return URI dictionary to Builder
+        try:
+            uri = self.getNextUri()
+            return uri
+        except StopIteration:
+            self.prefetcher.shutdown(wait=False)
+            return None
 
-#Using the default crawler as there is only Panchromatic band
+    def getNextUri(self):
+        while True:
+            self.prefetch()
+            if not self.prefetched:
+                raise StopIteration
+            path, future = self.prefetched.popleft()
+            try:
+                metadata = future.result()
+            except Exception as e:
+                print("Exception while reading {0}\n{1}".format(path, e))
+                continue
+            #If the file is not a S2 tile or the productName was not found we move on to the next item
+            if metadata is None or metadata.productName is None:
+                continue
+            return {
+                    'path': path,
+                    'displayName': metadata.displayName,
+                    'tag': self.tag,
+                    'groupName': metadata.groupName,
+                    'productName': metadata.productName
+                }
 
 
+class Sentinel2Tile10mCrawler(Sentinel2TileCrawler):
+    tag = '10m'
+
+class Sentinel2Tile20mCrawler(Sentinel2TileCrawler):
+    tag = '20m'
+
+
+
+class ParseCache(object):
+    """ LRU cache of values parsed from files, bounded by the estimated size of the cached values in bytes (maxBytes).
+        An entry is dropped as soon as the size or mtime of its file changes, parse errors are never cached.
+        Counters of hits, misses, evictions and invalidations are returned by stats(). """
+
+    def __init__(self, maxBytes=64*1024*1024):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, loader, sizeOf=None):
+        """ Returns loader(path), cached. sizeOf(value) estimates the memory held by the value, by default the file size is used. """
+        st = os.stat(path)
+        key = (path, loader)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == (st.st_size, st.st_mtime):
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return entry[1]
+                self.invalidations += 1
+                self.remove(key)
+            self.misses += 1
+
+        value = loader(path)
+        size = sizeOf(value) if sizeOf else st.st_size
+        if size <= self.maxBytes:
+            with self.lock:
+                self.remove(key)
+                self.entries[key] = ((st.st_size, st.st_mtime), value, size)
+                self.bytes += size
+                self.shrink()
+        return value
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def shrink(self):
+        while self.bytes > self.maxBytes and self.entries:
+            key, entry = self.entries.popitem(last=False)
+            self.bytes -= entry[2]
+            self.evictions += 1
+
+    def resize(self, maxBytes):
+        with self.lock:
+            self.maxBytes = maxBytes
+            self.shrink()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'invalidations': self.invalidations,
+                'entries': len(self.entries), 'bytes': self.bytes, 'maxBytes': self.maxBytes}
+
+parseCache = ParseCache()
+
+def tileNamespaces(root):
+    """ Namespaces for find() on a metadata.xml element tree, nx is the namespace of the root tag (psd-12 or psd-14) """
+    return {'nx': root.tag[1:].split('}')[0] if root.tag.startswith('{') else ''}
+
+# the same as readTileHeader of SentinelImporter.py, the raster type is installed without it
+def readTileHeader(path, fields=('tag',), tailBytes=16384, chunkSize=4096):
+    """ Reads only as much of a metadata.xml as the fields need, without building the tree. fields are any of
+        tag, namespace (root element), SENSING_TIME, HORIZONTAL_CS_CODE (read from the head of the file, the reading
+        stops before the angle grids) and CLOUD_COVERAGE_PERCENTAGE, VEGETATION_PERCENTAGE (Quality_Indicators_Info
+        is at the end of the file, they are looked up in its last tailBytes first).
+        path can also be a binary file object (e.g. io.BytesIO of a downloaded file).
+        Returns a dict of the found values (element texts). """
+    values = {}
+    wanted = set(fields)
+    with (open(path, 'rb') if isinstance(path, str) else path) as f:
+        tailFields = wanted.intersection(('CLOUD_COVERAGE_PERCENTAGE', 'VEGETATION_PERCENTAGE'))
+        if tailFields:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - tailBytes))
+            tail = f.read().decode('utf-8', 'replace')
+            for name in tailFields:
+                match = re.search('<{0}>([^<]*)</{0}>'.format(name), tail)
+                if match:
+                    values[name] = match.group(1).strip()
+                    wanted.discard(name)
+            f.seek(0)
+
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        while wanted:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    if 'tag' not in values:
+                        values['tag'] = elem.tag
+                        values['namespace'] = elem.tag[1:].split('}')[0] if elem.tag.startswith('{') else ''
+                        wanted.discard('tag')
+                        wanted.discard('namespace')
+                elif elem.tag in wanted:
+                    values[elem.tag] = elem.text.strip() if elem.text else elem.text
+                    wanted.discard(elem.tag)
+                else:
+                    elem.clear()
+    return values
+
+def readRootTag(path):
+    return readTileHeader(path, ('tag',)).get('tag')
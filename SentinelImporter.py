@@ -1,33 +1,86 @@
 import arcpy
 import datetime
+import importlib.util
+import json
 import os
-from functools import lru_cache
+import re
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 try:
     import xml.etree.cElementTree as ET
 except ImportError:
     import xml.etree.ElementTree as ET
 
+import UtmTransform
+
 class CloudMask(object):
     ns = {"eop": "http://www.opengis.net/eop/2.0", "gml": "http://www.opengis.net/gml/3.2"}
 
+    @classmethod
+    def iterMaskRecords(cls, maskGmlFile):
+        """ Streams (Id, Type, Tile, Timestamp, wkid, coords) records from a MSK_CLOUDS_B00.gml file.
+            coords is a flat array('i') of x, y pairs of the exterior ring. Every MaskFeature element is
+            dropped from the tree as soon as it is consumed, so memory does not grow with the mask size. """
+        gmlId = "{" + cls.ns["gml"] + "}id"
+        envelopeTag = "{" + cls.ns["gml"] + "}Envelope"
+        posListTag = "{" + cls.ns["gml"] + "}posList"
+        exteriorTag = "{" + cls.ns["gml"] + "}exterior"
+        maskTypeTag = "{" + cls.ns["eop"] + "}maskType"
+        featureTag = "{" + cls.ns["eop"] + "}MaskFeature"
+
+        wkid = tile = ts = ftype = coords = None
+        stack = []
+        for event, elem in ET.iterparse(maskGmlFile, events=("start", "end")):
+            if event == "start":
+                if not stack:
+                    rids = elem.attrib[gmlId].split("_")
+                    ts = datetime.datetime.strptime(rids[6], '%Y%m%dT%H%M%S')
+                    tile = rids[8]
+                stack.append(elem)
+                continue
+            stack.pop()
+            # only the ring of gml:exterior/gml:LinearRing, the holes (gml:interior) are left out
+            if elem.tag == posListTag and len(stack) > 1 and stack[-2].tag == exteriorTag:
+                coords = array("i", map(int, elem.text.split()))
+            elif elem.tag == maskTypeTag:
+                ftype = elem.text
+            elif elem.tag == envelopeTag:
+                wkid = int(elem.attrib["srsName"].split(":")[-1])
+            elif elem.tag == featureTag:
+                yield (elem.attrib[gmlId], ftype, tile, ts, wkid, coords)
+                ftype = coords = None
+                stack[-1].remove(elem)
+
+    @classmethod
+    def toPolygon(cls, coords, spatialReference):
+        """ Builds a polygon straight from a flat coordinate buffer (via WKB, no arcpy.Point per vertex).
+            coords can also be a list of such buffers, the exterior ring followed by the holes (see MaskSimplifier). """
+        rings = coords if isinstance(coords, list) else [coords]
+        wkb = struct.pack("=BII", 1 if sys.byteorder == "little" else 0, 3, len(rings))
+        wkb += b"".join(struct.pack("=I", len(ring)//2) + array("d", ring).tobytes() for ring in rings)
+        return arcpy.FromWKB(bytearray(wkb), spatialReference)
+
+    @classmethod
+    def featuresFromRecords(cls, records):
+        """ Turns records of iterMaskRecords into (Id, Type, Tile, Timestamp, Polygon) tuples. """
+        for fid, ftype, tile, ts, wkid, coords in records:
+            yield (fid, ftype, tile, ts, cls.toPolygon(coords, UtmTransform.spatialReference(wkid)))
+
+    @classmethod
+    def iterFeatures(cls, maskGmlFile):
+        """ Generator version of parseFeatures, yields (Id, Type, Tile, Timestamp, Polygon) tuples one by one. """
+        return cls.featuresFromRecords(cls.iterMaskRecords(maskGmlFile))
+
     @classmethod
     def parseFeatures(cls, maskGmlFile):
-        tree = cacheElementTree(maskGmlFile)
-        wkid = tree.find('./gml:boundedBy/gml:Envelope', cls.ns).attrib["srsName"].split(":")[-1]
-        rids = tree.getroot().attrib["{"+cls.ns["gml"]+"}id"].split("_")
-        ts = datetime.datetime.strptime(rids[6], '%Y%m%dT%H%M%S')
-        tile = rids[8]
-        features = []
-        maskFeatures = tree.findall('.//eop:MaskFeature', cls.ns)
-        for feature in maskFeatures:
-            fid = (feature.attrib["{"+cls.ns["gml"]+"}id"])
-            ftype = feature.find("eop:maskType", cls.ns).text
-            parray = feature.find("eop:extentOf/gml:Polygon/gml:exterior/gml:LinearRing/gml:posList", cls.ns).text
-            coords = [int(coor) for coor in parray.split(" ")]
-            points = [[coords[2*i], coords[2*i+1]] for i in range(len(coords)//2)]
-            shape = arcpy.Polygon(arcpy.Array([arcpy.Point(*pc) for pc in points]), arcpy.SpatialReference(int(wkid)))
-            features.append((fid, ftype, tile, ts, shape))
-        return features
+        return list(cls.iterFeatures(maskGmlFile))
 
     @classmethod
     def createFeatureClass(cls, workspace, fcname, spatialReference):
@@ -43,19 +96,558 @@ class CloudMask(object):
     @classmethod
     def insertFeatures(cls, features, outputFC):
         """ A polygon featureclass with attributes Id[Text(20)], Type[Text(20)], Tile[Text(20)], Timestamp[Date], Shape[Polygon] is expected in outputFC """
-        outSR = arcpy.Describe(outputFC).spatialReference
+        with CloudMaskWriter(outputFC) as writer:
+            writer.write(features)
+
+    @classmethod
+    def appendFeatures(cls, maskGmlFile, outputFeatureClass):
+        cls.insertFeatures(cls.iterFeatures(maskGmlFile), outputFeatureClass)
+
+    @classmethod
+    def deleteFeatures(cls, maskGmlFile, outputFC):
+        """ Deletes the features of the mask (same Tile and Timestamp) from outputFC, e.g. the leftovers of an interrupted import. """
+        for event, elem in ET.iterparse(maskGmlFile, events=("start",)):
+            rids = elem.attrib["{"+cls.ns["gml"]+"}id"].split("_")
+            break
+        ts = datetime.datetime.strptime(rids[6], '%Y%m%dT%H%M%S')
+        with arcpy.da.UpdateCursor(outputFC, ["Timestamp"], "Tile = '{0}'".format(rids[8])) as ucur:
+            for row in ucur:
+                if row[0] == ts:
+                    ucur.deleteRow()
+
+class CloudMaskWriter(object):
+    """ Buffered writer of (Id, Type, Tile, Timestamp, Polygon) features to a cloud mask featureclass. The spatial reference
+        of the featureclass is described once and the features of many tiles are inserted in batches of batchSize
+        through one insert cursor which stays open until close (or the end of the with block).
+        With a MaskSimplifier the mask records passed to writeRecords are simplified (and merged) before the insert,
+        with an AreaOfInterest only the mask polygons intersecting it are inserted.
+        flushListeners are called after every flush which wrote rows, e.g. to record the tiles written so far. """
 
-        with arcpy.da.InsertCursor(outputFC, ["Id", "Type","Tile", "Timestamp", "Shape@"]) as icur:
+    def __init__(self, outputFC, batchSize=5000, metrics=None, simplifier=None, aoi=None):
+        self.outputFC = outputFC
+        self.batchSize = batchSize
+        self.metrics = metrics
+        self.simplifier = simplifier
+        self.aoi = aoi
+        self.spatialReference = arcpy.Describe(outputFC).spatialReference
+        self.cursor = None
+        self.buffer = []
+        self.flushListeners = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, features):
+        """ Buffers the features of one tile, if they fail to parse none of the still buffered ones is written. """
+        start = len(self.buffer)
+        projected = 0
+        projectSeconds = 0.0
+        try:
             for feature in features:
                 geom = feature[4]
-                if outSR.factoryCode != geom.spatialReference.factoryCode:
-                    geom.projectAs(outSR)
-                icur.insertRow((feature[0], feature[1], feature[2], feature[3], geom))
+                if self.spatialReference.factoryCode != geom.spatialReference.factoryCode:
+                    projectStart = time.perf_counter()
+                    geom = geom.projectAs(self.spatialReference)
+                    projectSeconds += time.perf_counter() - projectStart
+                    projected += 1
+                self.buffer.append((feature[0], feature[1], feature[2], feature[3], geom))
+                if len(self.buffer) >= self.batchSize:
+                    self.flush()
+                    start = 0
+        except Exception:
+            del self.buffer[start:]
+            raise
+        finally:
+            if self.metrics and projected:
+                self.metrics.record("reproject", projectSeconds, items=projected)
+
+    def writeRecords(self, records, simplified=None):
+        """ Buffers the mask records of one tile (see CloudMask.iterMaskRecords), simplified first if the writer has a simplifier.
+            simplified is the (records, stats) pair of a tile already simplified in a worker process (see prepareTile). """
+        if simplified is not None:
+            records, stats = simplified
+            for key, value in stats.items():
+                self.simplifier.stats[key] += value
+        elif self.simplifier:
+            start = time.perf_counter()
+            records = self.simplifier.apply(records)
+            if self.metrics:
+                self.metrics.record("simplify", time.perf_counter() - start, items=len(records))
+        # the polygons in other UTM zones are transformed together as coordinate arrays, projectAs only for other systems
+        start = time.perf_counter()
+        records, transformed = UtmTransform.transformRecords(records, self.spatialReference.factoryCode)
+        if self.metrics and transformed:
+            self.metrics.record("reproject", time.perf_counter() - start, items=transformed)
+        if self.aoi:
+            self.write(self.aoi.filterFeatures(CloudMask.featuresFromRecords(self.aoi.filterRecords(records))))
+        else:
+            self.write(CloudMask.featuresFromRecords(records))
+
+    def flush(self):
+        if not self.buffer:
+            return
+        start = time.perf_counter()
+        if self.cursor is None:
+            self.cursor = arcpy.da.InsertCursor(self.outputFC, ["Id", "Type","Tile", "Timestamp", "Shape@"])
+        for row in self.buffer:
+            self.cursor.insertRow(row)
+        if self.metrics:
+            self.metrics.record("insert", time.perf_counter() - start, items=len(self.buffer))
+        self.buffer = []
+        for listener in self.flushListeners:
+            listener()
+
+    def release(self):
+        """ Writes the buffer and closes the cursor (to release the lock on the featureclass). """
+        self.flush()
+        if self.cursor is not None:
+            del self.cursor
+            self.cursor = None
+
+    def close(self):
+        self.release()
+
+class AreaOfInterest(object):
+    """ Area of interest of an import, a polygon or a featureclass (the union of its polygons). Tiles are tested against it
+        by the bounding box of their footprint (tileDataGeometry of tileInfo.json) first and then exactly, before anything
+        else is read. With clipCloudMasks the cloud mask polygons outside of it are skipped too.
+        The area is projected once per coordinate system of the tiles. """
+
+    def __init__(self, aoi, clipCloudMasks=False):
+        if isinstance(aoi, str):
+            geometry = None
+            with arcpy.da.SearchCursor(aoi, ["SHAPE@"]) as scur:
+                for row in scur:
+                    geometry = row[0] if geometry is None else geometry.union(row[0])
+            if geometry is None:
+                raise ValueError("No area of interest in {0}".format(aoi))
+            aoi = geometry
+        self.geometry = aoi
+        self.clipCloudMasks = clipCloudMasks
+        self.projected = {}
+        self.skippedTiles = []
+        self.skippedFeatures = 0
+
+    def inWkid(self, wkid):
+        """ (geometry, (xmin, ymin, xmax, ymax)) of the area in wkid """
+        if wkid not in self.projected:
+            geometry = self.geometry
+            if geometry.spatialReference.factoryCode != wkid:
+                geometry = geometry.projectAs(UtmTransform.spatialReference(wkid))
+            extent = geometry.extent
+            self.projected[wkid] = (geometry, (extent.XMin, extent.YMin, extent.XMax, extent.YMax))
+        return self.projected[wkid]
+
+    def touches(self, wkid, xmin, ymin, xmax, ymax):
+        """ True if the bounding box (in wkid) intersects the extent of the area """
+        bbox = self.inWkid(wkid)[1]
+        return xmin <= bbox[2] and xmax >= bbox[0] and ymin <= bbox[3] and ymax >= bbox[1]
+
+    def intersectsTile(self, tileMetadataPath):
+        """ True if the footprint of the tile intersects the area, also if the tile has no footprint to test """
+        try:
+            with open(os.path.join(os.path.dirname(tileMetadataPath), "tileInfo.json"), "r") as f:
+                geometry = json.load(f)["tileDataGeometry"]
+            wkid = int(geometry["crs"]["properties"]["name"].split(":")[-1])
+            rings = geometry["coordinates"] if geometry["type"] == "Polygon" else None
+        except (OSError, ValueError, KeyError, TypeError):
+            return True
+        if not rings:
+            return True
+        xs = [p[0] for p in rings[0]]
+        ys = [p[1] for p in rings[0]]
+        if not self.touches(wkid, min(xs), min(ys), max(xs), max(ys)):
+            return False
+        footprint = CloudMask.toPolygon([array("d", [v for p in ring for v in p]) for ring in rings], UtmTransform.spatialReference(wkid))
+        return not self.inWkid(wkid)[0].disjoint(footprint)
+
+    def filterTiles(self, tiles):
+        """ Yields the tiles intersecting the area, the others are appended to skippedTiles """
+        for tile in tiles:
+            if self.intersectsTile(tile):
+                yield tile
+            else:
+                self.skippedTiles.append(tile)
+
+    def filterRecords(self, records):
+        """ Yields the cloud mask records (see CloudMask.iterMaskRecords) whose exterior ring's bounding box touches the area """
+        for record in records:
+            coords = record[5][0] if isinstance(record[5], list) else record[5]
+            xs, ys = coords[0::2], coords[1::2]
+            if len(xs) and self.touches(record[4], min(xs), min(ys), max(xs), max(ys)):
+                yield record
+            else:
+                self.skippedFeatures += 1
+
+    def filterFeatures(self, features):
+        """ Yields the (Id, Type, Tile, Timestamp, Polygon) features intersecting the area """
+        for feature in features:
+            if self.inWkid(feature[4].spatialReference.factoryCode)[0].disjoint(feature[4]):
+                self.skippedFeatures += 1
+            else:
+                yield feature
+
+class BaselineFilter(object):
+    """ Keeps one tile per acquisition: tiles of the same MGRS tile (utmZone, latitudeBand and gridSquare of tileInfo.json)
+        and SENSING_TIME (to the second) are the same acquisition, e.g. reprocessed with a newer processing baseline or
+        the psd-12 and psd-14 metadata of a tile. rule(entry) ranks the tiles of an acquisition, the highest one is kept
+        (of equally ranked tiles the one with the greatest path, so the choice doesn't depend on the order of tiles).
+        An entry is a dict with
+            path, tile, sensingTime, productName
+            baseline        - processing baseline (e.g. 2.06 from N0206 of productName or N02.06 of TILE_ID), 0 if unknown
+            generationTime  - the last date of productName (e.g. 20180101T120710), "" if unknown
+            psd             - version of the metadata format from the namespace of metadata.xml (12, 14), 0 if unknown
+        The default rule is newestBaseline, see also latestGeneration and newestPsd.
+        Only tileInfo.json and the head of metadata.xml are read (or the columns of a TileCatalog), so it is a cheap
+        pass before anything is added. The skipped tiles are kept in skipped as (skipped tile, kept tile) pairs. """
+
+    def __init__(self, rule=None, threads=None):
+        self.rule = rule or BaselineFilter.newestBaseline
+        self.threads = threads
+        self.skipped = []
+
+    @staticmethod
+    def newestBaseline(entry):
+        return (entry["baseline"], entry["generationTime"], entry["psd"])
+
+    @staticmethod
+    def latestGeneration(entry):
+        return (entry["generationTime"], entry["baseline"], entry["psd"])
+
+    @staticmethod
+    def newestPsd(entry):
+        return (entry["psd"], entry["baseline"], entry["generationTime"])
 
     @classmethod
-    def appendFeatures(cls, maskGmlFile, outputFeatureClass):
-        features = cls.parseFeatures(maskGmlFile)
-        cls.insertFeatures(features, outputFeatureClass)
+    def entry(cls, path, tile, sensingTime, productName, namespace="", tileId="", psd=0):
+        match = re.search(r"_N(\d\d)(\d\d)_", productName or "") or re.search(r"_N(\d\d)\.(\d\d)", tileId or "")
+        baseline = int(match.group(1)) + int(match.group(2))/100.0 if match else 0.0
+        match = re.search(r"_(\d{8}T\d{6})$", productName or "")
+        generationTime = match.group(1) if match else ""
+        match = re.search(r"psd-(\d+)", namespace or "")
+        psd = int(match.group(1)) if match else psd
+        return {"path": path, "tile": tile, "sensingTime": (sensingTime or "")[:19], "productName": productName,
+                "baseline": baseline, "generationTime": generationTime, "psd": psd}
+
+    @classmethod
+    def readEntry(cls, tileMetadataPath):
+        """ The entry of a tile from its tileInfo.json and the head of its metadata.xml, None if they can't be read """
+        try:
+            with open(os.path.join(os.path.dirname(tileMetadataPath), "tileInfo.json"), "r") as f:
+                tileInfo = json.load(f)
+            header = readTileHeader(tileMetadataPath, ("namespace", "TILE_ID", "SENSING_TIME"))
+        except (OSError, ValueError, ET.ParseError):
+            return None
+        tile = "T{0}{1}{2}".format(tileInfo.get("utmZone", ""), tileInfo.get("latitudeBand", ""), tileInfo.get("gridSquare", ""))
+        return cls.entry(tileMetadataPath, tile, header.get("SENSING_TIME"), tileInfo.get("productName"),
+                         header.get("namespace"), header.get("TILE_ID"))
+
+    def readEntries(self, tiles, catalog=None):
+        rows = {path: i for i, path in enumerate(catalog["path"])} if catalog is not None else {}
+        entries = [None]*len(tiles)
+        unread = []
+        for n, tile in enumerate(tiles):
+            i = rows.get(tile)
+            if i is None:
+                unread.append(n)
+            else:
+                sensingTime = str(catalog["sensingTime"][i])
+                entries[n] = self.entry(tile, str(catalog["tile"][i]), None if sensingTime == "NaT" else sensingTime,
+                                        str(catalog["productName"][i]), psd=int(catalog["psd"][i]))
+        if self.threads and self.threads > 1:
+            with ThreadPoolExecutor(self.threads) as pool:
+                for n, entry in zip(unread, pool.map(self.readEntry, [tiles[n] for n in unread])):
+                    entries[n] = entry
+        else:
+            for n in unread:
+                entries[n] = self.readEntry(tiles[n])
+        return entries
+
+    def apply(self, tiles, catalog=None):
+        """ Returns the tiles (in their order) without the duplicates of an acquisition, reports the skipped ones.
+            With a TileCatalog the entries of the tiles in it are taken from its columns. Tiles which can't be read are
+            kept, adding them reports the error. """
+        tiles = list(tiles)
+        best = {}
+        keys = []
+        for n, entry in enumerate(self.readEntries(tiles, catalog)):
+            key = (entry["tile"], entry["sensingTime"]) if entry and entry["sensingTime"] else None
+            keys.append(key)
+            if key is not None and (key not in best or (self.rule(entry), entry["path"]) > (self.rule(best[key][1]), best[key][1]["path"])):
+                best[key] = (n, entry)
+        kept = []
+        for n, (tile, key) in enumerate(zip(tiles, keys)):
+            if key is None or best[key][0] == n:
+                kept.append(tile)
+            else:
+                self.skipped.append((tile, best[key][1]["path"]))
+                print("Tile {0} skipped, same acquisition as {1}.".format(tile, best[key][1]["path"]))
+        if self.skipped:
+            print("{0} duplicate tiles skipped.".format(len(self.skipped)))
+        return kept
+
+class IngestMetrics(object):
+    """ Durations, byte counts and failure reasons of an import, per tile and stage. Every measurement is an event (a dict)
+        written as a JSON line to eventsPath (if given) and passed to each of hooks. finish() adds a summary with the
+        p50/p95/max duration of every stage, the hits and misses of the watched caches (see watchCache) and the feature
+        and vertex counts of a watched MaskSimplifier (see watchSimplifier), and passes its lines to report.
+        The stages of addTiles are:
+            deduplicate - finding the tiles of the same acquisition before the import (see BaselineFilter)
+            discovery   - finding the next tile (including the area of interest test and the manifest check)
+            prepare     - waiting for the tile prepared in a worker process
+            addRasters  - AddRastersToMosaicDataset of a tile or a batch of tiles
+            cloudMask   - parsing, reprojecting and buffering the cloud mask of a tile (inserts included)
+            reproject   - transforming the cloud mask polygons in another coordinate system (projectAs outside WGS84 / UTM)
+            insert      - writing a batch of cloud mask features through the insert cursor
+            simplify    - simplifying and merging the cloud mask polygons of a tile (see MaskSimplifier)
+            cloudIndex  - adding the footprint and cloud mask polygons of a tile to a CloudIndex """
+
+    def __init__(self, eventsPath=None, hooks=(), report=print):
+        self.events = open(eventsPath, "a") if eventsPath else None
+        self.hooks = list(hooks)
+        self.report = report
+        self.durations = {}
+        self.bytes = {}
+        self.items = {}
+        self.added = 0
+        self.failures = []
+        self.caches = OrderedDict()
+        self.simplifier = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.events:
+            self.events.close()
+            self.events = None
+
+    def emit(self, event):
+        event["time"] = datetime.datetime.now().isoformat()
+        with self.lock:
+            if self.events:
+                self.events.write(json.dumps(event) + "\n")
+        for hook in self.hooks:
+            hook(event)
+
+    def record(self, stage, seconds, tile=None, size=None, items=None):
+        with self.lock:
+            self.durations.setdefault(stage, []).append(seconds)
+            self.bytes[stage] = self.bytes.get(stage, 0) + (size or 0)
+            self.items[stage] = self.items.get(stage, 0) + (items or 0)
+        event = {"event": "stage", "stage": stage, "seconds": seconds}
+        if tile is not None:
+            event["tile"] = tile
+        if size is not None:
+            event["bytes"] = size
+        if items is not None:
+            event["items"] = items
+        self.emit(event)
+
+    @contextmanager
+    def stage(self, stage, tile=None, size=None, items=None):
+        """ Records the duration of the with block, also if it raises. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, tile, size, items)
+
+    def timed(self, stage, items):
+        """ Yields items recording the time spent waiting for each of them. """
+        iterator = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(stage, time.perf_counter() - start, item)
+            yield item
+
+    def watchCache(self, name, stats, fromZero=False):
+        """ Reports the cache in the summary, stats() returns its counters (hits, misses and optionally evictions,
+            invalidations) and sizes like ParseCache.stats. The counters are reported as counted since the first
+            watchCache of name, or since they started with fromZero. """
+        if name not in self.caches:
+            self.caches[name] = (stats, {} if fromZero else stats())
+
+    cacheCounters = ("hits", "misses", "evictions", "invalidations")
+
+    def watchSimplifier(self, simplifier):
+        """ Reports the features and vertices of the cloud masks simplified from now on by simplifier in the summary """
+        if self.simplifier is None:
+            self.simplifier = (simplifier, dict(simplifier.stats))
+
+    def tileAdded(self, tile, resolution):
+        self.added += 1
+        self.emit({"event": "added", "tile": tile, "resolution": resolution})
+
+    def tileFailed(self, tile, resolution, error):
+        failure = {"event": "failed", "tile": tile, "resolution": resolution, "error": str(error), "type": type(error).__name__}
+        self.failures.append(failure)
+        self.emit(dict(failure))
+
+    @staticmethod
+    def fileSize(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def percentile(values, q):
+        """ Nearest rank percentile of sorted values """
+        return values[min(len(values) - 1, max(0, int(round(q/100.0*len(values))) - 1))]
+
+    def summary(self):
+        stages = OrderedDict()
+        with self.lock:
+            for stage, durations in self.durations.items():
+                durations = sorted(durations)
+                stages[stage] = {"count": len(durations), "seconds": sum(durations), "p50": self.percentile(durations, 50),
+                                 "p95": self.percentile(durations, 95), "max": durations[-1],
+                                 "bytes": self.bytes[stage], "items": self.items[stage]}
+        reasons = {}
+        for failure in self.failures:
+            reason = "{0}: {1}".format(failure["type"], failure["error"].strip().split("\n")[0][:100])
+            reasons[reason] = reasons.get(reason, 0) + 1
+        caches = OrderedDict()
+        for name, (stats, start) in list(self.caches.items()):
+            caches[name] = stats()
+            for counter in self.cacheCounters:
+                if counter in caches[name]:
+                    caches[name][counter] -= start.get(counter, 0)
+        summary = {"event": "summary", "added": self.added, "failed": len(self.failures), "failureReasons": reasons,
+                   "stages": stages, "caches": caches}
+        if self.simplifier is not None:
+            simplifier, start = self.simplifier
+            summary["simplified"] = dict((key, value - start.get(key, 0)) for key, value in simplifier.stats.items())
+        return summary
+
+    def summaryLines(self, summary=None):
+        summary = summary or self.summary()
+        lines = ["{0} tiles added, {1} failed.".format(summary["added"], summary["failed"])]
+        lines.extend("  {0} x {1}".format(count, reason) for reason, count in sorted(summary["failureReasons"].items()))
+        lines.append("{0:<12} {1:>7} {2:>10} {3:>9} {4:>9} {5:>9} {6:>10}".format("stage", "count", "total s", "p50 ms", "p95 ms", "max ms", "MB"))
+        for stage, st in summary["stages"].items():
+            lines.append("{0:<12} {1:>7} {2:>10.2f} {3:>9.1f} {4:>9.1f} {5:>9.1f} {6:>10.1f}".format(stage, st["count"], st["seconds"],
+                         st["p50"]*1000, st["p95"]*1000, st["max"]*1000, st["bytes"]/1048576.0))
+        for name, cache in summary.get("caches", {}).items():
+            lines.append("{0} cache: {1}.".format(name, ", ".join("{0} {1}".format(cache[counter], counter)
+                                                                   for counter in self.cacheCounters if counter in cache)))
+        simplified = summary.get("simplified")
+        if simplified and simplified["tiles"]:
+            lines.append("Cloud masks of {0} tiles simplified: {1} -> {2} features, {3} -> {4} vertices ({5:.1f}x fewer).".format(
+                         simplified["tiles"], simplified["featuresIn"], simplified["featuresOut"], simplified["verticesIn"],
+                         simplified["verticesOut"], simplified["verticesIn"]/float(simplified["verticesOut"]) if simplified["verticesOut"] else 0.0))
+        return lines
+
+    def finish(self):
+        """ Emits the summary event, reports its lines and returns it. """
+        summary = self.summary()
+        self.emit(summary)
+        if self.report:
+            for line in self.summaryLines(summary):
+                self.report(line)
+        return summary
+
+class IngestManifest(object):
+    """ SQLite table of the tiles added to a mosaic dataset with their metadata.xml size/mtime, product name,
+        resolution and status (started | done | failed). Lets importTiles/addTiles skip unchanged tiles and resume
+        an interrupted import. """
+
+    def __init__(self, manifestPath):
+        self.path = manifestPath
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(manifestPath)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS tiles (path TEXT NOT NULL, resolution TEXT NOT NULL,
+                size INTEGER, mtime REAL, productName TEXT, status TEXT NOT NULL, message TEXT, updated TEXT,
+                PRIMARY KEY (path, resolution))""")
+        self.connection.commit()
+
+    @classmethod
+    def forMosaicDataset(cls, mosaicDSName):
+        """ Opens the manifest of the mosaic dataset, E:/Sentinel2.gdb/S2-10m uses E:/Sentinel2.gdb.S2-10m.sqlite """
+        workspace, name = os.path.split(mosaicDSName.rstrip("/\\"))
+        return cls(workspace + "." + name + ".sqlite")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def key(tileMetadataPath):
+        return os.path.normcase(os.path.abspath(tileMetadataPath))
+
+    def status(self, tileMetadataPath, resolution):
+        """ Returns the recorded status of the tile or None if it was never added. """
+        row = self.connection.execute("SELECT status FROM tiles WHERE path = ? AND resolution = ?",
+                (self.key(tileMetadataPath), resolution)).fetchone()
+        return row[0] if row else None
+
+    def isCurrent(self, tileMetadataPath, resolution):
+        """ True if the tile was added successfully and its metadata.xml did not change since then. """
+        row = self.connection.execute("SELECT size, mtime, status FROM tiles WHERE path = ? AND resolution = ?",
+                (self.key(tileMetadataPath), resolution)).fetchone()
+        if row is None or row[2] != "done":
+            return False
+        st = os.stat(tileMetadataPath)
+        return row[0] == st.st_size and row[1] == st.st_mtime
+
+    def pending(self, tiles, resolution):
+        """ Yields the tiles that are not current, i.e. new, changed, failed or interrupted ones.
+            resolution can be a list, then tiles current for all of the resolutions are skipped. """
+        resolutions = resolution if isinstance(resolution, (list, tuple)) else [resolution]
+        skipped = 0
+        for tile in tiles:
+            if all(self.isCurrent(tile, res) for res in resolutions):
+                skipped += 1
+                self.hits += 1
+            else:
+                self.misses += 1
+                yield tile
+        if skipped:
+            print("{0} unchanged tiles skipped.".format(skipped))
+
+    def stats(self):
+        """ hits are the tiles pending skipped as current, misses those it passed on """
+        return {"hits": self.hits, "misses": self.misses}
+
+    def begin(self, tileMetadataPath, resolution):
+        """ Records the tile as started and returns its previous status. """
+        previous = self.status(tileMetadataPath, resolution)
+        st = os.stat(tileMetadataPath)
+        self.connection.execute("""INSERT OR REPLACE INTO tiles (path, resolution, size, mtime, status, updated)
+                VALUES (?, ?, ?, ?, 'started', ?)""",
+                (self.key(tileMetadataPath), resolution, st.st_size, st.st_mtime, datetime.datetime.now().isoformat()))
+        self.connection.commit()
+        return previous
+
+    def done(self, tileMetadataPath, resolution, productName=None):
+        self.update(tileMetadataPath, resolution, "done", productName=productName)
+
+    def failed(self, tileMetadataPath, resolution, message=None):
+        self.update(tileMetadataPath, resolution, "failed", message=message)
+
+    def update(self, tileMetadataPath, resolution, status, productName=None, message=None):
+        self.connection.execute("""UPDATE tiles SET status = ?, productName = COALESCE(?, productName), message = ?, updated = ?
+                WHERE path = ? AND resolution = ?""",
+                (status, productName, message, datetime.datetime.now().isoformat(), self.key(tileMetadataPath), resolution))
+        self.connection.commit()
 
 class SentinelImporter(object):
 
@@ -80,51 +672,533 @@ class SentinelImporter(object):
         return workspace + "/" + mosaicDs
 
     @classmethod
-    def addTile(cls, mosaicDSName, tileMetadataPath, resolution="10m", cloudMaskFC=None):
+    def addTile(cls, mosaicDSName, tileMetadataPath, resolution="10m", cloudMaskFC=None, preparedTile=None, overwrite=False):
+        """ cloudMaskFC is a featureclass or a CloudMaskWriter shared by many tiles.
+            preparedTile is the result of prepareTile, if given the cloud mask is taken from it instead of parsing the GML again.
+            With overwrite the tile replaces the raster and cloud mask features added by a previous (interrupted) run. """
         res = "20mCloud" if resolution == "20c" else resolution
-        arcpy.management.AddRastersToMosaicDataset(mosaicDSName, "Sentinel-2-L2A-" + res + "Tile", tileMetadataPath)
+        if overwrite:
+            arcpy.management.AddRastersToMosaicDataset(mosaicDSName, "Sentinel-2-L2A-" + res + "Tile", tileMetadataPath,
+                    duplicate_items_action="OVERWRITE_DUPLICATES")
+        else:
+            arcpy.management.AddRastersToMosaicDataset(mosaicDSName, "Sentinel-2-L2A-" + res + "Tile", tileMetadataPath)
         if cloudMaskFC:
-            CloudMask.appendFeatures(os.path.join(tileMetadataPath[:-12], "qi", "MSK_CLOUDS_B00.gml"), cloudMaskFC)
+            cls.addCloudMask(tileMetadataPath, cloudMaskFC, preparedTile, overwrite)
         print("Tile {0} added.".format(tileMetadataPath))
 
     @classmethod
-    def listTiles(cls, tilesFolder):
-        tiles = []
-        for (dirpath, dirnames, filenames) in os.walk(tilesFolder):
-            for filename in filenames:
-                if filename.lower() == "metadata.xml":
-                    tiles.append(os.path.join(dirpath, filename))
-        return tiles
+    def addCloudMask(cls, tileMetadataPath, cloudMaskFC, preparedTile=None, overwrite=False):
+        """ Returns the mask records of the tile, read once for the insert and whoever needs them next (a CloudIndex). """
+        maskGmlFile = os.path.join(tileMetadataPath[:-12], "qi", "MSK_CLOUDS_B00.gml")
+        writer = cloudMaskFC if isinstance(cloudMaskFC, CloudMaskWriter) else CloudMaskWriter(cloudMaskFC)
+        try:
+            if overwrite:
+                writer.release()
+                CloudMask.deleteFeatures(maskGmlFile, writer.outputFC)
+            if preparedTile and preparedTile["maskRecords"] is not None:
+                maskRecords = preparedTile["maskRecords"]
+            else:
+                maskRecords = list(CloudMask.iterMaskRecords(maskGmlFile))
+            if preparedTile and preparedTile.get("simplifiedMask") is not None and writer.simplifier:
+                writer.writeRecords(None, preparedTile["simplifiedMask"])
+            else:
+                writer.writeRecords(maskRecords)
+            return maskRecords
+        finally:
+            if writer is not cloudMaskFC:
+                writer.close()
 
     @classmethod
-    def addTiles(cls, mosaicDSName, tiles, resolution="10m", cloudMaskFC=None):
-        processedTiles = []
-        failedTiles = []
-        for tile in tiles:
-            try:
+    def addRasterBatch(cls, mosaicDSName, tiles, resolution="10m"):
+        """ Adds the rasters of all tiles by one AddRastersToMosaicDataset call, without updating the cell size ranges
+            and the boundary (see maintainMosaicDataset). The raster type builds exactly one item per tile (see
+            Sentinel2TileBuilder.buildResolution), if the call fails or adds another number of items than there are tiles,
+            the items it added are removed again and both halves of tiles are retried, down to the single tiles that fail.
+            Returns the failed tiles as a list of (tile, reason). """
+        if not tiles:
+            return []
+        res = "20mCloud" if resolution == "20c" else resolution
+        oidField = arcpy.Describe(mosaicDSName).OIDFieldName
+        added = "{0} > {1}".format(oidField, cls.lastItemId(mosaicDSName, oidField))
+        try:
+            arcpy.management.AddRastersToMosaicDataset(mosaicDSName, "Sentinel-2-L2A-" + res + "Tile", list(tiles),
+                    "NO_CELL_SIZES", "NO_BOUNDARY")
+            addedCount = cls.countItems(mosaicDSName, added)
+            if addedCount == len(tiles):
+                return []
+            reason = "{0} items added for {1} tiles".format(addedCount, len(tiles))
+        except Exception as e:
+            reason = str(e)
+        if cls.countItems(mosaicDSName, added):
+            arcpy.management.RemoveRastersFromMosaicDataset(mosaicDSName, added)
+        if len(tiles) == 1:
+            return [(tiles[0], reason)]
+        half = len(tiles)//2
+        return cls.addRasterBatch(mosaicDSName, tiles[:half], resolution) + cls.addRasterBatch(mosaicDSName, tiles[half:], resolution)
+
+    @classmethod
+    def lastItemId(cls, mosaicDSName, oidField):
+        with arcpy.da.SearchCursor(mosaicDSName, ["OID@"], sql_clause=(None, "ORDER BY {0} DESC".format(oidField))) as scur:
+            for row in scur:
+                return row[0]
+        return 0
+
+    @classmethod
+    def countItems(cls, mosaicDSName, where):
+        with arcpy.da.SearchCursor(mosaicDSName, ["OID@"], where) as scur:
+            return sum(1 for row in scur)
+
+    @classmethod
+    def maintainMosaicDataset(cls, mosaicDSName, footprints=False, statistics=False, overviews=False):
+        """ The work deferred by batched adding: cell size ranges and boundary, optionally footprints, statistics and overviews. """
+        arcpy.management.CalculateCellSizeRanges(mosaicDSName)
+        if footprints:
+            arcpy.management.BuildFootprints(mosaicDSName)
+        arcpy.management.BuildBoundary(mosaicDSName)
+        if statistics:
+            arcpy.management.CalculateStatistics(mosaicDSName)
+        if overviews:
+            arcpy.management.BuildOverviews(mosaicDSName)
+        print("Mosaic dataset maintained.")
+
+    tileDirectories = ("r10m", "r20m", "r60m", "qi", "auxiliary")
+
+    @classmethod
+    def scanDirectory(cls, path):
+        """ Lists one directory and returns (path of metadata.xml or None, subdirectories to descend into).
+            Once the directory is a tile root (metadata.xml and tileInfo.json) its band folders are not entered. """
+        metadata = None
+        hasTileInfo = False
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    name = entry.name.lower()
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry)
+                    elif name == "metadata.xml":
+                        metadata = entry.path
+                    elif name == "tileinfo.json":
+                        hasTileInfo = True
+        except OSError:
+            return (None, [])
+        if metadata and hasTileInfo:
+            subdirs = [d for d in subdirs if d.name.lower() not in cls.tileDirectories]
+        return (metadata, [d.path for d in subdirs])
+
+    @classmethod
+    def iterTiles(cls, tilesFolder, threads=None):
+        """ Yields metadata.xml paths as they are found. With threads > 1 the directories are listed concurrently
+            (the order of the tiles is not deterministic then). """
+        if not threads or threads < 2:
+            stack = [tilesFolder]
+            while stack:
+                metadata, subdirs = cls.scanDirectory(stack.pop())
+                if metadata:
+                    yield metadata
+                stack.extend(reversed(subdirs))
+            return
+
+        with ThreadPoolExecutor(threads) as pool:
+            pending = {pool.submit(cls.scanDirectory, tilesFolder)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    metadata, subdirs = future.result()
+                    if metadata:
+                        yield metadata
+                    pending.update(pool.submit(cls.scanDirectory, d) for d in subdirs)
+
+    @classmethod
+    def listTiles(cls, tilesFolder, threads=None):
+        return list(cls.iterTiles(tilesFolder, threads))
+
+    @classmethod
+    def prepareTiles(cls, tiles, resolution="10m", withCloudMask=False, workers=None, simplifier=None):
+        """ Yields (tile, future) pairs in the order of tiles. With workers > 1 up to 2*workers tiles are prepared
+            ahead in a process pool (see prepareTile), otherwise future is None and nothing is prepared.
+            With a MaskSimplifier the cloud masks are simplified in the worker processes too. """
+        if not workers or workers < 2:
+            for tile in tiles:
+                yield (tile, None)
+            return
+
+        with ProcessPoolExecutor(workers) as pool:
+            pending = deque()
+            for tile in tiles:
+                pending.append((tile, pool.submit(prepareTile, tile, resolution, withCloudMask, simplifier)))
+                if len(pending) >= 2*workers:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+
+    @classmethod
+    def addTiles(cls, mosaicDSName, tiles, resolution="10m", cloudMaskFC=None, workers=None, manifest=None, batchSize=None,
+                 metrics=None, cloudIndex=None, aoi=None, deduplicate=None, maintenance=None):
+        """ The cloud mask features of all tiles go through one CloudMaskWriter, pass your own as cloudMaskFC to set its batchSize.
+            With workers=N the XML parsing and world file writing run in N worker processes while this process
+            stays the single writer of the geodatabase.
+            With an IngestManifest tiles added in a previous run and unchanged since are skipped, failed and
+            interrupted ones are added again replacing what they left in the mosaic dataset and cloud mask.
+            With batchSize=N the rasters of N tiles are added by one geoprocessing call (see addRasterBatch) and the
+            mosaic dataset is maintained once at the end (see maintainMosaicDataset), maintenance is a dict of its
+            options, e.g. maintenance={"statistics": True, "overviews": True}.
+            mosaicDSName can also be a dict {resolution: mosaic dataset}, e.g. {"10m": mds10, "20m": mds20, "20c": mds20c}
+            (resolution is ignored then). Each tile is read once for all of them and its cloud mask is inserted once,
+            processedTiles and failedTiles are returned as dicts {resolution: tiles} in that case.
+            With IngestMetrics the stages of every tile are timed and the summary is reported at the end.
+            With a CloudIndex the footprint and cloud mask polygons of every added tile are indexed too, from the
+            tileInfo.json and mask records already read for the import.
+            With an AreaOfInterest (or a polygon or featureclass) only the tiles intersecting it are added, the others
+            are skipped before any geoprocessing or parsing. If its clipCloudMasks is set, the cloud mask polygons
+            outside of it are skipped as well (set aoi of your own CloudMaskWriter for the same).
+            With deduplicate=True (or a BaselineFilter with its own rule) only the newest tile of every acquisition is
+            added, the duplicates are found by a pass over all tiles before anything is added. """
+        targets = list(mosaicDSName.items()) if isinstance(mosaicDSName, dict) else [(resolution, mosaicDSName)]
+        resolutions = [res for res, mds in targets]
+        processedTiles = {res: [] for res in resolutions}
+        failedTiles = {res: [] for res in resolutions}
+        batched = bool(batchSize and batchSize > 1)
+        if aoi is not None and not isinstance(aoi, AreaOfInterest):
+            aoi = AreaOfInterest(aoi)
+        if aoi is not None:
+            tiles = aoi.filterTiles(tiles)
+        if deduplicate:
+            start = time.perf_counter()
+            baselineFilter = deduplicate if isinstance(deduplicate, BaselineFilter) else BaselineFilter()
+            tiles = baselineFilter.apply(tiles)
+            if metrics:
+                metrics.record("deduplicate", time.perf_counter() - start, items=len(baselineFilter.skipped))
+        if manifest:
+            tiles = manifest.pending(tiles, resolutions)
+        reportMetrics = metrics is not None
+        metrics = metrics or IngestMetrics(report=None)
+        metrics.watchCache("spatialReference", UtmTransform.spatialReferenceStats)
+        if manifest:
+            metrics.watchCache("manifest", manifest.stats)
+        watchRasterTypeCache(metrics)
+        tiles = metrics.timed("discovery", tiles)
+        writer = cloudMaskFC
+        if cloudMaskFC and not isinstance(cloudMaskFC, CloudMaskWriter):
+            writer = CloudMaskWriter(cloudMaskFC, metrics=metrics, aoi=aoi if aoi is not None and aoi.clipCloudMasks else None)
+        # tiles are recorded as done in the manifest only once their cloud mask features left the writer's buffer,
+        # by the writer's next flush
+        unflushedTiles = []
+
+        def tilesFlushed():
+            cls.markDone(manifest, unflushedTiles)
+        if manifest and writer:
+            writer.flushListeners.append(tilesFlushed)
+        if writer and writer.simplifier:
+            metrics.watchSimplifier(writer.simplifier)
+        indexedTiles = set()
+
+        def tileAdded(tile, res, preparedTile):
+            processedTiles[res].append(tile)
+            metrics.tileAdded(tile, res)
+            if cloudIndex is not None and tile not in indexedTiles:
+                indexedTiles.add(tile)
+                try:
+                    with metrics.stage("cloudIndex", tile):
+                        cloudIndex.addTile(tile, preparedTile)
+                except Exception as e:
+                    print("Unable to index tile {0}\n{1}".format(tile, e))
+            if manifest:
+                unflushedTiles.append((tile, res, getProductName(tile, preparedTile)))
+                if not writer or not writer.buffer:
+                    cls.markDone(manifest, unflushedTiles)
+
+        def tileFailed(tile, res, e):
+            print("Unable to add tile {0} ({1})\n{2}".format(tile, res, e))
+            failedTiles[res].append(tile)
+            metrics.tileFailed(tile, res, e)
+            if manifest:
+                manifest.failed(tile, res, str(e))
+
+        try:
+            preparedTiles = cls.prepareTiles(tiles, resolutions if len(resolutions) > 1 else resolutions[0], cloudMaskFC is not None, workers,
+                                             writer.simplifier if writer else None)
+            for chunk in cls.chunks(preparedTiles, batchSize if batched else 1):
+                cls.addTileChunk(targets, chunk, writer, manifest, batched, tileAdded, tileFailed, metrics)
+            if writer:
+                writer.flush()
+        finally:
+            if writer is not cloudMaskFC:
+                writer.close()
+            if writer and tilesFlushed in writer.flushListeners:
+                writer.flushListeners.remove(tilesFlushed)
+            if cloudIndex is not None:
+                cloudIndex.flush()
+        if manifest:
+            cls.markDone(manifest, unflushedTiles)
+        if aoi is not None:
+            print("{0} tiles outside the area of interest skipped.".format(len(aoi.skippedTiles)))
+            if aoi.skippedFeatures:
+                print("{0} cloud mask features outside the area of interest skipped.".format(aoi.skippedFeatures))
+        if batched:
+            for res, mds in targets:
+                if processedTiles[res]:
+                    cls.maintainMosaicDataset(mds, **(maintenance or {}))
+        if reportMetrics:
+            # the raster type is loaded by the first AddRastersToMosaicDataset of the session
+            watchRasterTypeCache(metrics, fromZero=True)
+            metrics.finish()
+        if isinstance(mosaicDSName, dict):
+            return (processedTiles, failedTiles)
+        return (processedTiles[resolution], failedTiles[resolution])
+
+    @classmethod
+    def addTileChunk(cls, targets, chunk, cloudMaskFC, manifest, batched, tileAdded, tileFailed, metrics):
+        """ Adds a chunk of (tile, future) pairs of prepareTiles to the (resolution, mosaic dataset) targets and its cloud masks
+            to cloudMaskFC, reporting every tile and resolution to tileAdded or tileFailed. Batched chunks are added by
+            addRasterBatch, except for tiles touched by a previous run which replace their old items one by one. """
+        if batched:
+            print("Adding {0} tiles...".format(len(chunk)))
+        entries = []
+        for tile, future in chunk:
+            if not batched:
                 print("Adding tile {0}...".format(tile))
-                cls.addTile(mosaicDSName, tile, resolution, cloudMaskFC)
-                processedTiles.append(tile)
+            # overwrite holds the resolutions the tile is added to, and if it replaces items of a previous run there
+            overwrite = {}
+            try:
+                for res, mds in targets:
+                    if not manifest:
+                        overwrite[res] = False
+                    elif not manifest.isCurrent(tile, res):
+                        overwrite[res] = manifest.begin(tile, res) is not None
+                preparedTile = None
+                if future:
+                    with metrics.stage("prepare", tile):
+                        preparedTile = future.result()
+                entries.append((tile, preparedTile, overwrite))
+            except Exception as e:
+                for res in overwrite:
+                    tileFailed(tile, res, e)
+
+        added = {tile: [] for tile, preparedTile, overwrite in entries}
+        for res, mds in targets:
+            failed = {}
+            if batched:
+                batch = [tile for tile, preparedTile, overwrite in entries if overwrite.get(res) is False]
+                with metrics.stage("addRasters", size=sum(IngestMetrics.fileSize(tile) for tile in batch), items=len(batch)):
+                    failed = dict(cls.addRasterBatch(mds, batch, res))
+            for tile, preparedTile, overwrite in entries:
+                if res not in overwrite:
+                    continue
+                if tile in failed:
+                    tileFailed(tile, res, Exception(failed[tile]))
+                    continue
+                try:
+                    if overwrite[res] or not batched:
+                        with metrics.stage("addRasters", tile, IngestMetrics.fileSize(tile), 1):
+                            cls.addTile(mds, tile, res, None, preparedTile, overwrite[res])
+                    added[tile].append(res)
+                except Exception as e:
+                    tileFailed(tile, res, e)
+
+        for tile, preparedTile, overwrite in entries:
+            if not added[tile]:
+                continue
+            try:
+                # a tile already current for another resolution has its cloud mask in place
+                if cloudMaskFC and len(overwrite) == len(targets):
+                    maskGmlFile = os.path.join(os.path.dirname(tile), "qi", "MSK_CLOUDS_B00.gml")
+                    with metrics.stage("cloudMask", tile, IngestMetrics.fileSize(maskGmlFile)):
+                        maskRecords = cls.addCloudMask(tile, cloudMaskFC, preparedTile, any(overwrite.values()))
+                    # keep what was read for tileAdded (the manifest and a CloudIndex), so the GML is not parsed again
+                    if preparedTile is None:
+                        try:
+                            preparedTile = {"path": tile, "tileInfo": readTileInfo(tile), "maskRecords": maskRecords}
+                        except (OSError, ValueError):
+                            pass
             except Exception as e:
-                failedTiles.append(tile)
-        return (processedTiles, failedTiles)
+                for res in added[tile]:
+                    tileFailed(tile, res, e)
+                continue
+            for res in added[tile]:
+                tileAdded(tile, res, preparedTile)
 
     @classmethod
-    def importTiles(cls, tilesFolder, mosaicDSName, resolution="10m", cloudMaskFC=None):
-        tiles = cls.listTiles(tilesFolder)
-        return cls.addTiles(mosaicDSName, tiles, resolution, cloudMaskFC)
+    def chunks(cls, items, size):
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
-@lru_cache(maxsize=128)
-def cacheElementTree(path):
-        try:
-            tree = ET.parse(path)
-        except ET.ParseError as e:
-            print("Exception while parsing {0}\n{1}".format(path,e))
-            return None
+    @classmethod
+    def markDone(cls, manifest, tiles):
+        for tile, resolution, productName in tiles:
+            manifest.done(tile, resolution, productName)
+        del tiles[:]
+
+    @classmethod
+    def importTiles(cls, tilesFolder, mosaicDSName, resolution="10m", cloudMaskFC=None, workers=None, manifest=None, discoveryThreads=None,
+                    catalog=None, tileFilter=None, batchSize=None, metrics=None, cloudIndex=None, aoi=None, clipCloudMasks=False,
+                    deduplicate=None, maintenance=None):
+        """ The tiles are added while tilesFolder is still being searched (see iterTiles).
+            With a TileCatalog (or a tileFilter) the catalog is updated from tilesFolder first and only the tiles
+            selected by tileFilter(catalog) are added, e.g. tileFilter=catalog.query(maxCloudCoverage=20).
+            To build several mosaic datasets in one pass over tilesFolder pass them as a dict
+            {resolution: mosaic dataset} (see addTiles).
+            aoi is a polygon or a featureclass, only the tiles intersecting it are added (and with clipCloudMasks
+            only the cloud mask polygons intersecting it are inserted), see AreaOfInterest.
+            With deduplicate=True (or a BaselineFilter) repeated acquisitions are skipped, with a catalog from its columns.
+            maintenance are the maintainMosaicDataset options used with batchSize (see addTiles). """
+        if catalog is None and tileFilter is not None:
+            from TileCatalog import TileCatalog
+            catalog = TileCatalog()
+        if catalog is not None:
+            start = time.perf_counter()
+            if metrics:
+                metrics.watchCache("catalog", catalog.stats)
+            catalog.update(tilesFolder, discoveryThreads)
+            if catalog.path:
+                catalog.save()
+            tiles = catalog.select(tileFilter, tilesFolder)
+            if metrics:
+                metrics.record("catalog", time.perf_counter() - start, items=len(tiles))
+        else:
+            tiles = cls.iterTiles(tilesFolder, discoveryThreads)
+        if aoi is not None and not isinstance(aoi, AreaOfInterest):
+            aoi = AreaOfInterest(aoi, clipCloudMasks)
+        if deduplicate:
+            start = time.perf_counter()
+            baselineFilter = deduplicate if isinstance(deduplicate, BaselineFilter) else BaselineFilter(threads=discoveryThreads)
+            tiles = baselineFilter.apply(tiles, catalog)
+            if metrics:
+                metrics.record("deduplicate", time.perf_counter() - start, items=len(baselineFilter.skipped))
+            deduplicate = None
+        return cls.addTiles(mosaicDSName, tiles, resolution, cloudMaskFC, workers, manifest, batchSize, metrics, cloudIndex, aoi, deduplicate,
+                            maintenance)
+
+def watchRasterTypeCache(metrics, fromZero=False):
+    """ Reports the ParseCache of the Sentinel-2 raster type in the metrics, if ArcGIS loaded it into this process """
+    for module in list(sys.modules.values()):
+        if hasattr(module, "Sentinel2TileBuilder") and hasattr(module, "parseCache"):
+            metrics.watchCache("parse", module.parseCache.stats, fromZero)
+            return
+
+# the same as readTileHeader of the raster type (Sentinel-2-Tile.py), keep the two in line
+def readTileHeader(path, fields=('tag',), tailBytes=16384, chunkSize=4096):
+    """ Reads only as much of a metadata.xml as the fields need, without building the tree. fields are any of
+        tag, namespace (root element), SENSING_TIME, HORIZONTAL_CS_CODE (read from the head of the file, the reading
+        stops before the angle grids) and CLOUD_COVERAGE_PERCENTAGE, VEGETATION_PERCENTAGE (Quality_Indicators_Info
+        is at the end of the file, they are looked up in its last tailBytes first).
+        path can also be a binary file object (e.g. io.BytesIO of a downloaded file).
+        Returns a dict of the found values (element texts). """
+    values = {}
+    wanted = set(fields)
+    with (open(path, 'rb') if isinstance(path, str) else path) as f:
+        tailFields = wanted.intersection(('CLOUD_COVERAGE_PERCENTAGE', 'VEGETATION_PERCENTAGE'))
+        if tailFields:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - tailBytes))
+            tail = f.read().decode('utf-8', 'replace')
+            for name in tailFields:
+                match = re.search('<{0}>([^<]*)</{0}>'.format(name), tail)
+                if match:
+                    values[name] = match.group(1).strip()
+                    wanted.discard(name)
+            f.seek(0)
+
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        while wanted:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            parser.feed(chunk)
+            for event, elem in parser.read_events():
+                if event == 'start':
+                    if 'tag' not in values:
+                        values['tag'] = elem.tag
+                        values['namespace'] = elem.tag[1:].split('}')[0] if elem.tag.startswith('{') else ''
+                        wanted.discard('tag')
+                        wanted.discard('namespace')
+                elif elem.tag in wanted:
+                    values[elem.tag] = elem.text.strip() if elem.text else elem.text
+                    wanted.discard(elem.tag)
+                else:
+                    elem.clear()
+    return values
+
+rasterTypePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Sentinel-2-Tile", "Sentinel-2-Tile.py")
+_rasterType = None
+
+def loadRasterType():
+    """ The Sentinel-2 raster type module, None where it is not next to this file """
+    global _rasterType
+    if _rasterType is None and os.path.isfile(rasterTypePath):
+        spec = importlib.util.spec_from_file_location("Sentinel2Tile", rasterTypePath)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _rasterType = module
+    return _rasterType
+
+def writeWorldFiles(tileMetadataPath, resolution="10m"):
+    """ Georeferences the bands of the resolution by the WorldFiles of the Sentinel-2 raster type, the .j2w files (or the
+        VRTs of SENTINEL2_WORLDFILE_CACHE) are then exactly those its builder checks. Returns False without writing
+        anything where the raster type is not next to this file, the builder writes them then. """
+    rasterType = loadRasterType()
+    if rasterType is None:
+        return False
+    metadata = rasterType.TileMetadata.get(tileMetadataPath)
+    images = [os.path.join(metadata.folder, "R" + resolution.replace("c", "m"), rasterType.bandProperties[key]["filename"])
+              for key in rasterType.Rxm[resolution]["bandKeys"]]
+    rasterType.WorldFiles(os.environ.get("SENTINEL2_WORLDFILE_CACHE")).prepare(metadata, resolution, images)
+    return True
+
+def getProductName(tileMetadataPath, preparedTile=None):
+    """ productName from tileInfo.json of the tile (or from the already prepared tile). """
+    tileInfo = preparedTile["tileInfo"] if preparedTile else readTileInfo(tileMetadataPath)
+    return tileInfo.get("productName")
+
+def isInFolder(path, folder):
+    """ True if path is folder or below it, /data/tiles2 is not in /data/tiles """
+    path = os.path.normcase(os.path.abspath(path))
+    folder = os.path.normcase(os.path.abspath(folder))
+    try:
+        return os.path.commonpath([path, folder]) == folder
+    except ValueError:
+        # on different drives
+        return False
+
+def readTileInfo(tileMetadataPath):
+    """ The content of tileInfo.json next to metadata.xml """
+    with open(os.path.join(os.path.dirname(tileMetadataPath), "tileInfo.json"), "r") as f:
+        return json.load(f)
 
-        return tree
+def prepareTile(tileMetadataPath, resolution="10m", withCloudMask=False, simplifier=None):
+    """ Pure python part of adding a tile (no arcpy calls), so it can run in a worker process.
+        resolution can be a list of resolutions, the metadata.xml is parsed once for all of them.
+        Returns a dict with the tileInfo.json content and the cloud mask records (None if not requested),
+        with a MaskSimplifier also the simplified records and their stats (see CloudMaskWriter.writeRecords). """
+    folder = os.path.dirname(tileMetadataPath)
+    tileInfo = readTileInfo(tileMetadataPath)
+    for res in resolution if isinstance(resolution, (list, tuple)) else [resolution]:
+        writeWorldFiles(tileMetadataPath, res)
+    maskRecords = None
+    if withCloudMask:
+        maskRecords = list(CloudMask.iterMaskRecords(os.path.join(folder, "qi", "MSK_CLOUDS_B00.gml")))
+    prepared = {"path": tileMetadataPath, "tileInfo": tileInfo, "maskRecords": maskRecords}
+    if withCloudMask and simplifier:
+        before = dict(simplifier.stats)
+        records = simplifier.apply(maskRecords)
+        prepared["simplifiedMask"] = (records, {key: value - before[key] for key, value in simplifier.stats.items()})
+    return prepared
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Adds a folder of Sentinel-2 tiles to a new mosaic dataset.")
+    parser.add_argument("tilesFolder", nargs="?", default="E:/Sentinel_tiles_from_amazonS3/")
+    parser.add_argument("--batch-size", type=int, default=None, help="tiles added per AddRastersToMosaicDataset call")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes preparing the tiles")
+    parser.add_argument("--statistics", action="store_true", help="calculate statistics once after batched adding")
+    parser.add_argument("--overviews", action="store_true", help="build overviews once after batched adding")
+    args = parser.parse_args()
 
     workspace = arcpy.env.workspace
 
@@ -135,7 +1209,9 @@ if __name__ == '__main__':
     mosaic_dataset = SentinelImporter.createMosaicDataset(workspace, "mosaic_dataset_name", "10m", arcpy.SpatialReference(32634))
 
     # Load Rasters
-    loadedRasters = SentinelImporter.importTiles("E:/Sentinel_tiles_from_amazonS3/", mosaic_dataset, "10m", cloudmask_featureclass)
+    loadedRasters = SentinelImporter.importTiles(args.tilesFolder, mosaic_dataset, "10m", cloudmask_featureclass,
+                                                workers=args.workers, batchSize=args.batch_size,
+                                                maintenance={"statistics": args.statistics, "overviews": args.overviews})
 
     print("--------- FAILED TILES ------------")
     print(loadedRasters[1])
@@ -0,0 +1,178 @@
+import json
+import os
+import re
+import numpy as np
+
+from SentinelImporter import SentinelImporter, readTileHeader, isInFolder
+
+class TileCatalog(object):
+    """ Columnar catalog (NumPy arrays saved as .npz) of the tiles of a tile tree with the values needed to choose tiles
+        before they are ingested. One row per metadata.xml:
+            path, size, mtime             - of metadata.xml (s3://bucket/key for tiles read from an S3TileSource),
+                                            used to update the catalog incrementally
+            tile                          - MGRS tile from tileInfo.json, e.g. T33UVR
+            productName                   - from tileInfo.json
+            sensingTime                   - SENSING_TIME (datetime64[ms], UTC)
+            cloudCoverage, vegetation     - CLOUD_COVERAGE_PERCENTAGE, VEGETATION_PERCENTAGE (NaN if missing)
+            epsg                          - HORIZONTAL_CS_CODE
+            psd                           - version of the metadata format from the namespace of metadata.xml (12, 14),
+                                            0 if unknown (see BaselineFilter)
+            xmin, ymin, xmax, ymax        - bounding box of tileDataGeometry in the tile coordinate system
+    """
+    columns = {"path": "U", "size": np.int64, "mtime": np.float64, "tile": "U", "productName": "U",
+               "sensingTime": "datetime64[ms]", "cloudCoverage": np.float32, "vegetation": np.float32, "epsg": np.int32,
+               "xmin": np.float64, "ymin": np.float64, "xmax": np.float64, "ymax": np.float64, "psd": np.int16}
+
+    def __init__(self, catalogPath=None):
+        """ Loads the catalog from catalogPath if it exists, without a path the catalog lives in memory only.
+            Columns missing from an older catalog are filled with zeros and its tiles are read again by the next update. """
+        self.path = catalogPath
+        self.hits = 0
+        self.misses = 0
+        if catalogPath and os.path.exists(catalogPath):
+            with np.load(catalogPath) as data:
+                self.data = {name: data[name] for name in self.columns if name in data.files}
+            missing = [name for name in self.columns if name not in self.data]
+            for name in missing:
+                self.data[name] = np.zeros(len(self.data["path"]), dtype=self.columns[name])
+            if missing:
+                self.data["size"][:] = -1
+        else:
+            self.data = {name: np.array([], dtype=dtype) for name, dtype in self.columns.items()}
+
+    def __len__(self):
+        return len(self.data["path"])
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    def save(self, catalogPath=None):
+        catalogPath = catalogPath or self.path
+        temp = catalogPath + ".tmp"
+        with open(temp, "wb") as f:
+            np.savez(f, **self.data)
+        os.replace(temp, catalogPath)
+        self.path = catalogPath
+
+    def update(self, tilesFolder, threads=None):
+        """ Adds the new and changed tiles under tilesFolder and drops the rows of tiles which are gone from it.
+            Unchanged tiles (same metadata.xml size and mtime) are not read again. """
+        known = {path: i for i, path in enumerate(self.data["path"])}
+        keep = np.zeros(len(self), dtype=bool)
+        keep[[i for path, i in known.items() if not isInFolder(path, tilesFolder)]] = True
+
+        records = []
+        for tile in SentinelImporter.iterTiles(tilesFolder, threads):
+            st = os.stat(tile)
+            i = known.get(tile)
+            if i is not None and self.data["size"][i] == st.st_size and self.data["mtime"][i] == st.st_mtime:
+                keep[i] = True
+                self.hits += 1
+                continue
+            self.misses += 1
+            try:
+                records.append(readTileRecord(tile, st))
+            except Exception as e:
+                print("Exception while reading {0}\n{1}".format(tile, e))
+
+        return self.merge(keep, records)
+
+    def updateFromSource(self, source, prefix="tiles/"):
+        """ Like update for the tiles under prefix of an S3TileSource, read remotely. The paths are s3://bucket/key,
+            size and mtime of metadata.xml come from the bucket listing. """
+        known = {path: i for i, path in enumerate(self.data["path"])}
+        keep = np.zeros(len(self), dtype=bool)
+        keep[[i for path, i in known.items() if not path.startswith(source.uri(prefix))]] = True
+
+        changed = {}
+        for key, size, mtime in source.listTiles(prefix):
+            i = known.get(source.uri(key))
+            if i is not None and self.data["size"][i] == size and self.data["mtime"][i] == mtime:
+                keep[i] = True
+                self.hits += 1
+            else:
+                self.misses += 1
+                changed[key] = (size, mtime)
+
+        records = []
+        for tile in source.readTiles(list(changed), headerFields, withMask=False):
+            if "error" in tile:
+                print("Exception while reading {0}\n{1}".format(source.uri(tile["key"]), tile["error"]))
+                continue
+            size, mtime = changed[tile["key"]]
+            records.append(tileRecord(source.uri(tile["key"]), size, mtime, tile["header"], tile["tileInfo"]))
+        return self.merge(keep, records)
+
+    def merge(self, keep, records):
+        """ Keeps the rows of keep and appends records """
+        for name, dtype in self.columns.items():
+            added = np.array([r[name] for r in records], dtype=dtype)
+            self.data[name] = np.concatenate([self.data[name][keep], added]) if len(added) else self.data[name][keep]
+        print("Catalog updated, {0} tiles read, {1} tiles in catalog.".format(len(records), len(self)))
+        return self
+
+    def stats(self):
+        """ hits are the unchanged tiles the updates kept, misses the new and changed tiles they read """
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
+
+    def select(self, predicate=None, folder=None):
+        """ Returns the paths of the tiles for which predicate(catalog) is True. The predicate works on whole columns,
+            e.g. lambda c: (c["cloudCoverage"] < 20) & (c["tile"] == "T33UVR"). With folder only the tiles below it. """
+        mask = np.ones(len(self), dtype=bool) if predicate is None else np.asarray(predicate(self), dtype=bool)
+        if folder is not None:
+            mask &= np.array([isInFolder(path, folder) for path in self.data["path"]], dtype=bool)
+        return list(self.data["path"][mask])
+
+    def query(self, maxCloudCoverage=None, minVegetation=None, start=None, end=None, tiles=None, bbox=None, epsg=None):
+        """ Common filters combined with AND, start/end are datetimes or ISO strings, bbox is (xmin, ymin, xmax, ymax)
+            in the coordinate system epsg (tiles in other coordinate systems are left out when bbox is given). """
+        def predicate(c):
+            mask = np.ones(len(self), dtype=bool)
+            if maxCloudCoverage is not None:
+                mask &= c["cloudCoverage"] <= maxCloudCoverage
+            if minVegetation is not None:
+                mask &= c["vegetation"] >= minVegetation
+            if start is not None:
+                mask &= c["sensingTime"] >= np.datetime64(start, "ms")
+            if end is not None:
+                mask &= c["sensingTime"] <= np.datetime64(end, "ms")
+            if tiles is not None:
+                mask &= np.isin(c["tile"], list(tiles))
+            if bbox is not None:
+                mask &= (c["xmin"] <= bbox[2]) & (c["xmax"] >= bbox[0]) & (c["ymin"] <= bbox[3]) & (c["ymax"] >= bbox[1])
+                if epsg is not None:
+                    mask &= c["epsg"] == epsg
+            return mask
+        return predicate
+
+headerFields = ("namespace", "SENSING_TIME", "HORIZONTAL_CS_CODE", "CLOUD_COVERAGE_PERCENTAGE", "VEGETATION_PERCENTAGE")
+
+def readTileRecord(tileMetadataPath, st=None):
+    """ Reads the catalog row of a tile from its metadata.xml and tileInfo.json """
+    st = st or os.stat(tileMetadataPath)
+    with open(os.path.join(os.path.dirname(tileMetadataPath), "tileInfo.json"), "r") as f:
+        tileInfo = json.load(f)
+    return tileRecord(tileMetadataPath, st.st_size, st.st_mtime, readTileHeader(tileMetadataPath, headerFields), tileInfo)
+
+def tileRecord(path, size, mtime, header, tileInfo):
+    """ The catalog row of a tile from the readTileHeader values of its metadata.xml and its tileInfo.json """
+    record = {"path": path, "size": size, "mtime": mtime, "sensingTime": "NaT",
+              "cloudCoverage": np.nan, "vegetation": np.nan, "epsg": 0, "psd": 0}
+    match = re.search(r"psd-(\d+)", header.get("namespace") or "")
+    if match:
+        record["psd"] = int(match.group(1))
+    if "SENSING_TIME" in header:
+        record["sensingTime"] = header["SENSING_TIME"].rstrip("Z")
+    if "CLOUD_COVERAGE_PERCENTAGE" in header:
+        record["cloudCoverage"] = float(header["CLOUD_COVERAGE_PERCENTAGE"])
+    if "VEGETATION_PERCENTAGE" in header:
+        record["vegetation"] = float(header["VEGETATION_PERCENTAGE"])
+    if "HORIZONTAL_CS_CODE" in header:
+        record["epsg"] = int(header["HORIZONTAL_CS_CODE"].split(":")[1])
+
+    record["tile"] = "T{0}{1}{2}".format(tileInfo.get("utmZone", ""), tileInfo.get("latitudeBand", ""), tileInfo.get("gridSquare", ""))
+    record["productName"] = tileInfo.get("productName", "")
+    coords = np.array(tileInfo.get("tileDataGeometry", {}).get("coordinates", [[[np.nan, np.nan]]])[0], dtype=np.float64)
+    record["xmin"], record["ymin"] = coords.min(axis=0)
+    record["xmax"], record["ymax"] = coords.max(axis=0)
+    return record
@@ -0,0 +1,177 @@
+import arcpy
+from array import array
+import numpy as np
+
+# WGS84 and the transverse Mercator series of Krüger to the 6th order in n (Karney 2011), accurate to well below a
+# millimetre inside a zone and a few millimetres in the neighbouring zones, which is where Sentinel-2 tiles overlap
+a = 6378137.0
+f = 1/298.257223563
+k0 = 0.9996
+
+def seriesCoefficients(a, f):
+    """ (A, e, alpha, beta) of the Krüger series for an ellipsoid """
+    n = f/(2 - f)
+    A = a/(1 + n)*(1 + n**2/4 + n**4/64 + n**6/256)
+    alpha = np.array([
+        n/2 - 2*n**2/3 + 5*n**3/16 + 41*n**4/180 - 127*n**5/288 + 7891*n**6/37800,
+        13*n**2/48 - 3*n**3/5 + 557*n**4/1440 + 281*n**5/630 - 1983433*n**6/1935360,
+        61*n**3/240 - 103*n**4/140 + 15061*n**5/26880 + 167603*n**6/181440,
+        49561*n**4/161280 - 179*n**5/168 + 6601661*n**6/7257600,
+        34729*n**5/80640 - 3418889*n**6/1995840,
+        212378941*n**6/319334400])
+    beta = np.array([
+        n/2 - 2*n**2/3 + 37*n**3/96 - n**4/360 - 81*n**5/512 + 96199*n**6/604800,
+        n**2/48 + n**3/15 - 437*n**4/1440 + 46*n**5/105 - 1118711*n**6/3870720,
+        17*n**3/480 - 37*n**4/840 - 209*n**5/4480 + 5569*n**6/90720,
+        4397*n**4/161280 - 11*n**5/504 - 830251*n**6/7257600,
+        4583*n**5/161280 - 108847*n**6/3991680,
+        20648693*n**6/638668800])
+    return (A, np.sqrt(f*(2 - f)), alpha, beta)
+
+wgs84 = seriesCoefficients(a, f)
+
+def conformal(tau, e):
+    """ tan of the conformal latitude for tau, the tan of the geographic latitude """
+    sigma = np.sinh(e*np.arctanh(e*tau/np.hypot(1, tau)))
+    return tau*np.hypot(1, sigma) - sigma*np.hypot(1, tau)
+
+def toTransverseMercator(lon, lat, lon0, ellipsoid=wgs84):
+    """ Transverse Mercator x, y (scale 1, no false easting or northing) of arrays of degrees """
+    A, e, alpha, beta = ellipsoid
+    lam = np.radians(np.asarray(lon, dtype=np.float64) - lon0)
+    tau = conformal(np.tan(np.radians(np.asarray(lat, dtype=np.float64))), e)
+    xi = np.arctan2(tau, np.cos(lam))
+    eta = np.arcsinh(np.sin(lam)/np.hypot(tau, np.cos(lam)))
+    x, y = eta.copy(), xi.copy()
+    for j, c in enumerate(alpha, 1):
+        x += c*np.cos(2*j*xi)*np.sinh(2*j*eta)
+        y += c*np.sin(2*j*xi)*np.cosh(2*j*eta)
+    return (A*x, A*y)
+
+def fromTransverseMercator(x, y, lon0, ellipsoid=wgs84):
+    """ Degrees lon, lat of arrays of transverse Mercator x, y (scale 1, no false easting or northing) """
+    A, e, alpha, beta = ellipsoid
+    xi, eta = np.asarray(y, dtype=np.float64)/A, np.asarray(x, dtype=np.float64)/A
+    xi1, eta1 = xi.copy(), eta.copy()
+    for j, c in enumerate(beta, 1):
+        xi1 -= c*np.sin(2*j*xi)*np.cosh(2*j*eta)
+        eta1 -= c*np.cos(2*j*xi)*np.sinh(2*j*eta)
+    lam = np.arctan2(np.sinh(eta1), np.cos(xi1))
+    tau1 = np.sin(xi1)/np.hypot(np.sinh(eta1), np.cos(xi1))
+    # Newton's method for the geographic latitude, converges in 2 or 3 steps
+    tau = tau1.copy()
+    for i in range(5):
+        taui = conformal(tau, e)
+        tau += (tau1 - taui)/np.hypot(1, taui)*(1 + (1 - e*e)*tau*tau)/((1 - e*e)*np.hypot(1, tau))
+    return (lon0 + np.degrees(lam), np.degrees(np.arctan(tau)))
+
+def utmZone(wkid):
+    """ (zone, south) of a WGS84 / UTM wkid (326zz north, 327zz south), None for other coordinate systems """
+    if 32601 <= wkid <= 32660:
+        return (wkid - 32600, False)
+    if 32701 <= wkid <= 32760:
+        return (wkid - 32700, True)
+    return None
+
+def isSupported(wkid):
+    """ True for the coordinate systems transformed here: WGS84 (4326) and WGS84 / UTM """
+    return wkid == 4326 or utmZone(wkid) is not None
+
+def toGeographic(x, y, wkid):
+    """ lon, lat arrays of x, y arrays in wkid """
+    if wkid == 4326:
+        return (np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    zone, south = utmZone(wkid)
+    return fromTransverseMercator((np.asarray(x, dtype=np.float64) - 500000)/k0,
+                                  (np.asarray(y, dtype=np.float64) - (10000000 if south else 0))/k0, 6*zone - 183)
+
+def fromGeographic(lon, lat, wkid):
+    """ x, y arrays in wkid of lon, lat arrays """
+    if wkid == 4326:
+        return (np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    zone, south = utmZone(wkid)
+    x, y = toTransverseMercator(lon, lat, 6*zone - 183)
+    return (k0*x + 500000, k0*y + (10000000 if south else 0))
+
+def transform(x, y, fromWkid, toWkid):
+    """ x, y arrays transformed from fromWkid to toWkid (both supported, see isSupported) at once """
+    if fromWkid == toWkid:
+        return (np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64))
+    lon, lat = toGeographic(x, y, fromWkid)
+    return fromGeographic(lon, lat, toWkid)
+
+spatialReferences = {}
+spatialReferenceCounts = {"hits": 0, "misses": 0}
+
+def spatialReference(wkid):
+    """ The arcpy.SpatialReference of wkid, created once per process """
+    if wkid in spatialReferences:
+        spatialReferenceCounts["hits"] += 1
+    else:
+        spatialReferenceCounts["misses"] += 1
+        spatialReferences[wkid] = arcpy.SpatialReference(wkid)
+    return spatialReferences[wkid]
+
+def spatialReferenceStats():
+    return {"hits": spatialReferenceCounts["hits"], "misses": spatialReferenceCounts["misses"], "entries": len(spatialReferences)}
+
+def transformRecords(records, wkid):
+    """ Transforms the coords of the records of a tile (see CloudMask.iterMaskRecords, a flat array or a list of rings) to
+        wkid, all the rings of a coordinate system in one go. The coords of transformed records become array('d'), records
+        already in wkid or in a coordinate system not supported here are returned as they are (for projectAs).
+        Returns the records and the number of transformed ones. """
+    records = list(records)
+    if not isSupported(wkid):
+        return (records, 0)
+    rings = {}
+    for i, record in enumerate(records):
+        if record[4] != wkid and isSupported(record[4]):
+            for ring in record[5] if isinstance(record[5], list) else [record[5]]:
+                rings.setdefault(record[4], []).append((i, ring))
+    transformed = {}
+    for fromWkid, items in rings.items():
+        coords = [np.asarray(ring, dtype=np.float64) for i, ring in items]
+        xy = np.concatenate(coords).reshape(-1, 2)
+        x, y = transform(xy[:, 0], xy[:, 1], fromWkid, wkid)
+        xy = np.column_stack([x, y]).ravel()
+        offsets = np.cumsum([len(c) for c in coords])[:-1]
+        for (i, ring), part in zip(items, np.split(xy, offsets)):
+            transformed.setdefault(i, []).append(array("d", part.tobytes()))
+    for i, parts in transformed.items():
+        fid, ftype, tile, ts, fromWkid, coords = records[i]
+        records[i] = (fid, ftype, tile, ts, wkid, parts if isinstance(coords, list) else parts[0])
+    return (records, len(transformed))
+
+# reference points (wkid, x, y, lon, lat): the origin of zone 33 north and south, and the point of the central meridian
+# at 45° N whose northing is k0 times the published WGS84 meridian arc of 4984944.378 m
+referencePoints = [(32633, 500000.0, 0.0, 15.0, 0.0),
+                   (32733, 500000.0, 10000000.0, 15.0, 0.0),
+                   (32633, 500000.0, 4982950.400, 15.0, 45.0)]
+
+def validate(points=None, wkids=(32632, 32633, 32634, 32635, 4326), tolerance=0.01):
+    """ Checks the transformations against the reference points (and a grid of points around each one: transformed to
+        every wkid and back, and through WGS84 or directly), returns the largest error in metres. Raises a ValueError
+        above tolerance. With the real arcpy pass points=[(wkid, x, y, lon, lat), ...] projected by ArcGIS to compare. """
+    # the UTM example of Snyder, Map Projections - A Working Manual, on the Clarke 1866 ellipsoid (published to 0.1 m)
+    x, y = toTransverseMercator(-73.5, 40.5, -75, seriesCoefficients(6378206.4, 1/294.978698214))
+    errors = [max(abs(k0*x - 127106.5), abs(k0*y - 4484124.4)) - 0.05]
+    for wkid, x, y, lon, lat in referencePoints if points is None else points:
+        lon1, lat1 = toGeographic(x, y, wkid)
+        errors.append(max(abs(lon1 - lon), abs(lat1 - lat))*111320.0)
+        x1, y1 = fromGeographic(lon, lat, wkid)
+        errors.append(max(abs(x1 - x), abs(y1 - y)))
+        if wkid == 4326:
+            continue
+        gx, gy = np.meshgrid(np.linspace(x - 60000, x + 60000, 7), np.linspace(y - 60000, y + 60000, 7))
+        for toWkid in wkids:
+            tx, ty = transform(gx, gy, wkid, toWkid)
+            bx, by = transform(tx, ty, toWkid, wkid)
+            errors.append(np.abs(np.concatenate([(bx - gx).ravel(), (by - gy).ravel()])).max())
+            for viaWkid in wkids:
+                vx, vy = transform(*transform(gx, gy, wkid, viaWkid), fromWkid=viaWkid, toWkid=toWkid)
+                scale = 111320.0 if toWkid == 4326 else 1.0
+                errors.append(np.abs(np.concatenate([(vx - tx).ravel(), (vy - ty).ravel()])).max()*scale)
+    error = float(max(errors))
+    if error > tolerance:
+        raise ValueError("UTM transformation off by {0:.4f} m".format(error))
+    return error
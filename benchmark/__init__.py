@@ -0,0 +1,2 @@
+""" Offline ingest benchmarks: a synthetic Sentinel-2 L2A archive generator (synthetic.py), a minimal arcpy stand-in
+    recording the calls (stub/arcpy.py) and the benchmark runner (run.py). """
@@ -0,0 +1,189 @@
+""" Offline ingest benchmarks on synthetic archives (see synthetic.py) with the arcpy stand-in (see stub/arcpy.py).
+        python -m benchmark.run --scales 10 1000 10000 --work C:/Temp/s2bench
+    For every scale an archive is generated once (and reused by later runs), then each stage runs in its own
+    process so the peak RSS is the stage's own:
+        listTiles        SentinelImporter.listTiles over the archive
+        parseFeatures    CloudMask.parseFeatures of every tile
+        insertFeatures   CloudMask.insertFeatures of every tile (features parsed before the clock starts)
+        buildResolution  Sentinel2TileBuilder.buildResolution of every tile
+        addTiles         SentinelImporter.addTiles of all tiles with their cloud masks, once per --batch-sizes value, the
+                         stand-in mosaic dataset gets the items the raster type builds
+    Reported are the throughput, the latency percentiles per tile (per run for listTiles and addTiles) and the peak RSS.
+        python -m benchmark.run --scales 1000 --stages addTiles --batch-sizes 1 10 50 200 """
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark.synthetic import generateArchive
+
+benchmarkFolder = os.path.dirname(os.path.abspath(__file__))
+repositoryFolder = os.path.dirname(benchmarkFolder)
+stages = ("listTiles", "parseFeatures", "insertFeatures", "buildResolution", "addTiles")
+builders = {"10m": "Sentinel210mTileBuilder", "20m": "Sentinel220mTileBuilder", "20mCloud": "Sentinel220mCloudTileBuilder"}
+
+def useStub():
+    """ Makes import arcpy load the stand-in and puts the repository on the path """
+    sys.path.insert(0, os.path.join(benchmarkFolder, "stub"))
+    sys.path.insert(1, repositoryFolder)
+
+def loadRasterType():
+    path = os.path.join(repositoryFolder, "Sentinel-2-Tile", "Sentinel-2-Tile.py")
+    spec = importlib.util.spec_from_file_location("Sentinel2Tile", path)
+    module = importlib.util.module_from_spec(spec)
+    # registered like an imported module, so its parseCache is found by the metrics (see watchRasterTypeCache)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def peakRss():
+    """ Peak resident set size of this process in MB, None where it cannot be read. """
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak/1024.0/1024.0 if sys.platform == "darwin" else peak/1024.0
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset/1024.0/1024.0
+    except (ImportError, AttributeError):
+        return None
+
+def percentile(values, q):
+    """ Nearest rank percentile of sorted values """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(q/100.0*len(values))) - 1))]
+
+def summary(stage, tiles, latencies, items=None, unit="tiles"):
+    latencies = sorted(latencies)
+    seconds = sum(latencies)
+    items = len(tiles) if items is None else items
+    return {"stage": stage, "tiles": len(tiles), "items": items, "unit": unit, "seconds": seconds,
+            "throughput": items/seconds if seconds else None,
+            "p50ms": percentile(latencies, 50)*1000, "p95ms": percentile(latencies, 95)*1000,
+            "p99ms": percentile(latencies, 99)*1000, "maxms": latencies[-1]*1000}
+
+def runStage(stage, archive, resolution="10m", batchSize=None):
+    """ Runs one stage in this process and returns its summary. """
+    useStub()
+    import arcpy
+    from SentinelImporter import CloudMask, SentinelImporter
+
+    def maskFile(tile):
+        return os.path.join(os.path.dirname(tile), "qi", "MSK_CLOUDS_B00.gml")
+
+    if stage == "listTiles":
+        baseRss = peakRss()
+        start = time.perf_counter()
+        tiles = SentinelImporter.listTiles(archive)
+        result = summary(stage, tiles, [time.perf_counter() - start])
+    else:
+        tiles = SentinelImporter.listTiles(archive)
+        latencies = []
+        if stage == "parseFeatures":
+            features = 0
+            baseRss = peakRss()
+            for tile in tiles:
+                start = time.perf_counter()
+                features += len(CloudMask.parseFeatures(maskFile(tile)))
+                latencies.append(time.perf_counter() - start)
+            result = summary(stage, tiles, latencies)
+            result["features"] = features
+        elif stage == "insertFeatures":
+            baseRss = peakRss()
+            for tile in tiles:
+                features = CloudMask.parseFeatures(maskFile(tile))
+                start = time.perf_counter()
+                CloudMask.insertFeatures(features, "CloudMask")
+                latencies.append(time.perf_counter() - start)
+            result = summary(stage, tiles, latencies)
+            result["features"] = arcpy.counts["InsertCursor.insertRow"]
+        elif stage == "buildResolution":
+            builder = loadRasterType().Sentinel2TileBuilder()
+            baseRss = peakRss()
+            for tile in tiles:
+                start = time.perf_counter()
+                builder.buildResolution({"path": tile}, resolution)
+                latencies.append(time.perf_counter() - start)
+            result = summary(stage, tiles, latencies)
+        elif stage == "addTiles":
+            rasterType = loadRasterType()
+            for name, builder in builders.items():
+                arcpy.rasterTypes["Sentinel-2-L2A-" + name + "Tile"] = getattr(rasterType, builder)().build
+            baseRss = peakRss()
+            start = time.perf_counter()
+            processedTiles, failedTiles = SentinelImporter.addTiles("mosaic", tiles, resolution, "CloudMask", batchSize=batchSize)
+            result = summary(stage, tiles, [time.perf_counter() - start])
+            result.update({"batchSize": batchSize or 1, "failed": len(failedTiles),
+                           "addRastersCalls": arcpy.counts["AddRastersToMosaicDataset"],
+                           "mosaicItems": len(arcpy.mosaicDatasets.get("mosaic", {})),
+                           "features": arcpy.counts["InsertCursor.insertRow"]})
+        else:
+            raise ValueError("Unknown stage {0}".format(stage))
+    result["peakRssMB"] = peakRss()
+    result["baseRssMB"] = baseRss
+    return result
+
+def prepareArchive(work, tiles, features, vertices, seed):
+    """ Generates the archive of a scale unless a previous run did already """
+    archive = os.path.join(work, "s2-{0}-{1}x{2}-{3}".format(tiles, features, vertices, seed))
+    marker = os.path.join(archive, "complete")
+    if not os.path.exists(marker):
+        print("Generating {0} tiles in {1}...".format(tiles, archive))
+        generateArchive(archive, tiles, features, vertices, seed=seed)
+        open(marker, "w").close()
+    return archive
+
+def printResult(scale, result):
+    stage = result["stage"] + ("/{0}".format(result["batchSize"]) if "batchSize" in result else "")
+    print("{0:>6} {1:<16} {2:>10.1f} {3:<9} {4:>9.3f} {5:>9.3f} {6:>9.3f} {7:>9.3f} {8:>9}".format(
+        scale, stage, result["throughput"] or 0, result["unit"] + "/s", result["p50ms"], result["p95ms"],
+        result["p99ms"], result["maxms"], "{0:.1f}".format(result["peakRssMB"]) if result["peakRssMB"] else "-"))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the tile ingest on synthetic archives without ArcGIS.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[10, 1000, 10000], help="archive sizes in tiles")
+    parser.add_argument("--stages", nargs="+", default=list(stages), choices=stages)
+    parser.add_argument("--work", default=os.path.join(tempfile.gettempdir(), "s2bench"), help="folder of the generated archives")
+    parser.add_argument("--features", type=int, default=50, help="cloud mask polygons per tile")
+    parser.add_argument("--vertices", type=int, default=40, help="vertices per cloud mask polygon")
+    parser.add_argument("--resolution", default="10m", choices=("10m", "20m", "20c"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 50], help="tiles per AddRasters call of addTiles")
+    parser.add_argument("--output", help="appends the results as JSON lines to this file")
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    parser.add_argument("--batch-size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("archive", nargs="?", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        # child process of a benchmark run, the result goes to the last line of stdout
+        result = runStage(args.stage, args.archive, args.resolution, args.batch_size)
+        sys.stdout.write("\n" + json.dumps(result) + "\n")
+        sys.exit(0)
+
+    print("{0:>6} {1:<16} {2:>20} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9}".format(
+        "tiles", "stage", "throughput", "p50 ms", "p95 ms", "p99 ms", "max ms", "RSS MB"))
+    for scale in args.scales:
+        archive = prepareArchive(args.work, scale, args.features, args.vertices, args.seed)
+        runs = [(stage, batchSize) for stage in args.stages for batchSize in (args.batch_sizes if stage == "addTiles" else [None])]
+        for stage, batchSize in runs:
+            command = [sys.executable, "-m", "benchmark.run", "--stage", stage, "--resolution", args.resolution, archive]
+            if batchSize:
+                command[-1:-1] = ["--batch-size", str(batchSize)]
+            process = subprocess.run(command, cwd=repositoryFolder, stdout=subprocess.PIPE, universal_newlines=True)
+            if process.returncode != 0:
+                print("{0:>6} {1:<16} failed".format(scale, stage))
+                continue
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            result.update({"scale": scale, "vertices": args.vertices})
+            printResult(scale, result)
+            if args.output:
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(result) + "\n")
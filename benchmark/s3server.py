@@ -0,0 +1,172 @@
+""" Local stand-in for an S3 endpoint serving a folder as a bucket, enough for S3TileSource: ListObjectsV2 (prefix, delimiter,
+    continuation-token, max-keys) and GET and HEAD of objects with Range and the MD5 as ETag, over keep-alive HTTP/1.1,
+    path style addressing.
+        python -m benchmark.s3server C:/Temp/s2bench/s2-1000-50x40-0 --bucket sentinel-s2-l2a --port 9000
+    latency adds a delay to every response to play a remote server. Requests are not authenticated. """
+import argparse
+import datetime
+import hashlib
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        url = urlsplit(self.path)
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        if bucket != server.bucket:
+            return self.reply(404, b"<Error><Code>NoSuchBucket</Code></Error>", "application/xml")
+        if not key:
+            return self.listObjects(dict((name, values[0]) for name, values in parse_qs(url.query, keep_blank_values=True).items()))
+        path = os.path.join(server.root, *key.split("/"))
+        if not os.path.isfile(path):
+            return self.reply(404, b"<Error><Code>NoSuchKey</Code></Error>", "application/xml")
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        byteRange = None if head else self.headers.get("Range")
+        if byteRange:
+            first, _, last = byteRange.split("=", 1)[1].partition("-")
+            if first:
+                start, end = int(first), min(int(last), size - 1) if last else size - 1
+            else:
+                start = max(0, size - int(last))
+            if start >= size:
+                return self.reply(416, b"", "application/xml", {"Content-Range": "bytes */{0}".format(size)})
+        headers = {"ETag": '"{0}"'.format(server.etag(path))}
+        if head:
+            return self.reply(200, b"", "application/octet-stream", headers, size)
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read(max(0, end - start + 1))
+        if byteRange:
+            headers["Content-Range"] = "bytes {0}-{1}/{2}".format(start, end, size)
+        self.reply(206 if byteRange else 200, data, "application/octet-stream", headers)
+
+    def listObjects(self, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter", "")
+        after = query.get("continuation-token") or query.get("start-after") or ""
+        maxKeys = int(query.get("max-keys", 1000))
+        entries = []
+        for key, size, mtime in self.server.walk(prefix, delimiter):
+            if key > after:
+                entries.append((key, size, mtime))
+        truncated = len(entries) > maxKeys
+        entries = entries[:maxKeys]
+        body = ['<?xml version="1.0" encoding="UTF-8"?>\n<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+                "<Name>{0}</Name><Prefix>{1}</Prefix><KeyCount>{2}</KeyCount><MaxKeys>{3}</MaxKeys><IsTruncated>{4}</IsTruncated>".format(
+                    escape(self.server.bucket), escape(prefix), len(entries), maxKeys, "true" if truncated else "false")]
+        for key, size, mtime in entries:
+            if size is None:
+                body.append("<CommonPrefixes><Prefix>{0}</Prefix></CommonPrefixes>".format(escape(key)))
+            else:
+                body.append("<Contents><Key>{0}</Key><LastModified>{1}</LastModified><Size>{2}</Size><StorageClass>STANDARD</StorageClass></Contents>".format(
+                    escape(key), datetime.datetime.utcfromtimestamp(mtime).strftime("%Y-%m-%dT%H:%M:%S.000Z"), size))
+        if truncated:
+            body.append("<NextContinuationToken>{0}</NextContinuationToken>".format(escape(entries[-1][0])))
+        body.append("</ListBucketResult>")
+        self.reply(200, "".join(body).encode("utf-8"), "application/xml")
+
+    def reply(self, status, data, contentType, headers=None, length=None):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(data) if length is None else length))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+class S3Server(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root, bucket="sentinel-s2-l2a", host="127.0.0.1", port=0, latency=0.0):
+        HTTPServer.__init__(self, (host, port), S3Handler)
+        self.root = os.path.abspath(root)
+        self.bucket = bucket
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.etags = {}
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        socketserver.ThreadingMixIn.process_request(self, request, client_address)
+
+    def etag(self, path):
+        """ MD5 of the file, as S3 has for objects not uploaded in parts """
+        st = os.stat(path)
+        cached = self.etags.get(path)
+        if cached and cached[0] == (st.st_size, st.st_mtime):
+            return cached[1]
+        md5 = hashlib.md5()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                md5.update(chunk)
+        self.etags[path] = ((st.st_size, st.st_mtime), md5.hexdigest())
+        return md5.hexdigest()
+
+    @property
+    def endpoint(self):
+        return "http://{0}:{1}".format(*self.server_address[:2])
+
+    def walk(self, prefix, delimiter):
+        """ Yields (key, size, mtime) of the objects and (prefix, None, None) of the common prefixes, sorted by key """
+        folder = prefix.rpartition("/")[0]
+        results = []
+        stack = [folder]
+        while stack:
+            current = stack.pop()
+            try:
+                entries = list(os.scandir(os.path.join(self.root, *current.split("/")) if current else self.root))
+            except OSError:
+                continue
+            for entry in entries:
+                key = (current + "/" if current else "") + entry.name
+                if not key.startswith(prefix) and not prefix.startswith(key + "/"):
+                    continue
+                if entry.is_dir():
+                    if delimiter == "/" and key.startswith(prefix):
+                        results.append((key + "/", None, None))
+                    else:
+                        stack.append(key)
+                elif key.startswith(prefix):
+                    st = entry.stat()
+                    results.append((key, st.st_size, st.st_mtime))
+        return sorted(results)
+
+    def start(self):
+        """ Serves on a background thread, returns the endpoint """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.endpoint
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves a folder as an S3 bucket.")
+    parser.add_argument("root")
+    parser.add_argument("--bucket", default="sentinel-s2-l2a")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args()
+    server = S3Server(args.root, args.bucket, args.host, args.port, args.latency)
+    print("Serving {0} as bucket {1} on {2}".format(args.root, args.bucket, server.endpoint))
+    server.serve_forever()
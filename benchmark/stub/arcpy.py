@@ -0,0 +1,194 @@
+""" Minimal stand-in for arcpy, enough to run SentinelImporter.py and the raster type without ArcGIS.
+    Geoprocessing tools and Describe are appended to calls as (name, args, kwargs), every call (cursor rows included)
+    is counted in counts. Nothing is written anywhere, the benchmarks measure the python side of an import.
+    Mosaic datasets keep their items in memory (see AddRastersToMosaicDataset), SearchCursor returns their OID@.
+    Put the folder of this file first on sys.path to use it instead of the real arcpy. """
+import itertools
+import re
+import struct
+import types
+from collections import Counter
+
+calls = []
+counts = Counter()
+
+def record(name, *args, **kwargs):
+    calls.append((name, args, kwargs))
+    counts[name] += 1
+
+# the items of every mosaic dataset as {OBJECTID: path}, and the builders of python raster types by name, e.g.
+# {"Sentinel-2-L2A-10mTile": Sentinel210mTileBuilder().build}; without one a raster type adds one item per path
+mosaicDatasets = {}
+rasterTypes = {}
+itemIds = itertools.count(1)
+
+def reset():
+    global itemIds
+    del calls[:]
+    counts.clear()
+    mosaicDatasets.clear()
+    itemIds = itertools.count(1)
+
+def whereFilter(where_clause):
+    """ The OBJECTID test of a "FIELD > n" (or <, >=, <=, =) where clause, other clauses select everything """
+    match = re.match(r"\s*\w+\s*(>=|<=|>|<|=)\s*(\d+)\s*$", where_clause or "")
+    if not match:
+        return lambda oid: True
+    op, value = match.group(1), int(match.group(2))
+    return {">": lambda oid: oid > value, "<": lambda oid: oid < value, ">=": lambda oid: oid >= value,
+            "<=": lambda oid: oid <= value, "=": lambda oid: oid == value}[op]
+
+class SpatialReference(object):
+
+    def __init__(self, item=None):
+        self.factoryCode = item if isinstance(item, int) else 0
+        counts["SpatialReference"] += 1
+
+class Point(object):
+    __slots__ = ("X", "Y")
+
+    def __init__(self, X=0.0, Y=0.0):
+        self.X = X
+        self.Y = Y
+
+class Array(list):
+
+    def add(self, point):
+        self.append(point)
+
+class Polygon(object):
+
+    def __init__(self, inputs=None, spatial_reference=None):
+        self.inputs = inputs
+        self.spatialReference = spatial_reference or SpatialReference()
+        counts["Polygon"] += 1
+
+    def projectAs(self, spatial_reference, transformation_name=None):
+        counts["projectAs"] += 1
+        return Polygon(self.inputs, spatial_reference)
+
+    def points(self):
+        """ (x, y) of all vertices, from the WKB or the Array of Points the polygon was made of """
+        if isinstance(self.inputs, bytes):
+            order = "<" if self.inputs[0] == 1 else ">"
+            rings, = struct.unpack_from(order + "I", self.inputs, 5)
+            offset, points = 9, []
+            for r in range(rings):
+                n, = struct.unpack_from(order + "I", self.inputs, offset)
+                values = struct.unpack_from(order + "{0}d".format(2*n), self.inputs, offset + 4)
+                points.extend(zip(values[0::2], values[1::2]))
+                offset += 4 + 16*n
+            return points
+        return [(p.X, p.Y) for p in self.inputs or []]
+
+    @property
+    def extent(self):
+        xs, ys = zip(*self.points())
+        return Extent(min(xs), min(ys), max(xs), max(ys))
+
+    def disjoint(self, second_geometry):
+        """ By the extents only """
+        counts["disjoint"] += 1
+        a, b = self.extent, second_geometry.extent
+        return a.XMin > b.XMax or b.XMin > a.XMax or a.YMin > b.YMax or b.YMin > a.YMax
+
+    def union(self, other):
+        return Polygon(Array(Point(x, y) for x, y in self.points() + other.points()), self.spatialReference)
+
+class Extent(object):
+
+    def __init__(self, XMin=None, YMin=None, XMax=None, YMax=None):
+        self.XMin, self.YMin, self.XMax, self.YMax = XMin, YMin, XMax, YMax
+
+def FromWKB(wkb, spatial_reference=None):
+    counts["FromWKB"] += 1
+    return Polygon(bytes(wkb), spatial_reference)
+
+class Field(object):
+    pass
+
+class Describe(object):
+    """ A featureclass or mosaic dataset in WGS84 / UTM zone 34N """
+
+    def __init__(self, value):
+        record("Describe", value)
+        self.catalogPath = value
+        self.spatialReference = SpatialReference(32634)
+        self.OIDFieldName = "OBJECTID"
+
+class Cursor(object):
+
+    def __init__(self, name, dataset, fields, where_clause=None, *args, **kwargs):
+        record(name, dataset, fields, where_clause)
+        self.name = name
+        self.rows = []
+        if dataset in mosaicDatasets and list(fields) == ["OID@"]:
+            test = whereFilter(where_clause)
+            sqlClause = kwargs.get("sql_clause") or (None, None)
+            oids = sorted((oid for oid in mosaicDatasets[dataset] if test(oid)), reverse="DESC" in (sqlClause[1] or ""))
+            self.rows = [(oid,) for oid in oids]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def insertRow(self, row):
+        counts[self.name + ".insertRow"] += 1
+        return counts[self.name + ".insertRow"]
+
+    def updateRow(self, row):
+        counts[self.name + ".updateRow"] += 1
+
+    def deleteRow(self):
+        counts[self.name + ".deleteRow"] += 1
+
+da = types.SimpleNamespace(
+    InsertCursor=lambda *args, **kwargs: Cursor("InsertCursor", *args, **kwargs),
+    UpdateCursor=lambda *args, **kwargs: Cursor("UpdateCursor", *args, **kwargs),
+    SearchCursor=lambda *args, **kwargs: Cursor("SearchCursor", *args, **kwargs))
+
+def tool(name):
+    def run(*args, **kwargs):
+        record(name, *args, **kwargs)
+        return args[0] if args else None
+    return run
+
+def AddRastersToMosaicDataset(in_mosaic_dataset, raster_type, input_path, *args, **kwargs):
+    """ Adds the items the raster type builds for each path (a path or a list of paths). A failing build fails the
+        whole call, like the geoprocessing tool. With OVERWRITE_DUPLICATES the items of a path already added are replaced. """
+    record("AddRastersToMosaicDataset", in_mosaic_dataset, raster_type, input_path, *args, **kwargs)
+    paths = input_path if isinstance(input_path, list) else [input_path]
+    build = rasterTypes.get(raster_type)
+    built = [(path, len(build({"path": path}) or []) if build else 1) for path in paths]
+    items = mosaicDatasets.setdefault(in_mosaic_dataset, {})
+    if kwargs.get("duplicate_items_action") == "OVERWRITE_DUPLICATES":
+        for oid in [oid for oid, path in items.items() if path in paths]:
+            del items[oid]
+    for path, count in built:
+        for i in range(count):
+            items[next(itemIds)] = path
+    return in_mosaic_dataset
+
+def RemoveRastersFromMosaicDataset(in_mosaic_dataset, where_clause=None, *args, **kwargs):
+    record("RemoveRastersFromMosaicDataset", in_mosaic_dataset, where_clause, *args, **kwargs)
+    items = mosaicDatasets.get(in_mosaic_dataset, {})
+    test = whereFilter(where_clause)
+    for oid in [oid for oid in items if test(oid)]:
+        del items[oid]
+    return in_mosaic_dataset
+
+management = types.SimpleNamespace(AddRastersToMosaicDataset=AddRastersToMosaicDataset,
+                                   RemoveRastersFromMosaicDataset=RemoveRastersFromMosaicDataset,
+                                   **{name: tool(name) for name in (
+    "AddField", "BuildBoundary", "BuildFootprints", "BuildOverviews", "CalculateCellSizeRanges",
+    "CalculateStatistics", "CreateFeatureclass", "CreateFileGDB", "CreateMosaicDataset")})
+
+env = types.SimpleNamespace(workspace="memory", overwriteOutput=True)
+
+for name in ("AddMessage", "AddWarning", "AddError", "SetProgressor", "SetProgressorLabel", "SetProgressorPosition", "ResetProgressor"):
+    globals()[name] = tool(name)
@@ -0,0 +1,136 @@
+""" Generator of synthetic Sentinel-2 L2A tile trees in the layout of the AWS archive:
+        tiles/<utmZone>/<latitudeBand>/<gridSquare>/<year>/<month>/<day>/<sequence>/
+            metadata.xml (psd-12 or psd-14), tileInfo.json, qi/MSK_CLOUDS_B00.gml, qi/CLD_20m.jp2, R10m/*.jp2, R20m/*.jp2
+    The band files are stubs of bandBytes bytes, enough for the importer and the raster type which never decode them. """
+import argparse
+import json
+import math
+import os
+import random
+
+namespaces = {12: "https://psd-12.sentinel2.eo.esa.int/PSD/S2_PDI_Level-2A_Tile_Metadata.xsd",
+              14: "https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-2A_Tile_Metadata.xsd"}
+
+bands = {"R10m": ["B02", "B03", "B04", "B08"],
+         "R20m": ["B02", "B03", "B04", "B05", "B06", "B07", "B8A", "B11", "B12"]}
+
+tileSize = 109800
+
+metadataTemplate = """<?xml version="1.0" encoding="UTF-8"?>
+<n1:Level-2A_Tile_ID xmlns:n1="{namespace}">
+<n1:General_Info><TILE_ID metadataLevel="Brief">{tileId}</TILE_ID><SENSING_TIME metadataLevel="Standard">{sensingTime}</SENSING_TIME></n1:General_Info>
+<n1:Geometric_Info><Tile_Geocoding metadataLevel="Brief"><HORIZONTAL_CS_NAME>WGS84 / UTM zone {zone}N</HORIZONTAL_CS_NAME><HORIZONTAL_CS_CODE>EPSG:326{zone:02d}</HORIZONTAL_CS_CODE>{sizes}{geopositions}</Tile_Geocoding>
+<Tile_Angles metadataLevel="Standard"><Mean_Viewing_Incidence_Angle_List>{angles}</Mean_Viewing_Incidence_Angle_List></Tile_Angles></n1:Geometric_Info>
+<n1:Quality_Indicators_Info metadataLevel="Standard"><L2A_Image_Content_QI><CLOUD_COVERAGE_PERCENTAGE>{cloudCoverage:.6f}</CLOUD_COVERAGE_PERCENTAGE><VEGETATION_PERCENTAGE>{vegetation:.6f}</VEGETATION_PERCENTAGE></L2A_Image_Content_QI></n1:Quality_Indicators_Info>
+</n1:Level-2A_Tile_ID>
+"""
+
+maskTemplate = """<?xml version="1.0" encoding="UTF-8"?>
+<eop:Mask xmlns:eop="http://www.opengis.net/eop/2.0" xmlns:gml="http://www.opengis.net/gml/3.2" gml:id="{maskId}">
+<gml:boundedBy><gml:Envelope srsName="urn:ogc:def:crs:EPSG:8.8.1:326{zone:02d}"><gml:lowerCorner>{xmin} {ymin}</gml:lowerCorner><gml:upperCorner>{xmax} {ymax}</gml:upperCorner></gml:Envelope></gml:boundedBy>
+<eop:maskMembers>{features}</eop:maskMembers>
+</eop:Mask>
+"""
+
+featureTemplate = ('<eop:MaskFeature gml:id="{maskType}.{index}"><eop:maskType codeSpace="urn:gs2:S2PDGS:maskType">{maskType}</eop:maskType>'
+                   '<eop:extentOf><gml:Polygon gml:id="{maskType}.{index}.0"><gml:exterior><gml:LinearRing>'
+                   '<gml:posList srsDimension="2">{posList}</gml:posList></gml:LinearRing></gml:exterior></gml:Polygon></eop:extentOf></eop:MaskFeature>')
+
+def tileFolder(root, zone, latitudeBand, gridSquare, date, sequence=0):
+    return os.path.join(root, "tiles", str(zone), latitudeBand, gridSquare, str(date[0]), str(date[1]), str(date[2]), str(sequence))
+
+def maskPolygon(rnd, ulx, uly, vertices, grid=20):
+    """ A closed ring of vertices points around a random centre, snapped to the grid like the real masks. """
+    radius = rnd.uniform(200, 3000)
+    cx = ulx + rnd.uniform(radius, tileSize - radius)
+    cy = uly - rnd.uniform(radius, tileSize - radius)
+    ring = []
+    for i in range(vertices):
+        a = 2*math.pi*i/vertices
+        r = radius*rnd.uniform(0.7, 1.0)
+        ring.append((int(cx + r*math.cos(a))//grid*grid, int(cy + r*math.sin(a))//grid*grid))
+    ring.append(ring[0])
+    return ring
+
+def writeTile(folder, rnd, zone, latitudeBand, gridSquare, date, psd=14, features=50, vertices=40, bandBytes=0):
+    """ Writes one tile folder and returns the path of its metadata.xml """
+    ulx, uly = 100000*rnd.randint(1, 7) - 20, 100000*rnd.randint(40, 70) + 20
+    tileName = "{0}{1}{2}".format(zone, latitudeBand, gridSquare)
+    stamp = "{0:04d}{1:02d}{2:02d}T{3:02d}{4:02d}{5:02d}".format(date[0], date[1], date[2], rnd.randint(8, 12), rnd.randint(0, 59), rnd.randint(0, 59))
+    productName = "S2A_MSIL2A_{0}_N0206_R{1:03d}_T{2}_{0}".format(stamp, rnd.randint(1, 143), tileName)
+
+    for subFolder in ("R10m", "R20m", "R60m", "qi", "auxiliary"):
+        os.makedirs(os.path.join(folder, subFolder), exist_ok=True)
+    stub = b"\0"*bandBytes
+    for resolutionFolder, names in bands.items():
+        for name in names:
+            with open(os.path.join(folder, resolutionFolder, name + ".jp2"), "wb") as f:
+                f.write(stub)
+    with open(os.path.join(folder, "qi", "CLD_20m.jp2"), "wb") as f:
+        f.write(stub)
+
+    sizes = "".join('<Size resolution="{0}"><NROWS>{1}</NROWS><NCOLS>{1}</NCOLS></Size>'.format(r, tileSize//r) for r in (10, 20, 60))
+    geopositions = "".join('<Geoposition resolution="{0}"><ULX>{1}</ULX><ULY>{2}</ULY><XDIM>{0}</XDIM><YDIM>-{0}</YDIM></Geoposition>'.format(r, ulx, uly)
+                           for r in (10, 20, 60))
+    angles = "".join('<Mean_Viewing_Incidence_Angle bandId="{0}"><ZENITH_ANGLE unit="deg">{1:.6f}</ZENITH_ANGLE>'
+                     '<AZIMUTH_ANGLE unit="deg">{2:.6f}</AZIMUTH_ANGLE></Mean_Viewing_Incidence_Angle>'.format(b, rnd.uniform(2, 11), rnd.uniform(0, 360))
+                     for b in range(13))
+    sensingTime = "{0}-{1:02d}-{2:02d}T{3}:{4}:{5}.{6:03d}Z".format(date[0], date[1], date[2], stamp[9:11], stamp[11:13], stamp[13:15], rnd.randint(0, 999))
+    metadataPath = os.path.join(folder, "metadata.xml")
+    with open(metadataPath, "w") as f:
+        f.write(metadataTemplate.format(namespace=namespaces[psd], tileId="S2A_OPER_MSI_L2A_TL_SGS__{0}_T{1}".format(stamp, tileName),
+                sensingTime=sensingTime, zone=zone, sizes=sizes, geopositions=geopositions, angles=angles,
+                cloudCoverage=rnd.uniform(0, 100), vegetation=rnd.uniform(0, 100)))
+
+    footprint = [[ulx, uly], [ulx + tileSize, uly], [ulx + tileSize, uly - tileSize], [ulx, uly - tileSize], [ulx, uly]]
+    tileInfo = {"path": "/".join(folder.split(os.sep)[-8:]),
+                "timestamp": sensingTime, "utmZone": zone, "latitudeBand": latitudeBand, "gridSquare": gridSquare,
+                "datastrip": {"id": "S2A_OPER_MSI_L2A_DS_SGS__{0}".format(stamp)},
+                "tileGeometry": {"type": "Polygon", "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG:8.8.1:326{0:02d}".format(zone)}},
+                                 "coordinates": [footprint]},
+                "tileDataGeometry": {"type": "Polygon", "crs": {"type": "name", "properties": {"name": "urn:ogc:def:crs:EPSG:8.8.1:326{0:02d}".format(zone)}},
+                                     "coordinates": [footprint]},
+                "tileOrigin": {"type": "Point", "coordinates": [ulx, uly]},
+                "dataCoveragePercentage": 100.0, "cloudyPixelPercentage": 0.0, "productName": productName,
+                "productPath": "products/{0}/{1}/{2}/{3}".format(date[0], date[1], date[2], productName)}
+    with open(os.path.join(folder, "tileInfo.json"), "w") as f:
+        json.dump(tileInfo, f, indent=2)
+
+    maskFeatures = []
+    for i in range(features):
+        maskType = "OPAQUE" if i % 3 else "CIRRUS"
+        ring = maskPolygon(rnd, ulx, uly, vertices)
+        maskFeatures.append(featureTemplate.format(maskType=maskType, index=i, posList=" ".join("{0} {1}".format(x, y) for x, y in ring)))
+    with open(os.path.join(folder, "qi", "MSK_CLOUDS_B00.gml"), "w") as f:
+        f.write(maskTemplate.format(maskId="S2A_OPER_MSK_CLOUDS_SGS__{0}_A015884_T{1}_B00_MSIL1C".format(stamp, tileName),
+                zone=zone, xmin=ulx, ymin=uly - tileSize, xmax=ulx + tileSize, ymax=uly, features="".join(maskFeatures)))
+    return metadataPath
+
+def generateArchive(root, tiles=10, features=50, vertices=40, psd14Ratio=0.5, bandBytes=0, seed=0):
+    """ Writes tiles synthetic tiles under root/tiles (spread over UTM zones, grid squares and the days of 2018)
+        and returns the paths of their metadata.xml. The same arguments always give the same archive. """
+    rnd = random.Random(seed)
+    paths = []
+    for i in range(tiles):
+        zone = 31 + i % 7
+        latitudeBand = "TUV"[i//7 % 3]
+        gridSquare = "ABCDEFGH"[i//21 % 8] + "QRSTUV"[i//168 % 6]
+        day = i//1008
+        date = (2018, 1 + day//28 % 12, 1 + day % 28)
+        folder = tileFolder(root, zone, latitudeBand, gridSquare, date)
+        psd = 14 if rnd.random() < psd14Ratio else 12
+        paths.append(writeTile(folder, rnd, zone, latitudeBand, gridSquare, date, psd, features, vertices, bandBytes))
+    return paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Writes a synthetic Sentinel-2 L2A tile tree.")
+    parser.add_argument("root")
+    parser.add_argument("--tiles", type=int, default=10)
+    parser.add_argument("--features", type=int, default=50, help="cloud mask polygons per tile")
+    parser.add_argument("--vertices", type=int, default=40, help="vertices per cloud mask polygon")
+    parser.add_argument("--psd14-ratio", type=float, default=0.5, help="share of tiles with psd-14 metadata")
+    parser.add_argument("--band-bytes", type=int, default=0, help="size of the stub band files")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    paths = generateArchive(args.root, args.tiles, args.features, args.vertices, args.psd14_ratio, args.band_bytes, args.seed)
+    print("{0} tiles written to {1}".format(len(paths), args.root))